@@ -0,0 +1,217 @@
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+
+import image_processing
+
+
+def expand_command(template, filename):
+    ''' (str, str) -> str
+    Returns the command template for the input file filename.
+    '{input}' is replaced by filename, '{stem}' by filename without its
+    extension and '{name}' by the file name without its directory.
+    
+    >>> expand_command('LOAD<{input}> INV SAVE<out/{name}.inv>', 'scans/a.pgm')
+    'LOAD<scans/a.pgm> INV SAVE<out/a.pgm.inv>'
+    
+    >>> expand_command('LOAD<{input}> CP SAVE<{stem}.pgmc>', 'scans/a.pgm')
+    'LOAD<scans/a.pgm> CP SAVE<scans/a.pgmc>'
+    '''
+    
+    cmd = template.replace('{input}', filename)
+    cmd = cmd.replace('{stem}', os.path.splitext(filename)[0])
+    cmd = cmd.replace('{name}', os.path.basename(filename))
+    
+    return cmd
+
+
+def read_manifest(filename):
+    ''' (str) -> list<str>
+    Returns the input files listed in the manifest filename, one per line.
+    Blank lines and lines starting with '#' are skipped.
+    '''
+    
+    fobj = open(filename, 'r')
+    lines = fobj.read().splitlines()
+    fobj.close()
+    
+    return [line.strip() for line in lines if line.strip() and not(line.strip().startswith('#'))]
+
+
+def find_inputs(patterns, manifest=None):
+    ''' (list<str>, str) -> list<str>
+    Returns the input files matching the glob patterns, followed by the files
+    listed in manifest, without duplicates. Patterns without wildcards are
+    kept even if the file does not exist, so that it is reported as failed.
+    
+    >>> find_inputs(['comp.pgm', 'no_such_file_*.pgm', 'missing.pgm'])
+    ['comp.pgm', 'missing.pgm']
+    '''
+    
+    filenames = []
+    
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            filenames.extend(sorted(glob.glob(pattern)))
+        else:
+            filenames.append(pattern)
+    
+    if manifest is not None:
+        filenames.extend(read_manifest(manifest))
+    
+    return list(dict.fromkeys(filenames))
+
+
+def run_one(task):
+    ''' (list) -> list
+    Runs the command template of task = [filename, template, streaming,
+    optimize, cache_dir, cache_bytes] on filename, with a ResultCache in
+    cache_dir unless cache_dir is None. Returns [filename, error, seconds, num_pixel],
+    where error is None on success and the error message otherwise.
+    This is called in the worker processes, so it never raises.
+    '''
+    
+    filename, template, streaming, optimize, cache_dir, cache_bytes = task
+    start = time.perf_counter()
+    
+    try:
+        cache = None
+        if cache_dir is not None:
+            cache = image_processing.ResultCache(cache_dir, cache_bytes)
+        file_type, num_row, num_col = image_processing.read_image_header(filename)
+        image_processing.process_command(expand_command(template, filename), streaming, optimize, cache=cache)
+        error = None
+    except Exception as e:
+        num_row = num_col = 0
+        error = type(e).__name__ + ': ' + str(e)
+    
+    return [filename, error, time.perf_counter() - start, num_row * num_col]
+
+
+def run_batch(template, filenames, processes=None, chunksize=None, streaming=False, optimize=True, report=None,
+              cache_dir=None, cache_bytes=1024 * 1024 * 1024):
+    ''' (str, list<str>, int, int, bool, bool, function, str, int) -> list<list>
+    Runs the command template on every file in filenames across a pool of
+    processes worker processes (default: one per CPU). Files are handed to
+    the workers chunksize at a time. report, if given, is called with the
+    result of each file as it finishes. If cache_dir is given, results are
+    shared between files and runs through a ResultCache of at most
+    cache_bytes in cache_dir. Returns the results of run_one, sorted by filename.
+    
+    >>> results = run_batch('LOAD<{input}> INV SAVE<{stem}_inv.pgm>', ['comp.pgm', 'missing.pgm'], processes=1)
+    >>> [[result[0], result[1] is None] for result in results]
+    [['comp.pgm', True], ['missing.pgm', False]]
+    '''
+    
+    tasks = [[filename, template, streaming, optimize, cache_dir, cache_bytes] for filename in filenames]
+    results = []
+    
+    if processes is None:
+        processes = os.cpu_count() or 1
+    
+    if chunksize is None:
+        chunksize = max(1, len(tasks) // (processes * 4))
+    
+    if processes == 1:
+        outcomes = map(run_one, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        outcomes = pool.imap_unordered(run_one, tasks, chunksize)
+    
+    try:
+        for result in outcomes:
+            results.append(result)
+            if report is not None:
+                report(result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    return sorted(results)
+
+
+def print_result(result):
+    ''' (list) -> NoneType
+    Prints one line for the result of run_one.
+    
+    >>> print_result(['a.pgm', None, 0.25, 100])
+    ok      a.pgm  0.250s
+    >>> print_result(['b.pgm', 'AssertionError: bad', 0.01, 0])
+    FAILED  b.pgm  AssertionError: bad
+    '''
+    
+    filename, error, seconds, num_pixel = result
+    
+    if error is None:
+        print('ok      %s  %.3fs' % (filename, seconds))
+    else:
+        print('FAILED  %s  %s' % (filename, error))
+
+
+def summarize(results, seconds):
+    ''' (list<list>, float) -> str
+    Returns a summary of results for a batch that took seconds to run.
+    
+    >>> summarize([['a.pgm', None, 0.5, 2000000], ['b.pgm', 'Error', 0.1, 0]], 1.0)
+    '2 files, 1 ok, 1 failed in 1.00s (2.0 files/s, 2.0 Mpixel/s)'
+    '''
+    
+    num_failed = len([result for result in results if result[1] is not None])
+    num_pixel = sum(result[3] for result in results)
+    seconds = max(seconds, 1e-9)
+    
+    return '%d files, %d ok, %d failed in %.2fs (%.1f files/s, %.1f Mpixel/s)' % (
+        len(results), len(results) - num_failed, num_failed, seconds,
+        len(results) / seconds, num_pixel / seconds / 1e6)
+
+
+def main(argv=None):
+    ''' (list<str>) -> int
+    Command line entry point. Returns the exit status: 0 if every file was
+    processed, 1 if any failed and 2 if there was nothing to do.
+    '''
+    
+    parser = argparse.ArgumentParser(
+        description='Run an image command on many PGM files in parallel.',
+        epilog="Example: batch_process.py 'LOAD<{input}> INV SAVE<out/{name}>' 'scans/*.pgm'")
+    parser.add_argument('command', help='command template; {input}, {stem} and {name} are replaced for each file')
+    parser.add_argument('inputs', nargs='*', help='input files or glob patterns')
+    parser.add_argument('-m', '--manifest', help='file listing input files, one per line')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='number of worker processes (default: one per CPU)')
+    parser.add_argument('-c', '--chunksize', type=int, default=None, help='files handed to a worker at a time')
+    parser.add_argument('-s', '--streaming', action='store_true', help='process images one row at a time')
+    parser.add_argument('--no-optimize', action='store_true', help='run the commands exactly as given')
+    parser.add_argument('--cache', metavar='DIR', help='reuse results of earlier runs stored in DIR')
+    parser.add_argument('--cache-size', type=int, default=1024, help='size limit of the cache in MB (default: 1024)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only report failures and the summary')
+    args = parser.parse_args(argv)
+    
+    filenames = find_inputs(args.inputs, args.manifest)
+    
+    if len(filenames) == 0:
+        print('No input files.', file=sys.stderr)
+        return 2
+    
+    def report(result):
+        if not(args.quiet) or result[1] is not None:
+            print_result(result)
+    
+    start = time.perf_counter()
+    results = run_batch(args.command, filenames, args.processes, args.chunksize,
+                        args.streaming, not(args.no_optimize), report,
+                        args.cache, args.cache_size * 1024 * 1024)
+    print(summarize(results, time.perf_counter() - start))
+    
+    if any(result[1] is not None for result in results):
+        return 1
+    
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
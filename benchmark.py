@@ -0,0 +1,305 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import image_processing
+
+
+def reference_compress(img_matrix):
+    ''' (list<list<int>>) -> list<list<str>>
+    Compresses img_matrix the original way: one find_end_of_repetition
+    scan and one str(A) + 'x' + str(B) per run. Used to check that
+    compress gives exactly the same output.
+    
+    >>> reference_compress([[1, 5, 5, 5, 7]])
+    [['1x1', '5x3', '7x1']]
+    '''
+    
+    comp_img_matrix = []
+    
+    for row in img_matrix:
+        comp_row = []
+        c = 0
+        while c < len(row):
+            target_num = row[c]
+            last_occur = image_processing.find_end_of_repetition(row, c, target_num)
+            num_occur = last_occur - c + 1
+            comp_row.append(str(target_num) + 'x' + str(num_occur))
+            c += num_occur
+        comp_img_matrix.append(comp_row)
+    
+    return comp_img_matrix
+
+
+def make_image(kind, num_row, num_col, seed=0):
+    ''' (str, int, int, int) -> list<list<int>>
+    Returns a num_row x num_col test image. kind is one of 'flat' (one value),
+    'striped' (long runs), 'text' (a light page with short dark strokes,
+    like a scanned page) or 'noise' (random pixels, runs of about one pixel).
+    
+    >>> make_image('flat', 2, 3)
+    [[0, 0, 0], [0, 0, 0]]
+    
+    >>> [len(row) for row in make_image('text', 3, 50)]
+    [50, 50, 50]
+    '''
+    
+    rand = random.Random(seed)
+    img_matrix = []
+    
+    for r in range(num_row):
+        if kind == 'flat':
+            row = [0] * num_col
+        elif kind == 'striped':
+            row = []
+            while len(row) < num_col:
+                row.extend([rand.randrange(256)] * rand.randint(1, 64))
+            row = row[:num_col]
+        elif kind == 'text':
+            row = [255] * num_col
+            # one line of text every 12 rows, 8 rows high
+            if r % 12 < 8:
+                c = rand.randint(0, 6)
+                while c < num_col:
+                    stroke = rand.randint(1, 3)
+                    row[c:c + stroke] = [rand.choice([0, 32, 64])] * len(row[c:c + stroke])
+                    c += stroke + rand.randint(1, 8)
+        else:
+            row = [rand.randrange(256) for c in range(num_col)]
+        img_matrix.append(row)
+    
+    return img_matrix
+
+
+def time_call(func, *args, repeat=3):
+    ''' (function, ..., int) -> list
+    Returns [seconds, result] for the fastest of repeat calls of func(*args).
+    '''
+    
+    best = None
+    
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    
+    return [best, result]
+
+
+def benchmark_compress(num_row=500, num_col=2000):
+    ''' (int, int) -> NoneType
+    Prints how long reference_compress and compress take on each kind of
+    test image, and stops with an AssertionError if their outputs differ.
+    '''
+    
+    backends = ['python'] if image_processing.numpy is None else ['python', 'numpy']
+    old_backend = image_processing.BACKEND
+    
+    for kind in ['flat', 'striped', 'noise']:
+        img_matrix = make_image(kind, num_row, num_col)
+        img = image_processing.Image.from_matrix(img_matrix)
+        ref_time, expected = time_call(reference_compress, img_matrix)
+        print('%-8s reference      %8.3fs' % (kind, ref_time))
+    
+        for backend in backends:
+            image_processing.set_backend(backend)
+            new_time, result = time_call(image_processing.compress, img)
+            if result != expected:
+                raise AssertionError('compress does not match the reference on the ' + kind + ' image.')
+            print('%-8s compress %-6s %8.3fs  x%.1f' % (kind, backend, new_time, ref_time / new_time))
+    
+    image_processing.set_backend(old_backend)
+
+
+def peak_memory(func, *args):
+    ''' (function, ...) -> int
+    Returns the most memory, in bytes, allocated at once during func(*args),
+    as traced by tracemalloc. Memory mapped files are not counted.
+    '''
+    
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_cases(kind, num_row, num_col, directory):
+    ''' (str, int, int, str) -> list<list>
+    Writes the test files for a kind of image to directory and returns the
+    cases to time as [name, num_pixel, function, arguments].
+    '''
+    
+    ip = image_processing
+    img_matrix = make_image(kind, num_row, num_col)
+    img = ip.Image.from_matrix(img_matrix)
+    comp_img = ip.compress(img)
+    half = [num_row // 4, num_col // 4, num_row // 2, num_col // 2]
+    num_pixel = num_row * num_col
+    files = {}
+    
+    for img_format, extension in [[None, '.pgm'], ['P5', '.p5.pgm']]:
+        files[extension] = os.path.join(directory, kind + extension)
+        ip.save_image(img, files[extension], img_format)
+    
+    for img_format, extension in [[None, '.pgmc'], ['P5C', '.p5c']]:
+        files[extension] = os.path.join(directory, kind + extension)
+        ip.save_image(comp_img, files[extension], img_format)
+    
+    out = os.path.join(directory, 'out')
+    
+    return [['load_image P2', num_pixel, ip.load_image, [files['.pgm'], True]],
+            ['load_image P5', num_pixel, ip.load_image, [files['.p5.pgm'], True]],
+            ['load_image P2C', num_pixel, ip.load_image, [files['.pgmc']]],
+            ['load_image P5C', num_pixel, ip.load_image, [files['.p5c']]],
+            ['save_image P2', num_pixel, ip.save_image, [img, out]],
+            ['save_image P5', num_pixel, ip.save_image, [img, out, 'P5']],
+            ['save_image P2C', num_pixel, ip.save_image, [comp_img, out]],
+            ['invert', num_pixel, ip.invert, [img]],
+            ['flip_horizontal', num_pixel, ip.flip_horizontal, [img]],
+            ['flip_vertical', num_pixel, ip.flip_vertical, [img]],
+            ['crop', num_pixel // 4, ip.crop, [img] + half],
+            ['compress', num_pixel, ip.compress, [img]],
+            ['compress adaptive', num_pixel, ip.compress, [img, False, 'adaptive']],
+            ['compress adaptive P5C', num_pixel, ip.compress, [img, True, 'adaptive']],
+            ['decompress', num_pixel, ip.decompress, [comp_img]],
+            ['invert_compressed', num_pixel, ip.invert_compressed, [comp_img]],
+            ['pipeline INV FH CR', num_pixel, ip.process_command,
+             ['LOAD<' + files['.pgm'] + '> INV FH CR<' + ','.join(map(str, half)) + '> SAVE<' + out + '>']],
+            ['pipeline CP', num_pixel, ip.process_command,
+             ['LOAD<' + files['.p5.pgm'] + '> CP SAVE<' + out + '>']],
+            ['pipeline DC INV', num_pixel, ip.process_command,
+             ['LOAD<' + files['.pgmc'] + '> DC INV SAVE<' + out + ',P5>']]]
+
+
+def run_benchmarks(num_row=1000, num_col=1000, kinds=None, repeat=3, report=None):
+    ''' (int, int, list<str>, int, function) -> dict
+    Times every case of benchmark_cases on num_row x num_col images of each
+    kind in kinds (default: all). Returns a dict from 'case/kind' to a dict
+    with the best 'seconds' of repeat runs, 'pixels_per_sec' and
+    'peak_bytes'. report, if given, is called with each name and result.
+    '''
+    
+    if kinds is None:
+        kinds = ['flat', 'striped', 'text', 'noise']
+    
+    directory = tempfile.mkdtemp()
+    results = {}
+    
+    try:
+        for kind in kinds:
+            for name, num_pixel, func, args in benchmark_cases(kind, num_row, num_col, directory):
+                seconds = time_call(func, *args, repeat=repeat)[0]
+                result = {'seconds': seconds,
+                          'pixels_per_sec': num_pixel / max(seconds, 1e-9),
+                          'peak_bytes': peak_memory(func, *args)}
+                results[name + '/' + kind] = result
+                if report is not None:
+                    report(name + '/' + kind, result)
+    finally:
+        shutil.rmtree(directory)
+    
+    return results
+
+
+def print_result(name, result):
+    ''' (str, dict) -> NoneType
+    Prints one line of benchmark results.
+    
+    >>> print_result('invert/flat', {'seconds': 0.5, 'pixels_per_sec': 2e6, 'peak_bytes': 3 * 1024 * 1024})
+    invert/flat                        0.5000s     2.00 Mpixel/s     3.0 MB peak
+    '''
+    
+    print('%-32s %8.4fs %8.2f Mpixel/s %7.1f MB peak' % (
+        name, result['seconds'], result['pixels_per_sec'] / 1e6, result['peak_bytes'] / 1024 / 1024))
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    ''' (dict, dict, float) -> list<str>
+    Returns a description of each regression of results against baseline:
+    a case whose throughput fell, or whose peak memory grew, by more than
+    tolerance (a fraction). Cases missing from either are ignored.
+    
+    >>> old = {'invert/flat': {'seconds': 1.0, 'pixels_per_sec': 100.0, 'peak_bytes': 1000}}
+    >>> new = {'invert/flat': {'seconds': 2.0, 'pixels_per_sec': 50.0, 'peak_bytes': 1100}}
+    >>> compare_results(new, old)
+    ['invert/flat: 50% slower (100 -> 50 pixels/s)']
+    '''
+    
+    regressions = []
+    
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        new = results[name]
+        if new['pixels_per_sec'] < old['pixels_per_sec'] * (1 - tolerance):
+            regressions.append('%s: %d%% slower (%.0f -> %.0f pixels/s)' % (
+                name, round(100 * (1 - new['pixels_per_sec'] / old['pixels_per_sec'])),
+                old['pixels_per_sec'], new['pixels_per_sec']))
+        if new['peak_bytes'] > old['peak_bytes'] * (1 + tolerance) + 64 * 1024:
+            regressions.append('%s: %d%% more memory (%d -> %d bytes peak)' % (
+                name, round(100 * (new['peak_bytes'] / max(old['peak_bytes'], 1) - 1)),
+                old['peak_bytes'], new['peak_bytes']))
+    
+    return regressions
+
+
+def main(argv=None):
+    ''' (list<str>) -> int
+    Command line entry point. Returns 1 if a regression against the
+    baseline was found or compress does not match its reference, else 0.
+    '''
+    
+    parser = argparse.ArgumentParser(description='Benchmark the image functions on synthetic images.')
+    parser.add_argument('--size', default='1000x1000', help='image size as ROWSxCOLS (default: 1000x1000)')
+    parser.add_argument('--kinds', default='flat,striped,text,noise', help='comma separated kinds of image')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each case; the fastest is kept')
+    parser.add_argument('--backend', choices=['python', 'numpy'], help='image_processing backend to use')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown or memory growth (default: 0.2)')
+    parser.add_argument('--save', metavar='FILE', help='write the results as JSON to FILE, e.g. to make a baseline')
+    parser.add_argument('--check-compress', action='store_true', help='only check compress against reference_compress')
+    args = parser.parse_args(argv)
+    
+    num_row, num_col = [int(n) for n in args.size.lower().split('x')]
+    
+    if args.backend is not None:
+        image_processing.set_backend(args.backend)
+    
+    if args.check_compress:
+        benchmark_compress(num_row, num_col)
+        return 0
+    
+    results = run_benchmarks(num_row, num_col, args.kinds.split(','), args.repeat, print_result)
+    
+    if args.save is not None:
+        fobj = open(args.save, 'w')
+        json.dump(results, fobj, indent=1, sort_keys=True)
+        fobj.close()
+    
+    if args.baseline is not None:
+        fobj = open(args.baseline, 'r')
+        baseline = json.load(fobj)
+        fobj.close()
+        regressions = compare_results(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+        print('No regressions against ' + args.baseline + '.')
+    
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,549 @@
+import array
+import asyncio
+import bisect
+import collections
 import doctest
+import hashlib
+import json
+import io
+import mmap
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+IDENTITY_TABLE = bytes(range(256))
+INVERT_TABLE = bytes(range(255, -1, -1))
+
+# 'numpy' runs the image operations as NumPy array operations, 'python'
+# runs them in pure Python. NumPy is used whenever it can be imported.
+BACKEND = 'python' if numpy is None else 'numpy'
+
+
+def set_backend(backend):
+    ''' (str) -> NoneType
+    Selects how image operations are run: 'numpy' (vectorised, needs NumPy)
+    or 'python'. Both give exactly the same results.
+    
+    >>> old_backend = BACKEND
+    >>> set_backend('python')
+    >>> invert([[0, 100]])
+    [[255, 155]]
+    >>> set_backend(old_backend)
+    
+    >>> set_backend('fortran')
+    Traceback (most recent call last):
+    AssertionError: The backend must be 'python' or 'numpy'.
+    '''
+    
+    global BACKEND
+    
+    if backend not in ['python', 'numpy']:
+        raise AssertionError("The backend must be 'python' or 'numpy'.")
+    
+    if backend == 'numpy' and numpy is None:
+        raise AssertionError('The numpy backend needs NumPy to be installed.')
+    
+    BACKEND = backend
+
+
+def image_to_array(img):
+    ''' (Image) -> numpy.ndarray
+    Returns a height x width uint8 array that shares img's buffer.
+    '''
+    
+    return numpy.ndarray((img.height, img.width), numpy.uint8, img.data, 0, (img.stride, 1))
+
+
+def array_to_image(arr):
+    ''' (numpy.ndarray) -> Image
+    Returns an Image over the pixels of the 2-D uint8 array arr,
+    sharing its buffer if arr is already contiguous.
+    '''
+    
+    arr = numpy.ascontiguousarray(arr, numpy.uint8)
+    
+    return Image(arr.shape[1], arr.shape[0], memoryview(arr.reshape(-1)))
+
+
+# When False, images made by this module (Image objects and CompressedMatrix
+# lists) are trusted and only checked where they enter: on load, or when a
+# plain nested list is passed in. When True, everything is checked every time.
+STRICT_VALIDATION = False
+
+
+def set_strict_validation(strict):
+    ''' (bool) -> NoneType
+    Turns strict validation on or off. In strict mode every operation
+    re-checks its input, even Images and CompressedMatrix lists that were
+    made by this module. This is slower but catches matrices that were
+    changed by hand after they were made.
+    
+    >>> set_strict_validation(True)
+    >>> is_valid_compressed_image(CompressedMatrix([['1x2'], ['3x3']]))
+    False
+    >>> set_strict_validation(False)
+    '''
+    
+    global STRICT_VALIDATION
+    STRICT_VALIDATION = strict
+
+
+class CompressedMatrix(list):
+    ''' A compressed image matrix ('AxB' strings) that is known to be valid,
+    because this module made it or checked it on load. It behaves exactly
+    like a nested list, but is_valid_compressed_image accepts it without
+    walking every run unless strict validation is on.
+    
+    >>> CompressedMatrix([['0x5', '200x2'], ['111x7']])
+    [['0x5', '200x2'], ['111x7']]
+    '''
+    
+    __slots__ = ()
+
+
+class DedupMatrix(CompressedMatrix):
+    ''' A CompressedMatrix whose rows that are the same list are saved as
+    back-references (see RowReferences), as made by dedup_rows or loaded
+    from a file with back-references. In any other matrix, rows that happen
+    to be the same list are saved in full.
+    
+    >>> row = ['5x3']
+    >>> format_image([row, row]), format_image(DedupMatrix([row, row]))
+    (b'P2C\\n3 2\\n255\\n5x3\\n5x3\\n', b'P2C\\n3 2\\n255\\n5x3\\n=1\\n')
+    '''
+    
+    __slots__ = ()
+
+
+def compressed_like(comp_img_matrix, rows):
+    ''' (<list<list<str>>>, iterable<list<str>>) -> <list<list<str>>>
+    Returns rows as a CompressedMatrix, or as a DedupMatrix if
+    comp_img_matrix is one, so rows it shares are still saved as
+    back-references.
+    
+    >>> type(compressed_like(dedup_rows([['5x3']]), [['6x3']])).__name__
+    'DedupMatrix'
+    '''
+    
+    if isinstance(comp_img_matrix, DedupMatrix):
+        return DedupMatrix(rows)
+    
+    return CompressedMatrix(rows)
+
+
+# A row of a compressed file can refer back to one of at most this many
+# rows before it, so a reader only needs to keep that many rows.
+ROW_REF_WINDOW = 256
+
+
+class RowReferences:
+    ''' Picks the rows of a compressed image that are written as
+    back-references: a row that is the same list as one of the last window
+    rows is written as '=d' ('P2C') or as a reference entry ('P5C'),
+    meaning the row d rows before it. The writers only use it for a
+    DedupMatrix or a stream of one, so other images are written in full.
+    The rows are kept while they can be referenced, so that their ids are
+    not reused.
+    
+    >>> row = ['5x3']
+    >>> refs = RowReferences()
+    >>> [refs.distance(next_row) for next_row in [row, ['6x3'], row, row]]
+    [0, 0, 2, 1]
+    '''
+    
+    __slots__ = ('window', 'num_row', 'rows')
+    
+    def __init__(self, window=ROW_REF_WINDOW):
+        ''' (RowReferences, int) -> NoneType
+        '''
+        
+        self.window = window
+        self.num_row = 0
+        self.rows = collections.OrderedDict()
+    
+    def distance(self, row):
+        ''' (RowReferences, list<str>) -> int
+        Records row as the next row and returns how many rows before it the
+        same list was last seen, or 0 if it was not in the last window rows.
+        '''
+        
+        r = self.num_row
+        self.num_row += 1
+        seen = self.rows.pop(id(row), None)
+        self.rows[id(row)] = [r, row]
+        
+        if len(self.rows) > self.window:
+            self.rows.popitem(last=False)
+        
+        if seen is not None and r - seen[0] <= self.window:
+            return r - seen[0]
+        
+        return 0
+
+
+def row_reference(comp_row):
+    ''' (list<str>) -> int
+    Returns d if comp_row, as read from a 'P2C' file, is the back-reference
+    '=d' to the row d rows before it, and 0 otherwise.
+    
+    >>> row_reference(['=3']), row_reference(['0x5'])
+    (3, 0)
+    '''
+    
+    if len(comp_row) == 1 and comp_row[0][:1] == '=' and comp_row[0][1:].isdecimal():
+        return int(comp_row[0][1:])
+    
+    return 0
+
+
+def dedup_rows(comp_img_matrix, window=ROW_REF_WINDOW):
+    ''' (<list<list<str>>>, int) -> <list<list<str>>>
+    Returns comp_img_matrix with every row that is equal to a row at most
+    window rows before it replaced by that same list, so the row is held
+    once in memory and saved as a back-reference (see RowReferences).
+    Rows are looked up in a hash table of at most window rows.
+    
+    >>> comp_img_matrix = dedup_rows([['5x3'], ['6x3'], ['5x3']])
+    >>> comp_img_matrix
+    [['5x3'], ['6x3'], ['5x3']]
+    >>> comp_img_matrix[2] is comp_img_matrix[0]
+    True
+    '''
+    
+    table = collections.OrderedDict()
+    new_comp_img_matrix = DedupMatrix()
+    
+    for r, row in enumerate(comp_img_matrix):
+        key = tuple(row)
+        seen = table.pop(key, None)
+        if seen is not None and r - seen[0] <= window:
+            row = seen[1]
+        table[key] = [r, row]
+        if len(table) > window:
+            table.popitem(last=False)
+        new_comp_img_matrix.append(row)
+    
+    return new_comp_img_matrix
+
+
+def map_compressed_rows(func, rows, window=ROW_REF_WINDOW):
+    ''' (function, iterable<list<str>>, int) -> iterator
+    Yields func(row) for each of rows. A row that is the same list as one
+    of the last window rows gets the same result, so rows shared through
+    back-references are only worked on once and stay shared.
+    
+    >>> row = ['5x3']
+    >>> results = list(map_compressed_rows(len, [row, ['1x1', '1x2'], row]))
+    >>> results
+    [1, 2, 1]
+    '''
+    
+    results = collections.OrderedDict()
+    
+    for row in rows:
+        seen = results.pop(id(row), None)
+        if seen is None:
+            seen = [row, func(row)]
+        results[id(row)] = seen
+        if len(results) > window:
+            results.popitem(last=False)
+        yield seen[1]
+
+
+
+class Image:
+    ''' A grayscale image stored as one contiguous buffer of bytes.
+    Pixel (r, c) lives at data[r * stride + c], so every row is a
+    contiguous slice of data and can be viewed without copying.
+    An Image can be indexed like a nested list: img[r] is a zero-copy
+    memoryview of row r and img[r][c] is an int.
+    
+    >>> img = Image.from_matrix([[0, 100, 150], [200, 200, 200]])
+    >>> img.width, img.height
+    (3, 2)
+    >>> img[1][0]
+    200
+    >>> img.to_matrix()
+    [[0, 100, 150], [200, 200, 200]]
+    >>> img == [[0, 100, 150], [200, 200, 200]]
+    True
+    '''
+    
+    __slots__ = ('width', 'height', 'stride', 'data')
+    
+    def __init__(self, width, height, data=None, stride=None):
+        ''' (Image, int, int, bytes-like, int) -> NoneType
+        Creates a width x height image over data. If data is None,
+        a zero filled buffer is allocated. stride defaults to width.
+        
+        >>> Image(2, 2).to_matrix()
+        [[0, 0], [0, 0]]
+        
+        >>> Image(2, 2, bytearray(3))
+        Traceback (most recent call last):
+        AssertionError: The buffer is too small for the given dimensions.
+        '''
+        
+        if stride is None:
+            stride = width
+        if data is None:
+            data = bytearray(stride * height)
+        
+        if height > 0 and len(data) < (height - 1) * stride + width:
+            raise AssertionError('The buffer is too small for the given dimensions.')
+        
+        self.width = width
+        self.height = height
+        self.stride = stride
+        self.data = data
+    
+    @classmethod
+    def from_matrix(cls, img_matrix):
+        ''' (list<list>) -> Image
+        Returns a new Image holding the pixels of img_matrix.
+        
+        >>> Image.from_matrix([['3', '2'], ['4', '5']]).to_matrix()
+        [[3, 2], [4, 5]]
+        '''
+        
+        if isinstance(img_matrix, Image):
+            return img_matrix
+        
+        num_row = len(img_matrix)
+        num_col = len(img_matrix[0])
+        data = bytearray()
+        
+        for r in range(num_row):
+            try:
+                data += bytes(img_matrix[r])
+            except TypeError:
+                data += bytes(map(int, img_matrix[r]))
+        
+        return cls(num_col, num_row, data)
+    
+    def to_matrix(self):
+        ''' (Image) -> list<list<int>>
+        Returns the pixels of the image as a nested list.
+        
+        >>> Image(3, 1, b'\\x01\\x02\\x03').to_matrix()
+        [[1, 2, 3]]
+        '''
+        
+        return [list(self.row(r)) for r in range(self.height)]
+    
+    def row(self, r):
+        ''' (Image, int) -> memoryview
+        Returns a zero-copy view of row r.
+        
+        >>> img = Image(3, 2, bytearray(b'abcdef'))
+        >>> bytes(img.row(1))
+        b'def'
+        '''
+        
+        start = r * self.stride
+        return memoryview(self.data)[start:start + self.width]
+    
+    def rows(self):
+        ''' (Image) -> iterator<memoryview>
+        Yields a zero-copy view of each row, from top to bottom.
+        '''
+        
+        for r in range(self.height):
+            yield self.row(r)
+    
+    def tobytes(self):
+        ''' (Image) -> bytes
+        Returns the pixels as width * height packed bytes.
+        
+        >>> Image(2, 2, b'abcdef', 3).tobytes()
+        b'abde'
+        '''
+        
+        if self.stride == self.width:
+            return bytes(memoryview(self.data)[:self.width * self.height])
+        return b''.join(self.rows())
+    
+    def copy(self):
+        ''' (Image) -> Image
+        Returns a compact copy of the image that owns its buffer.
+        '''
+        
+        return Image(self.width, self.height, bytearray(self.tobytes()))
+    
+    def __len__(self):
+        return self.height
+    
+    def __getitem__(self, r):
+        if r < 0:
+            r += self.height
+        if not(0 <= r < self.height):
+            raise IndexError('Image row index out of range.')
+        return self.row(r)
+    
+    def __iter__(self):
+        return self.rows()
+    
+    def __eq__(self, other):
+        if isinstance(other, Image):
+            return (self.width, self.height) == (other.width, other.height) and self.tobytes() == other.tobytes()
+        if isinstance(other, list):
+            return self.to_matrix() == other
+        return NotImplemented
+    
+    __hash__ = None
+    
+    def __reduce__(self):
+        # pickle only the pixels, so Images can be sent to other processes
+        # even when data is a memoryview of a file
+        return (Image, (self.width, self.height, self.tobytes()))
+    
+    def __repr__(self):
+        return 'Image(' + str(self.width) + ', ' + str(self.height) + ')'
+
+
+class ImageView(Image):
+    ''' A flipped and/or cropped view of an Image that shares its pixels.
+    Pixel (r, c) of the view is pixel (y, x) of source, where y is top + r
+    (counted from the bottom of the window if flip_v) and x is left + c
+    (counted from the right if flip_h), as in compile_steps.
+    Flipping or cropping a view makes another view in constant time. The
+    pixels are only gathered into a buffer (once) when something needs
+    data or stride; rows can be read, and the view saved, without that.
+    fused_transform runs its steps straight from the source.
+    
+    >>> img = Image.from_matrix([[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+    >>> view = crop(flip_horizontal(img, lazy=True), 0, 0, 2, 2, lazy=True)
+    >>> view
+    ImageView(2, 2)
+    >>> view.to_matrix()
+    [[3, 2], [6, 5]]
+    >>> flip_vertical(view, lazy=True).to_matrix()
+    [[6, 5], [3, 2]]
+    >>> invert(view).to_matrix()
+    [[252, 253], [249, 250]]
+    '''
+    
+    __slots__ = ('source', 'top', 'left', 'flip_h', 'flip_v', 'image')
+    
+    def __init__(self, source, top=0, left=0, height=None, width=None, flip_h=False, flip_v=False):
+        ''' (ImageView, Image, int, int, int, int, bool, bool) -> NoneType
+        Creates a view of the height x width window of source whose top
+        left corner is (top, left), flipped as flip_h and flip_v say.
+        height and width default to the rest of source.
+        '''
+        
+        self.source = source
+        self.top = top
+        self.left = left
+        self.height = source.height - top if height is None else height
+        self.width = source.width - left if width is None else width
+        self.flip_h = flip_h
+        self.flip_v = flip_v
+        self.image = None
+    
+    @property
+    def data(self):
+        return self.materialize().data
+    
+    @property
+    def stride(self):
+        return self.materialize().stride
+    
+    def steps(self):
+        ''' (ImageView) -> list<list>
+        Returns the steps that make the view from source.
+        
+        >>> ImageView(Image(4, 4), 1, 0, 2, 3, True, False).steps()
+        [['CR', 1, 0, 2, 3], ['FH']]
+        '''
+        
+        steps = [['CR', self.top, self.left, self.height, self.width]]
+        
+        if self.flip_h:
+            steps.append(['FH'])
+        
+        if self.flip_v:
+            steps.append(['FV'])
+        
+        return steps
+    
+    def transformed(self, step):
+        ''' (ImageView, list) -> ImageView
+        Returns a new view of source: this view after step, which is an FH,
+        FV, ROT or CR step as in a plan from parse_command.
+        '''
+        
+        top, left, height, width = self.top, self.left, self.height, self.width
+        flip_h = self.flip_h != (step[0] in ['FH', 'ROT'])
+        flip_v = self.flip_v != (step[0] in ['FV', 'ROT'])
+        
+        if step[0] == 'CR':
+            row, col, height, width = step[1:]
+            top += self.height - row - height if self.flip_v else row
+            left += self.width - col - width if self.flip_h else col
+        
+        return ImageView(self.source, top, left, height, width, flip_h, flip_v)
+    
+    def materialize(self):
+        ''' (ImageView) -> Image
+        Returns the pixels of the view as a new Image, gathering them the
+        first time it is called.
+        '''
+        
+        if self.image is None:
+            self.image = fused_transform(self.source, self.steps())
+        
+        return self.image
+    
+    def row(self, r):
+        ''' (ImageView, int) -> memoryview
+        Returns a view of row r. Unless the view is flipped horizontally,
+        it shares the source's pixels.
+        '''
+        
+        if self.image is not None:
+            return self.image.row(r)
+        
+        if self.flip_v:
+            r = self.height - 1 - r
+        
+        row = self.source.row(self.top + r)[self.left:self.left + self.width]
+        
+        if self.flip_h:
+            return memoryview(row.tobytes()[::-1])
+        
+        return row
+    
+    def tobytes(self):
+        if self.image is not None:
+            return self.image.tobytes()
+        return b''.join(self.rows())
+    
+    def copy(self):
+        return self.materialize().copy()
+    
+    def __repr__(self):
+        return 'ImageView(' + str(self.width) + ', ' + str(self.height) + ')'
+
+
+def image_view(img_matrix):
+    ''' (<list<list>> or Image) -> ImageView
+    Returns img_matrix if it is an ImageView, otherwise a view of all of it.
+    '''
+    
+    if isinstance(img_matrix, ImageView):
+        return img_matrix
+    
+    return ImageView(Image.from_matrix(img_matrix))
+
 
 def is_valid_image(img_matrix):
     ''' (list<list>) -> bool
@@ -34,8 +579,18 @@ def is_valid_image(img_matrix):
     
     >>> is_valid_image([[True, 2, 1], [1, 4, 6], [9, 2, 4]])
     False
+    
+    >>> is_valid_image(Image(3, 2))
+    True
     '''
     
+    # every byte of an Image buffer is already between 0 and 255
+    if isinstance(img_matrix, Image):
+        if STRICT_VALIDATION:
+            end = (img_matrix.height - 1) * img_matrix.stride + img_matrix.width
+            return img_matrix.height == 0 or len(img_matrix.data) >= end
+        return True
+    
     num_row = len(img_matrix)
     length = len(img_matrix[0])
     
@@ -64,10 +619,15 @@ def is_valid_compressed_image(img_matrix):
     Returns True if img_matrix contains strings in the form 'AxB',
     A is an integer between 0 and 255, B is a natural number, and
     the sum of all B values in one row is the same in each row.
+    A string 'A,A,...' of two or more values is a literal span, one pixel
+    per value.
     
     >>> is_valid_compressed_image([['0x5', '200x2'], ['111x7']])
     True
     
+    >>> is_valid_compressed_image([['0x5', '3,9'], ['111x7']])
+    True
+    
     >>> is_valid_compressed_image([['5x7', '9x3'], ['5x10'], ['4x6', '8x4']])
     True
     
@@ -100,37 +660,104 @@ def is_valid_compressed_image(img_matrix):
     
     >>> is_valid_compressed_image([['x', 'x2'], ['111x7']])
     False
+    
+    >>> is_valid_compressed_image(CompressedMatrix([['0x5', '200x2'], ['111x7']]))
+    True
     '''
     
-    num_row = len(img_matrix)
-    b_sum_list = []
+    if isinstance(img_matrix, CompressedMatrix) and not(STRICT_VALIDATION):
+        return True
     
-    for r in range(num_row):
-        num_col = len(img_matrix[r])
-        b_sum = 0
-        for c in range(num_col):
-            elem = img_matrix[r][c]
-            
-            if type(elem) != str or elem.count('x') != 1:
-                return False
-            
-            elem = elem.split('x')
-            a = elem[0]
-            b = elem[1]
-            
-            if not(a.isdecimal() and b.isdecimal()):
-                return False
-            
-            b_sum += int(b)
+    try:
+        check_compressed_image(img_matrix)
+    except AssertionError:
+        return False
+    
+    return True
+
+
+def check_compressed_image(img_matrix, num_col=None, message='Input matrix must be in compressed PGM image format.'):
+    ''' (list<list>, int, str) -> int
+    Checks that img_matrix is a compressed image (see
+    is_valid_compressed_image) and returns its number of columns. Every row
+    must be num_col pixels wide, or as wide as the first row if num_col is
+    None. This is a single pass over img_matrix that parses each run once.
+    Otherwise an AssertionError with message is raised whose row and col
+    attributes give the first invalid row and run; col is None if the row's
+    runs are valid but it has the wrong width (see image_format_error).
+    
+    >>> check_compressed_image([['0x5', '200x2'], ['111x7']])
+    7
+    
+    >>> try:
+    ...     check_compressed_image([['0x5', '200x2'], ['111x7', '3x0']])
+    ... except AssertionError as err:
+    ...     print(err, err.row, err.col)
+    Input matrix must be in compressed PGM image format. 1 1
+    
+    >>> try:
+    ...     check_compressed_image([['0x5', '200x2'], ['111x6']], 7)
+    ... except AssertionError as err:
+    ...     print(err, err.row, err.col)
+    Input matrix must be in compressed PGM image format. 1 None
+    '''
+    
+    # run lengths of the runs already checked, as most runs repeat
+    lengths = {}
+    
+    # widths of the rows already checked, as rows may be shared
+    widths = {}
+    
+    for r, row in enumerate(img_matrix):
+        if id(row) in widths:
+            b_sum = widths[id(row)]
+        else:
+            b_sum = check_compressed_row(row, r, lengths, message)
+            widths[id(row)] = b_sum
         
-            if not (0 <= int(a) <= 255 and 0 < int(b)):
-                return False
+        if num_col is None:
+            num_col = b_sum
+        elif b_sum != num_col:
+            raise image_format_error(message, r)
+    
+    if num_col is None:
+        return 0
+    
+    return num_col
+
+
+def check_compressed_row(row, r, lengths, message):
+    ''' (list<str>, int, dict, str) -> int
+    Checks the runs of row r for check_compressed_image and returns the
+    width of the row. lengths holds the lengths of the runs already checked.
+    '''
+    
+    b_sum = 0
+    
+    for c, elem in enumerate(row):
+        if type(elem) != str:
+            raise image_format_error(message, r, c)
         
-        # checks if the sum of b values in each row are the same
-        b_sum_list.append(b_sum)
-        valid_sum = b_sum_list.count(b_sum_list[0]) == len(b_sum_list)
+        b = lengths.get(elem)
+        
+        if b is None:
+            if ',' in elem:
+                b = 0
+                for a in elem.split(','):
+                    if not(a.isdecimal()) or int(a) > 255:
+                        raise image_format_error(message, r, c)
+                    b += 1
+            else:
+                a, x, b = elem.partition('x')
+                # b holds any second 'x', so it is only decimal for 'AxB'
+                if not(a.isdecimal() and b.isdecimal()) or int(a) > 255 or int(b) == 0:
+                    raise image_format_error(message, r, c)
+                b = int(b)
+            lengths[elem] = b
+        
+        b_sum += b
     
-    return valid_sum
+    return b_sum
 
 
 def read_image(fobj):
@@ -199,9 +826,91 @@ def is_valid_details(img_matrix, img_type):
     return valid_type and valid_max_value
 
 
-def load_regular_image(filename):
-    ''' (str) -> list<list<int>>
-    Opens filename and returns as an image matrix.
+def image_format_error(message, row=None, col=None):
+    ''' (str, int, int) -> AssertionError
+    Returns an AssertionError with message. Its row and col attributes
+    hold the position of the first invalid pixel, or None if the problem is
+    not with a single pixel (for example, a bad header).
+    
+    >>> err = image_format_error('Input must be in PGM image format.', 2, 5)
+    >>> err.row, err.col
+    (2, 5)
+    '''
+    
+    err = AssertionError(message)
+    err.row = row
+    err.col = col
+    
+    return err
+
+
+def parse_regular_image(text):
+    ''' (str) -> Image
+    Returns the PGM image held in text as an Image. The header, the
+    dimensions and every pixel are checked while the pixels are converted,
+    in a single pass over the text.
+    If text is not in PGM format, an AssertionError is raised whose row
+    and col attributes give the first invalid pixel (see image_format_error).
+    
+    >>> parse_regular_image('P2\\n3 2\\n255\\n0 1 2\\n3 4 5\\n').to_matrix()
+    [[0, 1, 2], [3, 4, 5]]
+    
+    >>> parse_regular_image('P2\\n3 2\\n255\\n')
+    Traceback (most recent call last):
+    AssertionError: Input must not be empty.
+    
+    >>> try:
+    ...     parse_regular_image('P2\\n3 2\\n255\\n0 1 2\\n3 256 5\\n')
+    ... except AssertionError as err:
+    ...     print(err, err.row, err.col)
+    Input must be in PGM image format. 1 1
+    '''
+    
+    message = 'Input must be in PGM image format.'
+    lines = text.splitlines()
+    
+    if len(lines) <= 3:
+        raise AssertionError('Input must not be empty.')
+    
+    magic = lines[0].split()
+    size = lines[1].split()
+    max_value = lines[2].split()
+    
+    if magic[:1] != ['P2'] or max_value[:1] != ['255']:
+        raise image_format_error(message)
+    
+    if len(size) < 2 or not(size[0].isdecimal() and size[1].isdecimal()):
+        raise image_format_error(message)
+    
+    num_col = int(size[0])
+    num_row = int(size[1])
+    
+    if num_row != len(lines) - 3:
+        raise image_format_error(message)
+    
+    data = bytearray()
+    
+    for r in range(num_row):
+        row = lines[r + 3].split()
+        
+        try:
+            if len(row) != num_col or not(''.join(row).isdecimal()):
+                raise ValueError
+            data += bytes(map(int, row))
+        except ValueError:
+            # find the first pixel that is missing or not between 0 and 255
+            for c in range(num_col):
+                if c >= len(row) or not(row[c].isdecimal()) or int(row[c]) > 255:
+                    raise image_format_error(message, r, c)
+            raise image_format_error(message, r, num_col)
+    
+    return Image(num_col, num_row, data)
+
+
+def load_regular_image(filename, as_image=False):
+    ''' (str, bool) -> list<list<int>> or Image
+    Opens filename and returns as an image matrix, or as an Image if
+    as_image is True. The file is read and parsed by parse_regular_image.
     If, during or after loading, the image matrix is not in PGM format,
     an AssertionError is raised.
     
@@ -250,33 +959,19 @@ def load_regular_image(filename):
     >>> load_regular_image('empty2.pgm')
     Traceback (most recent call last):
     AssertionError: Input must not be empty.
+    
+    >>> load_regular_image('comp3.pgm', as_image=True)
+    Image(9, 4)
     '''
     
     fobj = open(filename, 'r')
-    img_matrix = read_image(fobj)
+    img = parse_regular_image(fobj.read())
     fobj.close()
     
-    if len(img_matrix) <= 3:
-        raise AssertionError('Input must not be empty.')
-    
-    valid_image = is_valid_details(img_matrix, 'reg') and is_valid_image(img_matrix[3:])
-    
-    if not(valid_image):
-        raise AssertionError('Input must be in PGM image format.')
-    
-    num_row = int(img_matrix[1][1])
-    num_col = int(img_matrix[1][0])
-    valid_num_row = num_row == len(img_matrix) - 3
-    valid_num_col = num_col == len(img_matrix[3])
-    
-    if not(valid_num_row and valid_num_col):
-        raise AssertionError('Input must be in PGM image format.')
-    
-    for r in range(3, num_row + 3):
-        for c in range(num_col):
-            img_matrix[r][c] = int(img_matrix[r][c])
+    if as_image:
+        return img
     
-    return img_matrix[3:]
+    return img.to_matrix()
 
 
 def load_compressed_image(filename):
@@ -326,515 +1021,3500 @@ def load_compressed_image(filename):
     '''
     
     fobj = open(filename, 'r')
-    img_matrix = read_image(fobj)
+    text = fobj.read()
     fobj.close()
     
+    return parse_compressed_image(text)
+
+
+def parse_compressed_image(text):
+    ''' (str) -> list<list<str>>
+    Returns the compressed PGM image held in text as a compressed image matrix.
+    If text is not in compressed PGM format, an AssertionError is raised.
+    
+    >>> parse_compressed_image('P2C\\n7 2\\n255\\n0x5 200x2\\n111x7\\n')
+    [['0x5', '200x2'], ['111x7']]
+    
+    A row '=d' is the same as the row d rows before it, and is loaded as
+    that same list:
+    
+    >>> comp_img_matrix = parse_compressed_image('P2C\\n7 3\\n255\\n0x5 200x2\\n111x7\\n=2\\n')
+    >>> comp_img_matrix
+    [['0x5', '200x2'], ['111x7'], ['0x5', '200x2']]
+    >>> comp_img_matrix[2] is comp_img_matrix[0]
+    True
+    '''
+    
+    img_matrix = [line.split() for line in text.splitlines()]
+    
     if len(img_matrix) <= 3:
         raise AssertionError('Input must not be empty.')
     
-    valid_image = is_valid_details(img_matrix, 'comp') and is_valid_compressed_image(img_matrix[3:])
+    message = 'Input must be in a valid compressed PGM image format.'
     
-    if not(valid_image):
-        raise AssertionError('Input must be in a valid compressed PGM image format.')
+    if not(is_valid_details(img_matrix, 'comp')) or len(img_matrix[1]) != 2 or not(''.join(img_matrix[1]).isdecimal()):
+        raise image_format_error(message)
     
     num_row = int(img_matrix[1][1])
     num_col = int(img_matrix[1][0])
-    valid_num_row = num_row == len(img_matrix) - 3
-    b_sum = 0
-    
-    for c in range(len(img_matrix[3])):
-        elem = img_matrix[3][c].split('x')
-        b = elem[1]
-        b_sum += int(b)
-    
-    valid_num_col = num_col == b_sum
+    rows = img_matrix[3:]
+    shared = False
+    
+    for r in range(len(rows)):
+        d = row_reference(rows[r])
+        if d > min(r, ROW_REF_WINDOW):
+            raise image_format_error(message, r, 0)
+        if d > 0:
+            rows[r] = rows[r - d]
+            shared = True
+    
+    try:
+        check_compressed_image(rows, num_col, message)
+    except AssertionError as err:
+        if err.row != 0 or err.col is not None:
+            raise
+        # a bad run anywhere takes precedence over a wrong header width
+        check_compressed_image(rows, None, message)
+        raise AssertionError('The number of rows and columns of image matrix\'s contents must match the number of rows and columns specified in the second line of the file.')
     
-    if not(valid_num_row and valid_num_col):
+    if num_row != len(rows):
         raise AssertionError('The number of rows and columns of image matrix\'s contents must match the number of rows and columns specified in the second line of the file.')
     
-    return img_matrix[3:]
+    if shared:
+        return DedupMatrix(rows)
+    
+    return CompressedMatrix(rows)
 
 
-def load_image(filename):
-    ''' (str) -> list<list>
-    If file is a compressed PGM image, calls load_compressed_image(filename)
-    and returns a compressed PGM image matrix.
-    If file is a PGM image, calls load_regular_image(filename)
-    and returns a PGM image matrix.
+def read_binary_header(buf, magic):
+    ''' (bytes-like, bytes) -> list<int>
+    Parses the header of a binary PGM file held in buf.
+    Returns [width, height, maxval, offset] where offset is the index
+    of the first byte after the header.
+    If buf does not start with magic followed by three integers,
+    an AssertionError is raised. Comment lines starting with '#' are skipped.
     
-    >>> load_image('comp.pgm.compressed')
-    [['0x24'], ['0x1', '51x5', '0x1', '119x5', '0x1', '187x5', '0x1', '255x4', '0x1'], ['0x1', '51x1', '0x5', '119x1', '0x3', '119x1', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x1', '0x2', '255x1', '0x1'], ['0x1', '51x1', '0x5', '119x1', '0x3', '119x1', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x4', '0x1'], ['0x1', '51x1', '0x5', '119x1', '0x3', '119x1', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x1', '0x4'], ['0x1', '51x5', '0x1', '119x5', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x1', '0x4'], ['0x24']]
+    >>> read_binary_header(b'P5\\n3 2\\n255\\nabcdef', b'P5')
+    [3, 2, 255, 11]
     
-    >>> load_image('comp.pgm')
-    [[0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0], [0, 51, 51, 51, 51, 51, 0, 119, 119, 119, 119, 119, 0, 187, 187, 187, 187, 187, 0, 255, 255, 255, 255, 0], [0, 51, 0, 0, 0, 0, 0, 119, 0, 0, 0, 119, 0, 187, 0, 187, 0, 187, 0, 255, 0, 0, 255, 0], [0, 51, 0, 0, 0, 0, 0, 119, 0, 0, 0, 119, 0, 187, 0, 187, 0, 187, 0, 255, 255, 255, 255, 0], [0, 51, 0, 0, 0, 0, 0, 119, 0, 0, 0, 119, 0, 187, 0, 187, 0, 187, 0, 255, 0, 0, 0, 0], [0, 51, 51, 51, 51, 51, 0, 119, 119, 119, 119, 119, 0, 187, 0, 187, 0, 187, 0, 255, 0, 0, 0, 0], [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]]
-
-    >>> load_image('test2.txt')
-    [['0x5', '200x2'], ['111x7']]
-
-    >>> load_image('invalid.pgm.compressed')
-    Traceback (most recent call last):
-    AssertionError: Input must be in a valid compressed PGM image format.
+    >>> read_binary_header(b'P5 # made by hand\\n3 2 255 abcdef', b'P5')
+    [3, 2, 255, 26]
     
-    >>> load_image('invalid.pgm')
+    >>> read_binary_header(b'P2\\n3 2\\n255\\n', b'P5')
     Traceback (most recent call last):
     AssertionError: Input must be in PGM image format.
     '''
     
-    fobj = open(filename, 'r')
-    file_type = read_image(fobj)
-    file_type = file_type[0][0]
+    if bytes(buf[:len(magic)]) != magic or not(bytes(buf[len(magic):len(magic) + 1]).isspace()):
+        raise AssertionError('Input must be in PGM image format.')
     
-    if file_type == 'P2C':
-        img = load_compressed_image(filename)
-    elif file_type == 'P2':
-        img = load_regular_image(filename)
-    else:
+    fields = []
+    i = len(magic)
+    end = len(buf)
+    
+    while len(fields) < 3:
+        # skip whitespace and comments between fields
+        while i < end and (buf[i] in b' \t\r\n' or buf[i] == ord('#')):
+            if buf[i] == ord('#'):
+                while i < end and buf[i] != ord('\n'):
+                    i += 1
+            i += 1
+        start = i
+        while i < end and ord('0') <= buf[i] <= ord('9'):
+            i += 1
+        if start == i:
+            raise AssertionError('Input must be in PGM image format.')
+        fields.append(int(bytes(buf[start:i])))
+    
+    # exactly one whitespace byte separates the header from the pixels
+    if i >= end or buf[i] not in b' \t\r\n':
+        raise AssertionError('Input must be in PGM image format.')
+    
+    return fields + [i + 1]
+
+
+def load_binary_image(filename):
+    ''' (str) -> Image
+    Memory-maps filename, a binary PGM ('P5') image with a maxval of 255,
+    and returns an Image whose buffer is a zero-copy view of the pixel
+    bytes in the file. The file stays mapped while the Image is alive.
+    If the file is not in binary PGM format, an AssertionError is raised.
+    
+    >>> save_binary_image([[0, 51, 255], [7, 8, 9]], 'test.p5.pgm')
+    >>> load_binary_image('test.p5.pgm').to_matrix()
+    [[0, 51, 255], [7, 8, 9]]
+    
+    >>> save_regular_image([[0, 51, 255], [7, 8, 9]], 'test.pgm')
+    >>> load_binary_image('test.pgm')
+    Traceback (most recent call last):
+    AssertionError: Input must be in PGM image format.
+    '''
+    
+    fobj = open(filename, 'rb')
+    try:
+        buf = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        raise AssertionError('Input must not be empty.')
+    finally:
+        fobj.close()
+    
+    return parse_binary_image(buf)
+
+
+def parse_binary_image(buf):
+    ''' (bytes-like) -> Image
+    Returns the binary PGM ('P5') image held in buf as an Image whose
+    buffer is a zero-copy view of the pixel bytes in buf.
+    If buf is not in binary PGM format, an AssertionError is raised.
+    
+    >>> parse_binary_image(b'P5\\n2 1\\n255\\n\\x07\\x08').to_matrix()
+    [[7, 8]]
+    '''
+    
+    num_col, num_row, max_value, offset = read_binary_header(buf, b'P5')
+    
+    if max_value != 255 or len(buf) - offset < num_col * num_row:
+        raise AssertionError('Input must be in PGM image format.')
+    
+    data = memoryview(buf)[offset:offset + num_col * num_row]
+    
+    return Image(num_col, num_row, data)
+
+
+RUN_PREFIX = [str(a) + 'x' for a in range(256)]
+
+# The text of each pixel value in a literal span 'A,A,...'.
+LITERAL_TOKEN = [str(a) for a in range(256)]
+
+# Bytes read or written at a time by aload_image, asave_image and the writers.
+IO_CHUNK_SIZE = 1024 * 1024
+
+# The text of each pixel value, as written in a PGM ('P2') file.
+PIXEL_TEXT = [str(a).encode('ascii') for a in range(256)]
+
+# Matches one run of equal bytes, so a single scan of a row finds every run.
+RUN_PATTERN = re.compile(rb'(.)\1*', re.DOTALL)
+
+# Runs up to this many pixels long are remembered by RunTokens.
+RUN_TOKEN_CACHE_LENGTH = 32
+
+
+class RunTokens(dict):
+    ''' Maps a run of equal bytes to its 'AxB' token. Short runs are
+    remembered, so the token for a common run is only built once.
+    
+    >>> tokens = RunTokens()
+    >>> tokens[b'\x05\x05\x05']
+    '5x3'
+    '''
+    
+    __slots__ = ()
+    
+    def __missing__(self, run):
+        token = RUN_PREFIX[run[0]] + str(len(run))
+        if len(run) <= RUN_TOKEN_CACHE_LENGTH:
+            self[run] = token
+        return token
+
+
+def encode_row(row, tokens=None):
+    ''' (bytes or memoryview, RunTokens) -> list<str>
+    Returns the 'AxB' tokens of row. All run boundaries are found in one
+    regular expression scan; tokens may be shared between rows.
+    
+    >>> encode_row(bytes([1, 5, 5, 5, 7]))
+    ['1x1', '5x3', '7x1']
+    '''
+    
+    if tokens is None:
+        tokens = RunTokens()
+    
+    return list(map(tokens.__getitem__, map(re.Match.group, RUN_PATTERN.finditer(row))))
+
+
+def literal_spans(comp_row):
+    ''' (list<str>) -> list<str>
+    Returns comp_row with each stretch of two or more single pixel runs
+    ('Ax1') joined into one literal span 'A,A,...', which takes no more
+    text than the pixels themselves. Other runs are kept as they are.
+    
+    >>> literal_spans(['0x5', '1x1', '2x1', '3x1', '4x2', '7x1'])
+    ['0x5', '1,2,3', '4x2', '7x1']
+    '''
+    
+    new_row = []
+    num_runs = len(comp_row)
+    k = 0
+    
+    while k < num_runs:
+        end = k
+        while end < num_runs and comp_row[end].endswith('x1'):
+            end += 1
+        if end - k >= 2:
+            new_row.append(','.join([elem[:-2] for elem in comp_row[k:end]]))
+            k = end
+        else:
+            new_row.append(comp_row[k])
+            k += 1
+    
+    return new_row
+
+
+def write_varint(num, out):
+    ''' (int, bytearray) -> NoneType
+    Appends the natural number num to out as a little endian base 128
+    varint: 7 bits per byte, with the high bit set on all but the last byte.
+    
+    >>> out = bytearray()
+    >>> write_varint(5, out)
+    >>> write_varint(300, out)
+    >>> out
+    bytearray(b'\\x05\\xac\\x02')
+    '''
+    
+    while num > 127:
+        out.append(num & 127 | 128)
+        num >>= 7
+    out.append(num)
+
+
+def read_varint(buf, i):
+    ''' (bytes-like, int) -> (int, int)
+    Reads the varint starting at index i of buf.
+    Returns the number and the index of the byte after it.
+    
+    >>> read_varint(b'\\x05\\xac\\x02', 1)
+    (300, 3)
+    
+    >>> read_varint(b'\\xac', 0)
+    Traceback (most recent call last):
+    AssertionError: Input must be in a valid compressed PGM image format.
+    '''
+    
+    num = 0
+    shift = 0
+    
+    while True:
+        if i >= len(buf):
+            raise AssertionError('Input must be in a valid compressed PGM image format.')
+        byte = buf[i]
+        i += 1
+        num |= (byte & 127) << shift
+        if byte < 128:
+            return num, i
+        shift += 7
+
+
+def row_runs(row):
+    ''' (list<int> or memoryview) -> list<list<int>>
+    Returns the runs of equal consecutive values in row as [value, length] pairs.
+    
+    >>> row_runs([1, 5, 5, 5, 7])
+    [[1, 1], [5, 3], [7, 1]]
+    '''
+    
+    if not(isinstance(row, list)):
+        return [[run[0], len(run)] for run in map(re.Match.group, RUN_PATTERN.finditer(row))]
+    
+    num_col = len(row)
+    runs = []
+    c = 0
+    
+    while c < num_col:
+        target_num = row[c]
+        last_occur = find_end_of_repetition(row, c, target_num)
+        num_occur = last_occur - c + 1
+        runs.append([target_num, num_occur])
+        c += num_occur
+    
+    return runs
+
+
+def image_runs(img):
+    ''' (Image) -> list<list>
+    Returns the runs of each row of img, as row_runs does for one row.
+    With the numpy backend, all run boundaries are found at once.
+    
+    >>> image_runs(Image.from_matrix([[1, 5, 5], [7, 7, 7]]))
+    [[[1, 1], [5, 2]], [[7, 3]]]
+    '''
+    
+    if BACKEND != 'numpy' or img.height == 0 or img.width == 0:
+        return [row_runs(row) for row in img.rows()]
+    
+    arr = image_to_array(img)
+    starts = numpy.ones(arr.shape, bool)
+    starts[:, 1:] = arr[:, 1:] != arr[:, :-1]
+    starts = numpy.flatnonzero(starts)
+    lengths = numpy.diff(numpy.append(starts, arr.size))
+    values = arr.reshape(-1)[starts]
+    bounds = numpy.searchsorted(starts, numpy.arange(img.height + 1) * img.width).tolist()
+    
+    runs = [list(pair) for pair in zip(values.tolist(), lengths.tolist())]
+    
+    return [runs[bounds[r]:bounds[r + 1]] for r in range(img.height)]
+
+
+def pack_row(entries, out):
+    ''' (list, bytearray) -> NoneType
+    Appends the number of entries, then each entry, to out. An entry is
+    either a run [value, length], packed as a value byte followed by a
+    varint length, or bytes of literal pixels, packed as the first pixel,
+    a zero length, a varint count of the pixels after the first and then
+    those pixels. Literal spans decode to 'A,A,...' tokens.
+    
+    >>> out = bytearray()
+    >>> pack_row([[5, 3], bytes([1, 2, 3])], out)
+    >>> out
+    bytearray(b'\\x02\\x05\\x03\\x01\\x00\\x02\\x02\\x03')
+    '''
+    
+    write_varint(len(entries), out)
+    for entry in entries:
+        if type(entry) == list:
+            out.append(entry[0])
+            write_varint(entry[1], out)
+        else:
+            out.append(entry[0])
+            out.append(0)
+            write_varint(len(entry) - 1, out)
+            out += entry[1:]
+
+
+def token_entries(comp_row):
+    ''' (list<str>) -> list
+    Returns the pack_row entries of the compressed row comp_row: a run for
+    each 'AxB' token and literal pixels for each 'A,A,...' token, so that
+    unpacking gives back exactly the same tokens.
+    
+    >>> token_entries(['5x3', '1,2', '7x1'])
+    [[5, 3], b'\\x01\\x02', [7, 1]]
+    '''
+    
+    entries = []
+    
+    for elem in comp_row:
+        if ',' in elem:
+            entries.append(bytes(map(int, elem.split(','))))
+        else:
+            a, x, b = elem.partition('x')
+            entries.append([int(a), int(b)])
+    
+    return entries
+
+
+def adaptive_entries(runs):
+    ''' (list<list<int>>) -> list
+    Returns the pack_row entries that pack runs ([value, length] pairs) in
+    the fewest bytes, choosing for each run whether it is packed as a run
+    or as part of a literal span. A row of long runs comes out as runs
+    only, a noisy row as one literal span, and other rows as a mix.
+    The choice is made by dynamic programming over the runs, counting
+    each span's pixel count as one byte.
+    
+    >>> adaptive_entries([[0, 20], [1, 1], [2, 1], [3, 1], [0, 20]])
+    [[0, 20], bytearray(b'\\x01\\x02\\x03'), [0, 20]]
+    
+    >>> adaptive_entries([[0, 20], [1, 1], [0, 20]])
+    [[0, 20], [1, 1], [0, 20]]
+    '''
+    
+    # bytes of the cheapest packing of the runs so far that ends with a run
+    # entry, or inside a literal span
+    as_run = 0
+    as_span = None
+    choices = []
+    
+    for a, b in runs:
+        if as_span is None:
+            run_cost = as_run + 1 + varint_size(b)
+            choices.append([True, False])
+            as_span = as_run + b + 2
+        else:
+            run_cost = min(as_run, as_span) + 1 + varint_size(b)
+            # the span goes on, or a new one starts after a run entry
+            extend = as_span + b
+            start = as_run + b + 2
+            choices.append([as_run <= as_span, extend < start])
+            as_span = min(extend, start)
+        as_run = run_cost
+    
+    in_span = as_span is not None and as_span < as_run
+    spans = []
+    
+    for after_run, extended in reversed(choices):
+        spans.append(in_span)
+        if in_span:
+            in_span = extended
+        else:
+            in_span = not(after_run)
+    
+    spans.reverse()
+    entries = []
+    
+    for k in range(len(runs)):
+        a, b = runs[k]
+        if not(spans[k]):
+            entries.append([a, b])
+        elif k > 0 and spans[k - 1]:
+            entries[-1] += bytes([a]) * b
+        else:
+            entries.append(bytearray([a]) * b)
+    
+    return entries
+
+
+def pack_compressed_image(comp_img_matrix):
+    ''' (<list<list<str>>>) -> bytes
+    Returns comp_img_matrix in the packed compressed PGM ('P5C') format:
+    the header 'P5C', the width, the height and 255 as in a PGM file, then for
+    each row the number of entries as a varint followed by each entry as
+    pack_row writes it: a value byte and a varint length for each 'AxB'
+    run, and a literal span for each 'A,A,...' token. Shared rows are
+    written with pack_row_reference.
+    
+    >>> pack_compressed_image([['0x5', '200x2'], ['111x7']])
+    b'P5C\\n7 2\\n255\\n\\x02\\x00\\x05\\xc8\\x02\\x01o\\x07'
+    
+    >>> pack_compressed_image([[0, 1]])
+    Traceback (most recent call last):
+    AssertionError: Nested list must be a matrix in compressed PGM image format.
+    '''
+    
+    if not(is_valid_compressed_image(comp_img_matrix)):
+        raise AssertionError('Nested list must be a matrix in compressed PGM image format.')
+    
+    num_row = len(comp_img_matrix)
+    num_col = get_num_col_compressed_img(comp_img_matrix)
+    out = bytearray(('P5C\n' + str(num_col) + ' ' + str(num_row) + '\n255\n').encode('ascii'))
+    refs = RowReferences()
+    dedup = isinstance(comp_img_matrix, DedupMatrix)
+    
+    for row in comp_img_matrix:
+        d = refs.distance(row) if dedup else 0
+        if d > 0 and num_col > 0:
+            pack_row_reference(d, out)
+        else:
+            pack_row(token_entries(row), out)
+    
+    return bytes(out)
+
+
+def pack_row_reference(d, out):
+    ''' (int, bytearray) -> NoneType
+    Appends a packed back-reference to the row d rows before to out: no
+    entries, which a row of pixels can never have, then d as a varint.
+    
+    >>> out = bytearray()
+    >>> pack_row_reference(2, out)
+    >>> out
+    bytearray(b'\\x00\\x02')
+    '''
+    
+    out.append(0)
+    write_varint(d, out)
+
+
+def unpack_entry(buf, i, row):
+    ''' (bytes-like, int, list<str>) -> (int, int)
+    Reads the pack_row entry starting at index i of buf and appends its
+    token to row: 'AxB' for a run and 'A,A,...' for literal pixels.
+    Returns the number of pixels and the index of the byte after the entry.
+    
+    >>> row = []
+    >>> unpack_entry(b'\\x01\\x00\\x02\\x02\\x03', 0, row), row
+    ((3, 5), ['1,2,3'])
+    '''
+    
+    if i >= len(buf):
+        raise AssertionError('Input must be in a valid compressed PGM image format.')
+    
+    a = buf[i]
+    b, i = read_varint(buf, i + 1)
+    
+    if b > 0:
+        row.append(RUN_PREFIX[a] + str(b))
+        return b, i
+    
+    # a literal span: a is the first of its pixels
+    b, i = read_varint(buf, i)
+    
+    if i + b > len(buf):
+        raise AssertionError('Input must be in a valid compressed PGM image format.')
+    
+    if b == 0:
+        row.append(RUN_PREFIX[a] + '1')
+    else:
+        row.append(LITERAL_TOKEN[a] + ',' + ','.join(map(LITERAL_TOKEN.__getitem__, buf[i:i + b])))
+    
+    return b + 1, i + b
+
+
+def unpack_row(buf, i, num_col, rows=None):
+    ''' (bytes-like, int, int, list<list<str>>) -> (list<str>, int)
+    Reads one packed row starting at index i of buf.
+    Returns the row as 'AxB' and 'A,A,...' strings and the index of the byte after it.
+    A back-reference gives the same list as the row it refers to in rows,
+    the rows read so far.
+    An AssertionError is raised if the entries do not add up to num_col.
+    '''
+    
+    num_entries, i = read_varint(buf, i)
+    
+    if num_entries == 0 and num_col > 0:
+        d, i = read_varint(buf, i)
+        if rows is None or not(0 < d <= min(len(rows), ROW_REF_WINDOW)):
+            raise AssertionError('Input must be in a valid compressed PGM image format.')
+        return rows[-d], i
+    
+    row = []
+    b_sum = 0
+    
+    for k in range(num_entries):
+        b, i = unpack_entry(buf, i, row)
+        b_sum += b
+    
+    if b_sum != num_col:
+        raise AssertionError('The number of rows and columns of image matrix\'s contents must match the number of rows and columns specified in the second line of the file.')
+    
+    return row, i
+
+
+def unpack_compressed_image(buf):
+    ''' (bytes-like) -> <list<list<str>>>
+    Returns the compressed image matrix held in buf, in the packed
+    compressed PGM ('P5C') format. Runs are read as bytes and varints,
+    never by splitting text.
+    
+    >>> unpack_compressed_image(b'P5C\\n7 2\\n255\\n\\x02\\x00\\x05\\xc8\\x02\\x01o\\x07')
+    [['0x5', '200x2'], ['111x7']]
+    
+    >>> unpack_compressed_image(b'P5C\\n7 2\\n255\\n\\x02\\x00\\x05\\xc8\\x02\\x01o\\x06')
+    Traceback (most recent call last):
+    AssertionError: The number of rows and columns of image matrix's contents must match the number of rows and columns specified in the second line of the file.
+    '''
+    
+    num_col, num_row, max_value, i = read_binary_header(buf, b'P5C')
+    
+    if max_value != 255:
+        raise AssertionError('Input must be in a valid compressed PGM image format.')
+    
+    comp_img_matrix = CompressedMatrix()
+    shared = False
+    
+    for r in range(num_row):
+        # a row with no entries is a back-reference
+        shared = shared or (i < len(buf) and buf[i] == 0 and num_col > 0)
+        row, i = unpack_row(buf, i, num_col, comp_img_matrix)
+        comp_img_matrix.append(row)
+    
+    if i != len(buf):
+        raise AssertionError('The number of rows and columns of image matrix\'s contents must match the number of rows and columns specified in the second line of the file.')
+    
+    if shared:
+        return DedupMatrix(comp_img_matrix)
+    
+    return comp_img_matrix
+
+
+def load_packed_image(filename):
+    ''' (str) -> <list<list<str>>>
+    Opens filename, a packed compressed PGM ('P5C') image, and returns
+    it as a compressed image matrix.
+    If the file is not in packed compressed PGM format, an AssertionError is raised.
+    
+    >>> save_packed_image([['0x5', '200x2'], ['111x7']], 'test.p5c')
+    >>> load_packed_image('test.p5c')
+    [['0x5', '200x2'], ['111x7']]
+    '''
+    
+    fobj = open(filename, 'rb')
+    buf = fobj.read()
+    fobj.close()
+    
+    if not(buf):
+        raise AssertionError('Input must not be empty.')
+    
+    return unpack_compressed_image(buf)
+
+
+def save_packed_image(img_matrix, filename, index=False):
+    ''' (<list<list>> or Image, str, bool) -> NoneType
+    Saves img_matrix to filename in the packed compressed PGM ('P5C') format.
+    A regular image is compressed first.
+    If index is True, also saves a row index next to filename
+    (see save_row_index) for crop_compressed_file.
+    
+    >>> save_packed_image([[0, 0, 0, 0, 0, 200, 200], [111] * 7], 'test.p5c')
+    >>> load_image('test.p5c')
+    [['0x5', '200x2'], ['111x7']]
+    '''
+    
+    if index and (isinstance(img_matrix, Image) or type(img_matrix[0][0]) != str):
+        img_matrix = compress(img_matrix)
+    
+    if isinstance(img_matrix, Image) or type(img_matrix[0][0]) != str:
+        buf = compress(img_matrix, packed=True)
+    else:
+        buf = pack_compressed_image(img_matrix)
+    
+    write_file(filename, lambda fobj: fobj.write(buf))
+    
+    if index:
+        save_row_index(img_matrix, filename, packed=True)
+
+
+def read_image_header(filename):
+    ''' (str) -> list
+    Reads only the header of filename and returns [file_type, num_row, num_col],
+    where file_type is 'P2', 'P2C', 'P5' or 'P5C'.
+    If the header is not valid, an AssertionError is raised.
+    
+    >>> save_image([[1, 2, 3], [4, 5, 6]], 'test.pgm')
+    >>> read_image_header('test.pgm')
+    ['P2', 2, 3]
+    
+    >>> save_image([[1, 2, 3], [4, 5, 6]], 'test.p5.pgm', 'P5')
+    >>> read_image_header('test.p5.pgm')
+    ['P5', 2, 3]
+    '''
+    
+    fobj = open(filename, 'rb')
+    header = fobj.read(1024)
+    fobj.close()
+    
+    file_type = header.split(None, 1)[:1]
+    file_type = file_type[0].decode('ascii', 'replace') if file_type else ''
+    
+    if file_type in ['P5', 'P5C']:
+        num_col, num_row, max_value, offset = read_binary_header(header, file_type.encode('ascii'))
+        return [file_type, num_row, num_col]
+    
+    if file_type not in ['P2', 'P2C']:
+        raise AssertionError('File must be a PGM image or compressed PGM image.')
+    
+    size = header.split(b'\n')[1].split() if header.count(b'\n') >= 2 else []
+    
+    if len(size) != 2 or not(size[0].isdigit() and size[1].isdigit()):
+        raise AssertionError('Input must be in PGM image format.')
+    
+    return [file_type, int(size[1]), int(size[0])]
+
+
+def load_image(filename, as_image=False, cache=None):
+    ''' (str, bool, ImageCache) -> list<list> or Image
+    If file is a compressed PGM image, calls load_compressed_image(filename)
+    and returns a compressed PGM image matrix.
+    If file is a PGM image, calls load_regular_image(filename)
+    and returns a PGM image matrix, or an Image if as_image is True.
+    If file is a binary PGM image, calls load_binary_image(filename)
+    and returns a PGM image matrix, or the Image itself if as_image is True.
+    If file is a packed compressed PGM image, calls load_packed_image(filename)
+    and returns a compressed PGM image matrix.
+    If cache is an ImageCache, a file that has not changed since it was last
+    loaded is taken from cache instead of being read and parsed again.
+    
+    >>> load_image('comp.pgm.compressed')
+    [['0x24'], ['0x1', '51x5', '0x1', '119x5', '0x1', '187x5', '0x1', '255x4', '0x1'], ['0x1', '51x1', '0x5', '119x1', '0x3', '119x1', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x1', '0x2', '255x1', '0x1'], ['0x1', '51x1', '0x5', '119x1', '0x3', '119x1', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x4', '0x1'], ['0x1', '51x1', '0x5', '119x1', '0x3', '119x1', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x1', '0x4'], ['0x1', '51x5', '0x1', '119x5', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x1', '0x4'], ['0x24']]
+    
+    >>> load_image('comp.pgm')
+    [[0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0], [0, 51, 51, 51, 51, 51, 0, 119, 119, 119, 119, 119, 0, 187, 187, 187, 187, 187, 0, 255, 255, 255, 255, 0], [0, 51, 0, 0, 0, 0, 0, 119, 0, 0, 0, 119, 0, 187, 0, 187, 0, 187, 0, 255, 0, 0, 255, 0], [0, 51, 0, 0, 0, 0, 0, 119, 0, 0, 0, 119, 0, 187, 0, 187, 0, 187, 0, 255, 255, 255, 255, 0], [0, 51, 0, 0, 0, 0, 0, 119, 0, 0, 0, 119, 0, 187, 0, 187, 0, 187, 0, 255, 0, 0, 0, 0], [0, 51, 51, 51, 51, 51, 0, 119, 119, 119, 119, 119, 0, 187, 0, 187, 0, 187, 0, 255, 0, 0, 0, 0], [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]]
+
+    >>> load_image('test2.txt')
+    [['0x5', '200x2'], ['111x7']]
+
+    >>> load_image('invalid.pgm.compressed')
+    Traceback (most recent call last):
+    AssertionError: Input must be in a valid compressed PGM image format.
+    
+    >>> load_image('invalid.pgm')
+    Traceback (most recent call last):
+    AssertionError: Input must be in PGM image format.
+    
+    >>> save_image([[1, 2], [3, 4]], 'test.p5.pgm', 'P5')
+    >>> load_image('test.p5.pgm')
+    [[1, 2], [3, 4]]
+    >>> load_image('test.p5.pgm', True)
+    Image(2, 2)
+    
+    >>> cache = ImageCache()
+    >>> load_image('comp3.pgm', cache=cache) == load_image('comp3.pgm', cache=cache)
+    True
+    >>> cache.hits, cache.misses
+    (1, 1)
+    '''
+    
+    if cache is not None:
+        key = cache.key(filename)
+        img = cache.get(key)
+        if img is None:
+            img = load_image(filename, True)
+            cache.put(key, img)
+        if isinstance(img, Image) and not(as_image):
+            return img.to_matrix()
+        return img
+    
+    # only the magic number is needed to pick a loader
+    fobj = open(filename, 'rb')
+    file_type = fobj.readline().split()
+    fobj.close()
+    file_type = file_type[0] if file_type else b''
+    
+    if file_type == b'P2C':
+        img = load_compressed_image(filename)
+    elif file_type == b'P2':
+        img = load_regular_image(filename, as_image)
+    elif file_type == b'P5':
+        img = load_binary_image(filename)
+        if not(as_image):
+            img = img.to_matrix()
+    elif file_type == b'P5C':
+        img = load_packed_image(filename)
+    else:
         raise AssertionError('File must be a PGM image or compressed PGM image.')
 
     return img
 
 
-def save_regular_image(img_matrix, filename):
-    ''' (list<list>, str) -> NoneType
-    Saves nested_list to a file with filename.
-    If nested_list is not a valid PGM matrix, raises an AssertionError.
+class ImageCache:
+    ''' An in-memory cache of loaded images, for load_image.
+    Images are kept by (path, modification time, size) of the file they
+    were loaded from, so a file that changes is loaded again. When the
+    images take more than max_bytes, the least recently used are dropped.
+    hits and misses count how often an image was or was not found.
+    
+    The cached images are shared by everyone who loads the file, so they
+    are read-only: an Image's pixels are a read-only memoryview, and each
+    compressed image matrix is a new list of the (shared) cached rows,
+    which must not be changed.
+    
+    >>> cache = ImageCache(max_bytes=100)
+    >>> cache.put(['a', 0, 0], Image(10, 6))
+    >>> cache.put(['b', 0, 0], Image(10, 6))
+    >>> cache.get(['a', 0, 0]) is None, cache.get(['b', 0, 0])
+    (True, Image(10, 6))
+    >>> cache.num_bytes
+    60
+    '''
+    
+    __slots__ = ('max_bytes', 'num_bytes', 'hits', 'misses', 'images')
+    
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        ''' (ImageCache, int) -> NoneType
+        Creates an empty cache that holds images of at most max_bytes in total.
+        '''
+        
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.images = collections.OrderedDict()
+    
+    def key(self, filename):
+        ''' (ImageCache, str) -> list
+        Returns the key of the current contents of filename.
+        '''
+        
+        stat = os.stat(filename)
+        
+        return [os.path.abspath(filename), stat.st_mtime_ns, stat.st_size]
+    
+    def get(self, key):
+        ''' (ImageCache, list) -> Image or list<list<str>> or NoneType
+        Returns the image stored under key, or None if there is none.
+        '''
+        
+        entry = self.images.get(tuple(key))
+        
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        self.images.move_to_end(tuple(key))
+        self.hits += 1
+        
+        if isinstance(entry[0], Image):
+            return entry[0]
+        
+        return compressed_like(entry[0], entry[0])
+    
+    def put(self, key, img_matrix):
+        ''' (ImageCache, list, Image or list<list<str>>) -> NoneType
+        Stores img_matrix under key, dropping the least recently used images
+        until the cache fits in max_bytes. An image larger than max_bytes
+        is not stored.
+        '''
+        
+        if isinstance(img_matrix, Image):
+            img_matrix = Image(img_matrix.width, img_matrix.height, memoryview(img_matrix.data).toreadonly(), img_matrix.stride)
+            num_bytes = img_matrix.stride * img_matrix.height
+        else:
+            img_matrix = compressed_like(img_matrix, img_matrix)
+            num_bytes = sys.getsizeof(img_matrix)
+            for row in img_matrix:
+                num_bytes += sys.getsizeof(row) + sum(map(sys.getsizeof, row))
+        
+        if tuple(key) in self.images:
+            self.num_bytes -= self.images.pop(tuple(key))[1]
+        
+        if num_bytes > self.max_bytes:
+            return
+        
+        self.images[tuple(key)] = [img_matrix, num_bytes]
+        self.num_bytes += num_bytes
+        
+        while self.num_bytes > self.max_bytes:
+            old_key, old_entry = self.images.popitem(last=False)
+            self.num_bytes -= old_entry[1]
+    
+    def clear(self):
+        ''' (ImageCache) -> NoneType
+        Drops every image and resets the counters.
+        '''
+        
+        self.images.clear()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+def parse_image(buf, as_image=False):
+    ''' (bytes-like, bool) -> list<list> or Image
+    Returns the image held in buf, the whole contents of an image file,
+    as load_image would return it. The format is picked from the magic
+    number at the start of buf, so the header is only looked at once.
+    
+    >>> parse_image(b'P2C\\n7 2\\n255\\n0x5 200x2\\n111x7\\n')
+    [['0x5', '200x2'], ['111x7']]
+    
+    >>> parse_image(b'P2\\n2 1\\n255\\n7 8\\n', as_image=True)
+    Image(2, 1)
+    
+    >>> parse_image(b'GIF89a')
+    Traceback (most recent call last):
+    AssertionError: File must be a PGM image or compressed PGM image.
+    '''
+    
+    file_type = bytes(buf[:4]).split()
+    file_type = file_type[0] if file_type else b''
+    
+    if file_type == b'P2C':
+        return parse_compressed_image(bytes(buf).decode('ascii', 'replace'))
+    
+    if file_type == b'P2':
+        img = parse_regular_image(bytes(buf).decode('ascii', 'replace'))
+        if as_image:
+            return img
+        return img.to_matrix()
+    
+    if file_type == b'P5':
+        img = parse_binary_image(buf)
+        if as_image:
+            return img
+        return img.to_matrix()
+    
+    if file_type == b'P5C':
+        return unpack_compressed_image(buf)
+    
+    raise AssertionError('File must be a PGM image or compressed PGM image.')
+
+
+async def aload_image(filename, as_image=False, executor=None, chunk_size=IO_CHUNK_SIZE):
+    ''' (str, bool, Executor, int) -> list<list> or Image
+    Coroutine version of load_image for use in an asyncio event loop.
+    The file is opened, read chunk_size bytes at a time and parsed by
+    parse_image in executor (the loop's default executor if None), so
+    the event loop is never blocked and many loads can be in flight at
+    once. A ProcessPoolExecutor can be given to parse on other cores.
+    
+    >>> asyncio.run(aload_image('comp3.pgm'))
+    [[0, 0, 0, 0, 119, 0, 0, 0, 119], [0, 0, 0, 0, 119, 0, 0, 0, 119], [51, 51, 51, 0, 119, 119, 119, 119, 119], [0, 0, 0, 0, 0, 0, 0, 0, 0]]
+    
+    >>> asyncio.run(aload_image('invalid.pgm.compressed'))
+    Traceback (most recent call last):
+    AssertionError: Input must be in a valid compressed PGM image format.
+    '''
+    
+    loop = asyncio.get_running_loop()
+    fobj = await loop.run_in_executor(executor, open, filename, 'rb')
+    chunks = []
+    
+    try:
+        while True:
+            chunk = await loop.run_in_executor(executor, fobj.read, chunk_size)
+            if not(chunk):
+                break
+            chunks.append(chunk)
+    finally:
+        await loop.run_in_executor(executor, fobj.close)
+    
+    return await loop.run_in_executor(executor, parse_image, b''.join(chunks), as_image)
+
+
+def format_image(img_matrix, img_format=None):
+    ''' (<list<list>> or Image, str) -> bytes
+    Returns the contents of the file save_image(img_matrix, filename,
+    img_format) would write.
+    
+    >>> format_image([[0, 255]])
+    b'P2\\n2 1\\n255\\n0 255\\n'
+    
+    >>> format_image([[0, 255]], 'P5')
+    b'P5\\n2 1\\n255\\n\\x00\\xff'
+    
+    >>> format_image([['0x5', '200x2'], ['111x7']])
+    b'P2C\\n7 2\\n255\\n0x5 200x2\\n111x7\\n'
+    '''
+    
+    is_image = isinstance(img_matrix, Image) or type(img_matrix[0][0]) == int
+    
+    if img_format == 'P5C':
+        if is_image:
+            return compress(img_matrix, packed=True)
+        return pack_compressed_image(img_matrix)
+    
+    if img_format == 'P5' or is_image:
+        if not(is_valid_image(img_matrix)):
+            raise AssertionError('Nested list must be a matrix in PGM image format.')
+        img_matrix = Image.from_matrix(img_matrix)
+        if img_format == 'P5':
+            header = 'P5\n' + str(img_matrix.width) + ' ' + str(img_matrix.height) + '\n255\n'
+            return header.encode('ascii') + img_matrix.tobytes()
+        fobj = io.BytesIO()
+        write_regular_image(img_matrix, fobj)
+        return fobj.getvalue()
+    
+    if type(img_matrix[0][0]) != str:
+        raise AssertionError('The elements of the image matrix must either be strings or integers.')
+    
+    fobj = io.BytesIO()
+    write_compressed_image(img_matrix, fobj)
+    
+    return fobj.getvalue()
+
+
+async def asave_image(img_matrix, filename, img_format=None, executor=None, chunk_size=IO_CHUNK_SIZE):
+    ''' (<list<list>> or Image, str, str, Executor, int) -> NoneType
+    Coroutine version of save_image for use in an asyncio event loop.
+    The file contents are built by format_image in executor (the loop's
+    default executor if None) and written chunk_size bytes at a time,
+    so the event loop is never blocked.
+    
+    >>> asyncio.run(asave_image([['0x5', '200x2'], ['111x7']], 'test.pgm.compressed'))
+    >>> load_image('test.pgm.compressed')
+    [['0x5', '200x2'], ['111x7']]
+    '''
+    
+    loop = asyncio.get_running_loop()
+    buf = memoryview(await loop.run_in_executor(executor, format_image, img_matrix, img_format))
+    fobj = await loop.run_in_executor(executor, open_temp_file, filename)
+    
+    # written next to filename and renamed onto it, like write_file
+    try:
+        try:
+            for i in range(0, len(buf), chunk_size):
+                await loop.run_in_executor(executor, fobj.write, buf[i:i + chunk_size])
+        finally:
+            await loop.run_in_executor(executor, fobj.close)
+        if os.path.exists(filename):
+            os.chmod(fobj.name, os.stat(filename).st_mode & 0o7777)
+        await loop.run_in_executor(executor, os.replace, fobj.name, filename)
+    finally:
+        if os.path.exists(fobj.name):
+            os.remove(fobj.name)
+    
+    # like save_image, a row index of an older version of the file is removed
+    if os.path.exists(filename + '.idx'):
+        await loop.run_in_executor(executor, os.remove, filename + '.idx')
+
+
+def open_temp_file(filename):
+    ''' (str) -> file
+    Opens a new file for binary writing in the same directory as filename,
+    for a saver to write to before renaming it onto filename.
+    '''
+    
+    directory, name = os.path.split(filename)
+    
+    while True:
+        temp_name = os.path.join(directory, '.' + name + '.' + os.urandom(4).hex() + '.tmp')
+        try:
+            return open(temp_name, 'xb')
+        except FileExistsError:
+            continue
+
+
+def write_file(filename, write):
+    ''' (str, function) -> NoneType
+    Calls write(fobj) on a temporary file next to filename, then
+    renames it onto filename. The old file is never truncated, so an Image
+    from load_binary_image that still maps it keeps its pixels, and
+    filename is left untouched if write raises. A row index of the old
+    file (see save_row_index) is removed.
+    
+    >>> save_binary_image([[1, 2], [3, 4]], 'test.p5.pgm')
+    >>> img = load_image('test.p5.pgm', True)
+    >>> save_binary_image([[5]], 'test.p5.pgm')
+    >>> img.to_matrix(), load_image('test.p5.pgm')
+    ([[1, 2], [3, 4]], [[5]])
+    '''
+    
+    fobj = open_temp_file(filename)
+    
+    try:
+        try:
+            write(fobj)
+        finally:
+            fobj.close()
+        if os.path.exists(filename):
+            os.chmod(fobj.name, os.stat(filename).st_mode & 0o7777)
+        if os.path.exists(filename + '.idx'):
+            os.remove(filename + '.idx')
+        os.replace(fobj.name, filename)
+    finally:
+        if os.path.exists(fobj.name):
+            os.remove(fobj.name)
+
+
+def write_regular_image(img_matrix, fobj, buffer_size=IO_CHUNK_SIZE):
+    ''' (list<list> or Image, file, int) -> NoneType
+    Writes img_matrix as a PGM ('P2') image to fobj, which can be any file
+    object opened for binary writing, such as a file, pipe or socket file.
+    Rows are written as they are formatted, buffer_size bytes at a time,
+    so the whole text of the image is never held in memory.
+    img_matrix is not changed.
+    If img_matrix is not a valid PGM matrix, raises an AssertionError.
+    
+    >>> fobj = io.BytesIO()
+    >>> write_regular_image([[0, 1], [2, 255]], fobj)
+    >>> fobj.getvalue()
+    b'P2\\n2 2\\n255\\n0 1\\n2 255\\n'
+    '''
+    
+    if not(is_valid_image(img_matrix)):
+        raise AssertionError('Nested list must be a matrix in PGM image format.')
+    
+    img_matrix = Image.from_matrix(img_matrix)
+    header = 'P2\n' + str(img_matrix.width) + ' ' + str(img_matrix.height) + '\n255\n'
+    parts = [header.encode('ascii')]
+    num_bytes = 0
+    
+    for row in img_matrix.rows():
+        line = b' '.join(map(PIXEL_TEXT.__getitem__, row)) + b'\n'
+        parts.append(line)
+        num_bytes += len(line)
+        if num_bytes >= buffer_size:
+            fobj.write(b''.join(parts))
+            parts = []
+            num_bytes = 0
+    
+    fobj.write(b''.join(parts))
+
+
+def save_regular_image(img_matrix, filename):
+    ''' (list<list> or Image, str) -> NoneType
+    Saves nested_list to a file with filename, using write_regular_image.
+    If nested_list is not a valid PGM matrix, raises an AssertionError.
+    
+    >>> save_regular_image([[0]*10, [255]*10, [0]*10], 'test.pgm')
+    >>> fobj = open('test.pgm', 'r')
+    >>> fobj.read()
+    'P2\\n10 3\\n255\\n0 0 0 0 0 0 0 0 0 0\\n255 255 255 255 255 255 255 255 255 255\\n0 0 0 0 0 0 0 0 0 0\\n'
+    >>> fobj.close()
+    >>> image = [[0]*10, [255]*10, [0]*10]
+    >>> image2 = load_image('test.pgm')
+    >>> image == image2
+    True
+    
+    >>> save_regular_image(Image.from_matrix([[1, 2], [3, 4]]), 'test.pgm')
+    >>> load_image('test.pgm')
+    [[1, 2], [3, 4]]
+    '''
+
+    if not(is_valid_image(img_matrix)):
+        raise AssertionError('Nested list must be a matrix in PGM image format.')
+    
+    # checked before the file is opened, so a bad matrix leaves it untouched
+    img_matrix = Image.from_matrix(img_matrix)
+    write_file(filename, lambda fobj: write_regular_image(img_matrix, fobj))
+
+
+def save_binary_image(img_matrix, filename):
+    ''' (list<list> or Image, str) -> NoneType
+    Saves img_matrix to filename as a binary PGM ('P5') image.
+    If img_matrix is not a valid PGM matrix, raises an AssertionError.
+    
+    >>> save_binary_image([[0]*3, [255]*3], 'test.p5.pgm')
+    >>> fobj = open('test.p5.pgm', 'rb')
+    >>> fobj.read()
+    b'P5\\n3 2\\n255\\n\\x00\\x00\\x00\\xff\\xff\\xff'
+    >>> fobj.close()
+    '''
+    
+    if not(is_valid_image(img_matrix)):
+        raise AssertionError('Nested list must be a matrix in PGM image format.')
+    
+    img_matrix = Image.from_matrix(img_matrix)
+    write_file(filename, lambda fobj: write_binary_image(img_matrix, fobj))
+
+
+def write_binary_image(img_matrix, fobj):
+    ''' (Image, file) -> NoneType
+    Writes img_matrix as a binary PGM ('P5') image to fobj, one row at a time.
+    
+    >>> fobj = io.BytesIO()
+    >>> write_binary_image(Image.from_matrix([[0, 255]]), fobj)
+    >>> fobj.getvalue()
+    b'P5\\n2 1\\n255\\n\\x00\\xff'
+    '''
+    
+    header = 'P5\n' + str(img_matrix.width) + ' ' + str(img_matrix.height) + '\n255\n'
+    fobj.write(header.encode('ascii'))
+    
+    for row in img_matrix.rows():
+        fobj.write(row)
+
+
+def get_num_col_compressed_img(img_matrix):
+    ''' (<list<list>>) -> int
+    Returns the sum of all b values in the first row of img_matrix.
+    
+    >>> get_num_col_compressed_img([['11x5'], ['1x1', '5x3', '7x1'], ['255x3', '0x1', '255x1']])
+    5
+    
+    >>> get_num_col_compressed_img([['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x29', '239x1'], ['255x27', '223x1', '95x1', '15x1'], ['255x25', '239x1', '95x1', '0x3'], ['255x24', '143x1', '15x1', '0x4'], ['255x22', '207x1', '47x1', '0x5', '14x1'], ['255x21', '159x1', '15x1', '0x4', '14x1', '95x1', '115x1']])
+    30
+    
+    >>> get_num_col_compressed_img([['3x3', '4x3'], ['5x6']])
+    6
+    '''
+    
+    first_row = img_matrix[0]
+    b_list = []
+    
+    for c in range(len(first_row)):
+        elem = first_row[c].split('x')
+        # a literal span has one pixel per value
+        b = int(elem[1]) if len(elem) > 1 else first_row[c].count(',') + 1
+        b_list.append(b)
+        
+    b_sum = 0
+    
+    for i in range(len(b_list)):
+        b_sum += b_list[i]
+    
+    return b_sum
+
+
+def write_compressed_image(img_matrix, fobj, buffer_size=IO_CHUNK_SIZE):
+    ''' (<list<list>>, file, int) -> NoneType
+    Writes img_matrix as a compressed PGM ('P2C') image to fobj, which can be
+    any file object opened for binary writing, such as a file, pipe or socket
+    file. Rows are written as they are formatted, buffer_size bytes at a time.
+    In a DedupMatrix, a row shared with an earlier row is written as a
+    back-reference '=d' (see RowReferences).
+    If img_matrix is not a valid compressed PGM image matrix, raise an AssertionError.
+    
+    >>> fobj = io.BytesIO()
+    >>> write_compressed_image([['0x5', '200x2'], ['111x7']], fobj)
+    >>> fobj.getvalue()
+    b'P2C\\n7 2\\n255\\n0x5 200x2\\n111x7\\n'
+    
+    >>> fobj = io.BytesIO()
+    >>> write_compressed_image(dedup_rows([['0x5', '200x2'], ['111x7'], ['0x5', '200x2']]), fobj)
+    >>> fobj.getvalue()
+    b'P2C\\n7 3\\n255\\n0x5 200x2\\n111x7\\n=2\\n'
+    '''
+    
+    if not(is_valid_compressed_image(img_matrix)):
+        raise AssertionError('Nested list must be a matrix in compressed PGM image format.')
+    
+    header = 'P2C\n' + str(get_num_col_compressed_img(img_matrix)) + ' ' + str(len(img_matrix)) + '\n255\n'
+    parts = [header]
+    num_bytes = 0
+    refs = RowReferences()
+    dedup = isinstance(img_matrix, DedupMatrix)
+    
+    for row in img_matrix:
+        d = refs.distance(row) if dedup else 0
+        if d > 0:
+            line = '=' + str(d) + '\n'
+        else:
+            line = ' '.join(row) + '\n'
+        parts.append(line)
+        num_bytes += len(line)
+        if num_bytes >= buffer_size:
+            fobj.write(''.join(parts).encode('ascii'))
+            parts = []
+            num_bytes = 0
+    
+    fobj.write(''.join(parts).encode('ascii'))
+
+
+def save_compressed_image(img_matrix, filename, index=False):
+    ''' (<list<list>>, str, bool) -> NoneType
+    Saves img_matrix as filename, using write_compressed_image.
+    If index is True, also saves a row index next to filename
+    (see save_row_index) for crop_compressed_file.
+    If img_matrix is not a valid compressed PGM
+    image matrix, raise an AssertionError.
+    
+    >>> save_compressed_image([['0x5', '200x2'], ['111x7']], 'test.pgm.compressed')
+    >>> fobj = open('test.pgm.compressed', 'r')
+    >>> fobj.read()
+    'P2C\\n7 2\\n255\\n0x5 200x2\\n111x7\\n'
+    >>> fobj.close()
+    
+    >>> save_compressed_image([['0x24'], ['0x1', '51x5', '0x1', '119x5', '0x1', '187x5', '0x1', '255x4', '0x1'], ['0x1', '51x1', '0x5', '119x1', '0x3', '119x1', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x1', '0x2', '255x1', '0x1'], ['0x1', '51x1', '0x5', '119x1', '0x3', '119x1', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x4', '0x1'], ['0x1', '51x1', '0x5', '119x1', '0x3', '119x1', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x1', '0x4'], ['0x1', '51x5', '0x1', '119x5', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x1', '0x4'], ['0x24']], 'test2.pgm.compressed')
+    >>> fobj = open('test2.pgm.compressed', 'r')
+    >>> fobj.read()
+    'P2C\\n24 7\\n255\\n0x24\\n0x1 51x5 0x1 119x5 0x1 187x5 0x1 255x4 0x1\\n0x1 51x1 0x5 119x1 0x3 119x1 0x1 187x1 0x1 187x1 0x1 187x1 0x1 255x1 0x2 255x1 0x1\\n0x1 51x1 0x5 119x1 0x3 119x1 0x1 187x1 0x1 187x1 0x1 187x1 0x1 255x4 0x1\\n0x1 51x1 0x5 119x1 0x3 119x1 0x1 187x1 0x1 187x1 0x1 187x1 0x1 255x1 0x4\\n0x1 51x5 0x1 119x5 0x1 187x1 0x1 187x1 0x1 187x1 0x1 255x1 0x4\\n0x24\\n'
+    >>> fobj.close()
+    '''
+
+    if not(is_valid_compressed_image(img_matrix)):
+        raise AssertionError('Nested list must be a matrix in compressed PGM image format.')
+    
+    # checked before the file is opened, so a bad matrix leaves it untouched
+    img_matrix = compressed_like(img_matrix, img_matrix)
+    write_file(filename, lambda fobj: write_compressed_image(img_matrix, fobj))
+    
+    if index:
+        save_row_index(img_matrix, filename)
+
+
+def save_image(img_matrix, filename, img_format=None):
+    '''(<list<list>> or Image, str, str) -> NoneType
+    Saves img_matrix as filename.
+    If img_format is 'P5', a regular image is saved as a binary PGM image.
+    If img_format is 'P5C', the image is saved as a packed compressed PGM image.
+    Otherwise regular images are saved as 'P2' and compressed images as 'P2C'.
+    If img_matrix is not a valid compressed PGM image matrix
+    or PGM image matrix, raise an AssertionError.
+    
+    >>> save_image([['0x5', '200x2'], ['111x7']], 'test2.pgm.compressed')
+    >>> fobj = open('test2.pgm.compressed', 'r')
+    >>> fobj.read()
+    'P2C\\n7 2\\n255\\n0x5 200x2\\n111x7\\n'
+    >>> fobj.close()
+    
+    >>> save_image([['0x5', '200x2'], ['111x7']], 'test2.txt')
+    >>> fobj = open('test2.txt', 'r')
+    >>> fobj.read()
+    'P2C\\n7 2\\n255\\n0x5 200x2\\n111x7\\n'
+    >>> fobj.close()
+    
+    >>> save_image([[0, 255]], 'test.p5.pgm', 'P5')
+    >>> load_image('test.p5.pgm')
+    [[0, 255]]
+    '''
+    
+    if img_format == 'P5':
+        save_binary_image(img_matrix, filename)
+    elif img_format == 'P5C':
+        save_packed_image(img_matrix, filename)
+    elif isinstance(img_matrix, Image) or type(img_matrix[0][0]) == int:
+        save_regular_image(img_matrix, filename)
+    elif type(img_matrix[0][0]) == str:
+        save_compressed_image(img_matrix, filename)
+    else:
+        raise AssertionError('The elements of the image matrix must either be strings or integers.')
+
+
+def invert(img_matrix):
+    ''' (<list<list>> or Image) -> <list<list>> or Image
+    Returns a nested list where each element of img_matrix is subtracted from 255.
+    If img_matrix is an Image, an Image is returned.
+    Raises an AssertionError if the input matrix is not a valid PGM image matrix.
+    
+    >>> image = [[0, 100, 150], [200, 200, 200], [255, 255, 255]]
+    >>> invert(image)
+    [[255, 155, 105], [55, 55, 55], [0, 0, 0]]
+    >>> image == [[0, 100, 150], [200, 200, 200], [255, 255, 255]]
+    True
+    
+    >>> img = [[3, 2, 3], [4, 5, 6], [7, 8, 9]]
+    >>> invert(img)
+    [[252, 253, 252], [251, 250, 249], [248, 247, 246]]
+    >>> img == [[3, 2, 3], [4, 5, 6], [7, 8, 9]]
+    True
+    
+    >>> image = [[0, 150], [200, 200, 200], [255, 255, 255]]
+    >>> invert(image)
+    Traceback (most recent call last):
+    AssertionError: Nested list must be a matrix in PGM image format.
+    
+    >>> image = [[0, 261, 250], [200, 200, 200], [255, 255, 255]]
+    >>> invert(image)
+    Traceback (most recent call last):
+    AssertionError: Nested list must be a matrix in PGM image format.
+    
+    >>> invert(Image.from_matrix([[0, 100], [200, 255]])).to_matrix()
+    [[255, 155], [55, 0]]
+    '''
+    
+    if not(is_valid_image(img_matrix)):
+        raise AssertionError('Nested list must be a matrix in PGM image format.')
+    
+    if not(isinstance(img_matrix, Image)):
+        return invert(Image.from_matrix(img_matrix)).to_matrix()
+    
+    if BACKEND == 'numpy':
+        return array_to_image(255 - image_to_array(img_matrix))
+    
+    data = img_matrix.tobytes().translate(INVERT_TABLE)
+    
+    return Image(img_matrix.width, img_matrix.height, bytearray(data))
+
+
+def flip(img_matrix, direction, lazy=False):
+    ''' (<list<list>> or Image, str, bool) -> <list<list>> or Image
+    If direction == 'h', returns  the elements of each sublist in img_matrix reversed.
+    If direction is not 'h', returns the order of sublists in img_matrix reversed.
+    If lazy is True, returns an ImageView of img_matrix instead of copying it.
+    Raises an AssertionError if the input matrix is not a valid PGM image matrix.
+    
+    >>> image = [[1, 2, 3, 4, 5], [0, 0, 5, 10, 10], [5, 5, 5, 5, 5]]
+    >>> flip_vertical(image)
+    [[5, 5, 5, 5, 5], [0, 0, 5, 10, 10], [1, 2, 3, 4, 5]]
+    
+    >>> image = [[1, 2, 3, 4], [0, 0, 5], [5, 5, 5, 5, 5]]
+    >>> flip_vertical(image)
+    Traceback (most recent call last):
+    AssertionError: Input matrix must be in PGM image format.
+    
+    >>> image = [[1, 2, 3, 4, 5], [0, 0, 5, 10, 10], [5, 5, 5, 5, 5]]
+    >>> flip_horizontal(image)
+    [[5, 4, 3, 2, 1], [10, 10, 5, 0, 0], [5, 5, 5, 5, 5]]
+    
+    >>> image = [[1, 2, 3, 4, 'a'], [0, 0, 5, 10, 10], [5, 5, 5, 5, 5]]
+    >>> flip_horizontal(image)
+    Traceback (most recent call last):
+    AssertionError: Input matrix must be in PGM image format.
+    
+    >>> image = [[1, 2, 3, 4], [0, 0, 5], [5, 5, 5, 5, 5]]
+    >>> flip_horizontal(image)
+    Traceback (most recent call last):
+    AssertionError: Input matrix must be in PGM image format.
+    
+    >>> flip(Image.from_matrix([[1, 2], [3, 4]]), 'h').to_matrix()
+    [[2, 1], [4, 3]]
+    
+    >>> flip(Image.from_matrix([[1, 2], [3, 4]]), 'v').to_matrix()
+    [[3, 4], [1, 2]]
+    '''
+    
+    if not(is_valid_image(img_matrix)):
+        raise AssertionError('Input matrix must be in PGM image format.')
+    
+    if lazy:
+        return image_view(img_matrix).transformed(['FH' if direction == 'h' else 'FV'])
+    
+    if not(isinstance(img_matrix, Image)):
+        return flip(Image.from_matrix(img_matrix), direction).to_matrix()
+    
+    if BACKEND == 'numpy':
+        if direction == 'h':
+            return array_to_image(image_to_array(img_matrix)[:, ::-1])
+        return array_to_image(image_to_array(img_matrix)[::-1])
+    
+    num_row = img_matrix.height
+    num_col = img_matrix.width
+    data = bytearray(num_row * num_col)
+    
+    for r in range(num_row):
+        start = r * num_col
+        if direction == 'h':
+            data[start:start + num_col] = img_matrix.row(r)[::-1]
+        else:
+            data[start:start + num_col] = img_matrix.row(num_row - 1 - r)
+            
+    return Image(num_col, num_row, data)
+
+
+def flip_horizontal(img_matrix, lazy=False):
+    ''' (<list<list>>, bool) -> <list<list>>
+    Returns  the elements of each sublist in img_matrix reversed.
+    If lazy is True, returns an ImageView of img_matrix instead of copying it.
+    
+    >>> image = [[1, 2, 3, 4, 5], [0, 0, 5, 10, 10], [5, 5, 5, 5, 5]]
+    >>> flip_horizontal(image)
+    [[5, 4, 3, 2, 1], [10, 10, 5, 0, 0], [5, 5, 5, 5, 5]]
+    
+    >>> image = [[1, 2, 3, 4, 'a'], [0, 0, 5, 10, 10], [5, 5, 5, 5, 5]]
+    >>> flip_horizontal(image)
+    Traceback (most recent call last):
+    AssertionError: Input matrix must be in PGM image format.
+    
+    >>> image = [[1, 2, 3, 4], [0, 0, 5], [5, 5, 5, 5, 5]]
+    >>> flip_horizontal(image)
+    Traceback (most recent call last):
+    AssertionError: Input matrix must be in PGM image format.
+    '''
+    
+    new_img_matrix = flip(img_matrix, 'h', lazy)
+    
+    return new_img_matrix
+    
+    
+def flip_vertical(img_matrix, lazy=False):
+    ''' (<list<list>>, bool) -> <list<list>>
+    Returns the order of sublists in img_matrix reversed.
+    If lazy is True, returns an ImageView of img_matrix instead of copying it.
+    
+    >>> image = [[1, 2, 3, 4, 5], [0, 0, 5, 10, 10], [5, 5, 5, 5, 5]]
+    >>> flip_vertical(image)
+    [[5, 5, 5, 5, 5], [0, 0, 5, 10, 10], [1, 2, 3, 4, 5]]
+    
+    >>> image = [[1, 2, 3, 4], [0, 0, 5], [5, 5, 5, 5, 5]]
+    >>> flip_vertical(image)
+    Traceback (most recent call last):
+    AssertionError: Input matrix must be in PGM image format.
+    '''
+    
+    new_img_matrix = flip(img_matrix, 'v', lazy)
+    
+    return new_img_matrix
+
+
+def rotate_180(img_matrix, lazy=False):
+    ''' (<list<list>> or Image, bool) -> <list<list>> or Image
+    Returns img_matrix turned by 180 degrees, which is the same as
+    flip_vertical(flip_horizontal(img_matrix)) but done in one pass.
+    If lazy is True, returns an ImageView of img_matrix instead of copying it.
+    Raises an AssertionError if the input matrix is not a valid PGM image matrix.
+    
+    >>> rotate_180([[1, 2, 3], [4, 5, 6]])
+    [[6, 5, 4], [3, 2, 1]]
+    
+    >>> rotate_180(Image.from_matrix([[1, 2], [3, 4]])).to_matrix()
+    [[4, 3], [2, 1]]
+    '''
+    
+    if not(is_valid_image(img_matrix)):
+        raise AssertionError('Input matrix must be in PGM image format.')
+    
+    if lazy:
+        return image_view(img_matrix).transformed(['ROT'])
+    
+    if not(isinstance(img_matrix, Image)):
+        return rotate_180(Image.from_matrix(img_matrix)).to_matrix()
+    
+    if BACKEND == 'numpy':
+        return array_to_image(image_to_array(img_matrix)[::-1, ::-1])
+    
+    data = bytearray(img_matrix.tobytes()[::-1])
+    
+    return Image(img_matrix.width, img_matrix.height, data)
+
+
+def crop(img_matrix, top_left_row, top_left_col, num_row, num_col, lazy=False):
+    ''' (list<list> or Image, int, int, int, int, bool) -> <list<list>> or Image
+    Returns a nested list of integers at indices top_left_row to num_row
+    and top_left_col to num_col of img_matrix.
+    If lazy is True, returns an ImageView of img_matrix instead of copying it.
+    The region must fit in img_matrix and not be empty, or an
+    AssertionError is raised.
+
+    >>> crop([[5, 5, 5], [5, 6, 6], [6, 6, 7]], 1, 1, 2, 2)
+    [[6, 6], [6, 7]]
+    
+    >>> crop([[1, 2, 3, 4], [4, 5, 6, 7], [8, 9, 10, 11]], 1, 2, 2, 1)
+    [[6], [10]]
+    
+    >>> crop([[1, 2, 3, 4], [4, 5, 6, 7], [8, 9, 10, 11]], 0, 0, 3, 4)
+    [[1, 2, 3, 4], [4, 5, 6, 7], [8, 9, 10, 11]]
+    
+    >>> crop(Image.from_matrix([[1, 2, 3], [4, 5, 6]]), 0, 1, 2, 2).to_matrix()
+    [[2, 3], [5, 6]]
+    
+    >>> crop([[1, 2], [3, 4]], 0, 0, 2, 0)
+    Traceback (most recent call last):
+    AssertionError: The dimensions given must be valid.
+    '''
+    
+    if not(is_valid_image(img_matrix)):
+        raise AssertionError('Input matrix must be in PGM image format.')
+    
+    end_row = top_left_row + num_row
+    end_col = top_left_col + num_col
+    valid_num_row = 0 < num_row and end_row <= len(img_matrix)
+    valid_num_col = 0 < num_col and end_col <= len(img_matrix[0])
+    
+    if not (valid_num_row and valid_num_col):
+        raise AssertionError('The dimensions given must be valid.')
+    
+    if lazy:
+        return image_view(img_matrix).transformed(['CR', top_left_row, top_left_col, num_row, num_col])
+    
+    if not(isinstance(img_matrix, Image)):
+        new_img = crop(Image.from_matrix(img_matrix), top_left_row, top_left_col, num_row, num_col)
+        return new_img.to_matrix()
+    
+    if BACKEND == 'numpy':
+        return array_to_image(image_to_array(img_matrix)[top_left_row:end_row, top_left_col:end_col])
+    
+    data = bytearray(num_row * num_col)
+    
+    for r in range(num_row):
+        row = img_matrix.row(top_left_row + r)
+        data[r * num_col:(r + 1) * num_col] = row[top_left_col:end_col]
+
+    return Image(num_col, num_row, data)
+
+
+def compile_steps(steps, num_row, num_col):
+    ''' (list<list>, int, int) -> list
+    Compiles a sequence of INV, FH, FV, ROT and CR steps applied to a
+    num_row x num_col image into one index mapping and one value mapping:
+    [top_left_row, top_left_col, num_row, num_col, flip_h, flip_v, table].
+    Pixel (r, c) of the result is table[src[y][x]], where src is the source
+    image, y is top_left_row + r (counted from the bottom of the window if
+    flip_v) and x is top_left_col + c (counted from the right if flip_h).
+    
+    >>> compile_steps([['INV'], ['FH'], ['CR', 1, 2, 3, 4]], 7, 24)[:6]
+    [1, 18, 3, 4, True, False]
+    >>> compile_steps([['INV'], ['FH'], ['CR', 1, 2, 3, 4]], 7, 24)[6][:3]
+    b'\\xff\\xfe\\xfd'
+    '''
+    
+    table = IDENTITY_TABLE
+    geometric_steps = []
+    
+    for step in steps:
+        if step[0] == 'INV':
+            table = table.translate(INVERT_TABLE)
+        else:
+            geometric_steps.append(step)
+    
+    fused_steps, size = fuse_steps(geometric_steps, [num_row, num_col])
+    window = [0, 0, num_row, num_col]
+    flip_h = False
+    flip_v = False
+    
+    for step in fused_steps:
+        if step[0] == 'CR':
+            window = step[1:]
+        if step[0] in ['FH', 'ROT']:
+            flip_h = True
+        if step[0] in ['FV', 'ROT']:
+            flip_v = True
+    
+    return window + [flip_h, flip_v, table]
+
+
+def fused_transform(img_matrix, steps):
+    ''' (<list<list>> or Image, list<list>) -> <list<list>> or Image
+    Applies a sequence of INV, FH, FV, ROT and CR steps (as in a plan from
+    parse_command) to img_matrix in a single pass, allocating only the
+    output image. The steps are first compiled by compile_steps.
+    Raises an AssertionError if the input matrix is not a valid PGM image matrix
+    or a crop does not fit.
+    
+    >>> fused_transform([[1, 2, 3], [4, 5, 6]], [['INV'], ['FH'], ['CR', 0, 0, 2, 2]])
+    [[252, 253], [249, 250]]
+    
+    >>> image = Image.from_matrix([[1, 2, 3], [4, 5, 6]])
+    >>> fused_transform(image, [['FV'], ['FH']]) == rotate_180(image)
+    True
+    '''
+    
+    if not(is_valid_image(img_matrix)):
+        raise AssertionError('Input matrix must be in PGM image format.')
+    
+    if not(isinstance(img_matrix, Image)):
+        return fused_transform(Image.from_matrix(img_matrix), steps).to_matrix()
+    
+    if isinstance(img_matrix, ImageView):
+        if img_matrix.image is not None:
+            return fused_transform(img_matrix.image, steps)
+        return fused_transform(img_matrix.source, img_matrix.steps() + list(steps))
+    
+    top_left_row, top_left_col, num_row, num_col, flip_h, flip_v, table = compile_steps(steps, img_matrix.height, img_matrix.width)
+    end_col = top_left_col + num_col
+    
+    if BACKEND == 'numpy':
+        arr = image_to_array(img_matrix)[top_left_row:top_left_row + num_row, top_left_col:end_col]
+        arr = arr[::-1 if flip_v else 1, ::-1 if flip_h else 1]
+        if table is IDENTITY_TABLE:
+            return array_to_image(arr)
+        return array_to_image(numpy.frombuffer(table, numpy.uint8)[arr])
+    
+    data = bytearray(num_row * num_col)
+    
+    for r in range(num_row):
+        if flip_v:
+            row = img_matrix.row(top_left_row + num_row - 1 - r)[top_left_col:end_col]
+        else:
+            row = img_matrix.row(top_left_row + r)[top_left_col:end_col]
+        if flip_h:
+            row = row[::-1]
+        if table is not IDENTITY_TABLE:
+            row = row.tobytes().translate(table)
+        data[r * num_col:(r + 1) * num_col] = row
+    
+    return Image(num_col, num_row, data)
+
+
+def find_end_of_repetition(int_list, ind, target_num):
+    ''' (<list<int>>) -> int
+    Looks through int_list starting after ind.
+    Returns the index of the last consecutive occurrence of the target_num.
+    
+    >>> find_end_of_repetition([5, 3, 5, 5, 5, -1, 0], 2, 5)
+    4
+    
+    >>> find_end_of_repetition([1, 2, 3, 4, 5, 6, 7], 6, 7)
+    6
+    
+    >>> find_end_of_repetition([1, 1, 1, 1, 1, 1], 0, 1)
+    5
+    '''
+    
+    num_elem = len(int_list)
+    
+    for i in range(ind, num_elem):
+        last_occur = i
+        if int_list[i] != target_num:
+            last_occur = i - 1
+            break
+    
+    return last_occur
+
+
+def compress(img_matrix, packed=False, mode='rle', dedup=False):
+    ''' (list<list<int>> or Image, bool, str, bool) -> <list<list<str>>> or bytes
+    Returns img_matrix with repeated integers in the form 'AxB'.
+    If packed is True, returns the runs in the packed compressed PGM ('P5C')
+    format instead, without building any strings.
+    If mode is 'adaptive', each row is written in its cheapest form, so
+    noisy rows are not blown up by runs of one pixel: stretches of single
+    pixels become literal spans 'A,A,...' (see literal_spans), and packed
+    rows are a mix of runs and literal spans chosen by adaptive_entries.
+    A row then never takes much more space than its pixels.
+    If dedup is True, a row equal to one of the ROW_REF_WINDOW rows before it
+    is shared with that row (see dedup_rows) and saved as a back-reference.
+    
+    >>> compress([[11, 11, 11, 11, 11], [1, 5, 5, 5, 7], [255, 255, 255, 0, 255]])
+    [['11x5'], ['1x1', '5x3', '7x1'], ['255x3', '0x1', '255x1']]
+    
+    
+    >>> compress([[5, 5, 5], [1, 2, 3], [4, 6, 5]])
+    [['5x3'], ['1x1', '2x1', '3x1'], ['4x1', '6x1', '5x1']]
+    
+    >>> compress([[5, 5, 5, 6], [4, 4, 7, 8], [2, 2, 22, 4]])
+    [['5x3', '6x1'], ['4x2', '7x1', '8x1'], ['2x2', '22x1', '4x1']]
+    
+    >>> compress([['11x5'], ['1x1', '5x3', '7x1'], ['255x3', '0x1', '255x1']])
+    Traceback (most recent call last):
+    AssertionError: Input matrix must be in PGM image format.
+    
+    >>> compress([[5, 5, 5, 6], [4, 4, 7, 8], [2, 2, 2222, 4]])
+    Traceback (most recent call last):
+    AssertionError: Input matrix must be in PGM image format.
+    
+    >>> compress(Image.from_matrix([[5, 5, 5, 6], [4, 4, 7, 8]]))
+    [['5x3', '6x1'], ['4x2', '7x1', '8x1']]
+    
+    >>> compress([[5, 5, 5, 6]], packed=True)
+    b'P5C\\n4 1\\n255\\n\\x02\\x05\\x03\\x06\\x01'
+    
+    >>> compress([[5, 5, 5, 6], [1, 2, 3, 3]], mode='adaptive')
+    [['5x3', '6x1'], ['1,2', '3x2']]
+    
+    >>> compress([[9, 2, 4, 7, 1]], packed=True, mode='adaptive')
+    b'P5C\\n5 1\\n255\\n\\x01\\t\\x00\\x04\\x02\\x04\\x07\\x01'
+    
+    >>> compress([[1, 1], [2, 2], [1, 1]], packed=True, dedup=True)
+    b'P5C\\n2 3\\n255\\n\\x01\\x01\\x02\\x01\\x02\\x02\\x00\\x02'
+    '''
+    
+    if mode not in ['rle', 'adaptive']:
+        raise AssertionError("Mode must be 'rle' or 'adaptive'.")
+    
+    if not(is_valid_image(img_matrix)):
+        raise AssertionError('Input matrix must be in PGM image format.')
+    
+    img_matrix = Image.from_matrix(img_matrix)
+    num_row = img_matrix.height
+    num_col = img_matrix.width
+    
+    if packed:
+        out = bytearray(('P5C\n' + str(num_col) + ' ' + str(num_row) + '\n255\n').encode('ascii'))
+        # where each packed row was last seen, for dedup
+        table = collections.OrderedDict()
+        for r, runs in enumerate(image_runs(img_matrix)):
+            if mode == 'adaptive':
+                runs = adaptive_entries(runs)
+            start = len(out)
+            pack_row(runs, out)
+            if dedup and num_col > 0:
+                key = bytes(out[start:])
+                seen = table.pop(key, None)
+                table[key] = r
+                if len(table) > ROW_REF_WINDOW:
+                    table.popitem(last=False)
+                if seen is not None and r - seen <= ROW_REF_WINDOW:
+                    del out[start:]
+                    pack_row_reference(r - seen, out)
+        return bytes(out)
+    
+    comp_img_matrix = CompressedMatrix()
+    tokens = RunTokens()
+    
+    for row in img_matrix.rows():
+        if mode == 'adaptive':
+            comp_img_matrix.append(literal_spans(encode_row(row, tokens)))
+        else:
+            comp_img_matrix.append(encode_row(row, tokens))
+    
+    if dedup:
+        return dedup_rows(comp_img_matrix)
+            
+    return comp_img_matrix
+
+
+# The pixel byte of each value A of an 'AxB' run.
+RUN_VALUE_BYTE = dict((str(a), bytes([a])) for a in range(256))
+
+
+def decompress_row(comp_row, num_col=None):
+    ''' (list<str>, int) -> bytes
+    Returns the pixels of the compressed row comp_row. Each run is checked
+    as it is expanded, so no separate validation pass is needed.
+    Raises an AssertionError if a run is not in the form 'AxB' or 'A,A,...'
+    or, if num_col is given, the row is not num_col pixels long.
+    
+    >>> decompress_row(['1,5', '5x2', '7x1'])
+    b'\\x01\\x05\\x05\\x05\\x07'
+    
+    >>> decompress_row(['1x1', '5x3'], 5)
+    Traceback (most recent call last):
+    AssertionError: Input matrix must be in compressed PGM image format.
+    '''
+    
+    runs = []
+    
+    try:
+        for elem in comp_row:
+            if ',' in elem:
+                values = elem.split(',')
+                if not(all(map(str.isdecimal, values))):
+                    raise ValueError
+                runs.append(bytes(map(int, values)))
+                continue
+            a, x, b = elem.partition('x')
+            value = RUN_VALUE_BYTE.get(a)
+            if value is None:
+                # values written with leading zeros
+                if not(a.isdecimal()) or int(a) > 255:
+                    raise ValueError
+                value = bytes([int(a)])
+            if not(b.isdecimal()) or int(b) == 0:
+                raise ValueError
+            runs.append(value * int(b))
+    except (AttributeError, TypeError, ValueError):
+        raise AssertionError('Input matrix must be in compressed PGM image format.')
+    
+    row = b''.join(runs)
+    
+    if num_col is not None and len(row) != num_col:
+        raise AssertionError('Input matrix must be in compressed PGM image format.')
+    
+    return row
+
+
+def decompress(comp_img_matrix, as_image=False):
+    ''' (<list<list<str>>>, bool) -> <list<list<int>>> or Image
+    Returns the pixels of comp_img_matrix, or an Image if as_image is True.
+    The output buffer is allocated once, from the size of the first row,
+    and each row is expanded straight into it by decompress_row, which
+    checks the runs on the way.
+    
+    >>> decompress([['11x5'], ['1x1', '5x3', '7x1'], ['255x3', '0x1', '255x1']])
+    [[11, 11, 11, 11, 11], [1, 5, 5, 5, 7], [255, 255, 255, 0, 255]]
+    
+    >>> image = [[11, 11, 11, 11, 11], [1, 5, 5, 5, 7], [255, 255, 255, 0, 255]]
+    >>> compressed_image = compress(image)
+    >>> image2 = decompress(compressed_image)
+    >>> image == image2
+    True
+    
+    >>> decompress([['0x5', '200x2'], ['111x7']], as_image=True)
+    Image(7, 2)
+    
+    >>> decompress([['20x4', '4x2'], ['20x3']])
+    Traceback (most recent call last):
+    AssertionError: Input matrix must be in compressed PGM image format.
+    '''
+    
+    if type(comp_img_matrix) not in [list, CompressedMatrix, DedupMatrix]:
+        raise AssertionError('Input matrix must be in compressed PGM image format.')
+    
+    num_row = len(comp_img_matrix)
+    
+    if num_row == 0:
+        return Image(0, 0) if as_image else []
+    
+    first_row = decompress_row(comp_img_matrix[0])
+    num_col = len(first_row)
+    data = bytearray(num_row * num_col)
+    data[:num_col] = first_row
+    # shared rows are only expanded once
+    rows = map_compressed_rows(lambda comp_row: decompress_row(comp_row, num_col), comp_img_matrix[1:])
+    
+    for r, row in enumerate(rows, 1):
+        data[r * num_col:(r + 1) * num_col] = row
+    
+    img = Image(num_col, num_row, data)
+    
+    if as_image:
+        return img
+    
+    return img.to_matrix()
+
+
+def decompress_file(src, dst, img_format=None):
+    ''' (str, str, str) -> NoneType
+    Decompresses the compressed image file src ('P2C' or 'P5C') into dst,
+    as a 'P2' image, or a 'P5' image if img_format is 'P5'. Rows are read,
+    expanded and written one at a time, so the image is never held in
+    memory as a whole.
+    
+    >>> save_image([['0x5', '200x2'], ['111x7']], 'test.pgm.compressed')
+    >>> decompress_file('test.pgm.compressed', 'test.pgm')
+    >>> load_image('test.pgm')
+    [[0, 0, 0, 0, 0, 200, 200], [111, 111, 111, 111, 111, 111, 111]]
+    
+    >>> decompress_file('test.pgm', 'test2.pgm')
+    Traceback (most recent call last):
+    AssertionError: Input must be in a valid compressed PGM image format.
+    '''
+    
+    stream = stream_image(src)
+    
+    if not(stream.compressed):
+        raise AssertionError('Input must be in a valid compressed PGM image format.')
+    
+    save_stream(stream_decompress(stream), dst, img_format)
+
+
+INVERT_RUN_VALUE = dict((str(a), str(255 - a)) for a in range(256))
+
+
+def invert_compressed(comp_img_matrix):
+    ''' (<list<list<str>>>) -> <list<list<str>>>
+    Returns a compressed image matrix where the value A of each 'AxB'
+    run (and each value of a literal span) of comp_img_matrix is subtracted
+    from 255, without decompressing.
+    
+    >>> invert_compressed([['0x5', '200x2'], ['111x5', '0,1']])
+    [['255x5', '55x2'], ['144x5', '255,254']]
+    
+    >>> invert_compressed([[0, 1], [2, 3]])
+    Traceback (most recent call last):
+    AssertionError: Input matrix must be in compressed PGM image format.
+    '''
+    
+    if not(is_valid_compressed_image(comp_img_matrix)):
+        raise AssertionError('Input matrix must be in compressed PGM image format.')
+    
+    return compressed_like(comp_img_matrix, map_compressed_rows(invert_compressed_row, comp_img_matrix))
+
+
+def invert_compressed_row(comp_row):
+    ''' (list<str>) -> list<str>
+    Returns comp_row with the value of each run subtracted from 255.
+    
+    >>> invert_compressed_row(['0x5', '1,2'])
+    ['255x5', '254,253']
+    '''
+    
+    inv_row = []
+    
+    for elem in comp_row:
+        if ',' in elem:
+            inv_row.append(','.join([INVERT_RUN_VALUE[str(int(a))] for a in elem.split(',')]))
+        else:
+            a, x, b = elem.partition('x')
+            inv_row.append(INVERT_RUN_VALUE[str(int(a))] + 'x' + b)
+    
+    return inv_row
+
+
+def reverse_compressed_row(comp_row):
+    ''' (list<str>) -> list<str>
+    Returns the runs of comp_row in reverse order, with the values of each
+    literal span reversed too.
+    
+    >>> reverse_compressed_row(['0x5', '1,2,3'])
+    ['3,2,1', '0x5']
+    '''
+    
+    return [','.join(elem.split(',')[::-1]) if ',' in elem else elem for elem in reversed(comp_row)]
+
+
+def flip_horizontal_compressed(comp_img_matrix):
+    ''' (<list<list<str>>>) -> <list<list<str>>>
+    Returns a compressed image matrix where the runs of each row
+    of comp_img_matrix are reversed, without decompressing.
+    
+    >>> flip_horizontal_compressed([['0x5', '200x2'], ['111x7']])
+    [['200x2', '0x5'], ['111x7']]
+    '''
+    
+    if not(is_valid_compressed_image(comp_img_matrix)):
+        raise AssertionError('Input matrix must be in compressed PGM image format.')
+    
+    return compressed_like(comp_img_matrix, map_compressed_rows(reverse_compressed_row, comp_img_matrix))
+
+
+def flip_vertical_compressed(comp_img_matrix):
+    ''' (<list<list<str>>>) -> <list<list<str>>>
+    Returns the rows of comp_img_matrix in reverse order, without decompressing.
+    
+    >>> flip_vertical_compressed([['0x5', '200x2'], ['111x7']])
+    [['111x7'], ['0x5', '200x2']]
+    '''
+    
+    if not(is_valid_compressed_image(comp_img_matrix)):
+        raise AssertionError('Input matrix must be in compressed PGM image format.')
+    
+    return compressed_like(comp_img_matrix, comp_img_matrix[::-1])
+
+
+def rotate_180_compressed(comp_img_matrix):
+    ''' (<list<list<str>>>) -> <list<list<str>>>
+    Returns comp_img_matrix turned by 180 degrees: the rows in reverse
+    order, each with its runs reversed, without decompressing.
+    
+    >>> rotate_180_compressed([['0x5', '200x2'], ['111x7']])
+    [['111x7'], ['200x2', '0x5']]
+    '''
+    
+    if not(is_valid_compressed_image(comp_img_matrix)):
+        raise AssertionError('Input matrix must be in compressed PGM image format.')
+    
+    return compressed_like(comp_img_matrix, map_compressed_rows(reverse_compressed_row, reversed(comp_img_matrix)))
+
+
+def crop_compressed_row(comp_row, top_left_col, num_col):
+    ''' (list<str>, int, int) -> list<str>
+    Returns the runs covering columns top_left_col to top_left_col + num_col
+    of comp_row, with the first and last runs shortened to fit.
+    
+    >>> crop_compressed_row(['0x5', '200x2', '7x3'], 3, 6)
+    ['0x2', '200x2', '7x2']
+    
+    >>> crop_compressed_row(['0x5', '200x2', '7x3'], 5, 2)
+    ['200x2']
+    
+    >>> crop_compressed_row(['0x2', '1,2,3,4'], 1, 4)
+    ['0x1', '1,2,3']
+    
+    >>> crop_compressed_row(['0x2', '1,2,3,4'], 2, 0)
+    []
+    '''
+    
+    # an empty region has no runs
+    if num_col == 0:
+        return []
+    
+    new_row = []
+    end_col = top_left_col + num_col
+    run_start = 0
+    
+    for elem in comp_row:
+        if ',' in elem:
+            values = elem.split(',')
+            run_end = run_start + len(values)
+            if run_end > top_left_col:
+                values = values[max(run_start, top_left_col) - run_start:min(run_end, end_col) - run_start]
+                new_row.append(','.join(values) if len(values) > 1 else values[0] + 'x1')
+        else:
+            a, x, b = elem.partition('x')
+            run_end = run_start + int(b)
+            if run_end > top_left_col:
+                b = min(run_end, end_col) - max(run_start, top_left_col)
+                new_row.append(a + 'x' + str(b))
+        
+        if run_end >= end_col:
+            break
+        run_start = run_end
+    
+    return new_row
+
+
+def crop_compressed(comp_img_matrix, top_left_row, top_left_col, num_row, num_col):
+    ''' (<list<list<str>>>, int, int, int, int) -> <list<list<str>>>
+    Returns the compressed image matrix of the num_row x num_col region of
+    comp_img_matrix whose top left corner is at (top_left_row, top_left_col).
+    Runs are sliced by their column offsets, without decompressing.
+    
+    >>> crop_compressed([['5x3'], ['5x1', '6x2'], ['6x2', '7x1']], 1, 1, 2, 2)
+    [['6x2'], ['6x1', '7x1']]
+    
+    >>> crop_compressed([['5x3'], ['5x1', '6x2'], ['6x2', '7x1']], 1, 1, 2, 3)
+    Traceback (most recent call last):
+    AssertionError: The dimensions given must be valid.
+    
+    >>> crop_compressed([['1x1', '2x1'], ['3x2']], 0, 0, 1, 0)
+    Traceback (most recent call last):
+    AssertionError: The dimensions given must be valid.
+    '''
+    
+    if not(is_valid_compressed_image(comp_img_matrix)):
+        raise AssertionError('Input matrix must be in compressed PGM image format.')
+    
+    valid_num_row = 0 < num_row and top_left_row + num_row <= len(comp_img_matrix)
+    valid_num_col = 0 < num_col and top_left_col + num_col <= get_num_col_compressed_img(comp_img_matrix)
+    
+    if not (valid_num_row and valid_num_col):
+        raise AssertionError('The dimensions given must be valid.')
+    
+    rows = comp_img_matrix[top_left_row:top_left_row + num_row]
+    
+    return compressed_like(comp_img_matrix, map_compressed_rows(lambda row: crop_compressed_row(row, top_left_col, num_col), rows))
+
+
+INDEX_RUN_STEP = 16
+
+
+def varint_size(num):
+    ''' (int) -> int
+    Returns the number of bytes write_varint uses for num.
+    
+    >>> varint_size(127), varint_size(128), varint_size(300)
+    (1, 2, 2)
+    '''
+    
+    return max(1, (num.bit_length() + 6) // 7)
+
+
+def build_row_index(comp_img_matrix, packed=False, step=INDEX_RUN_STEP):
+    ''' (<list<list<str>>>, bool, int) -> list
+    Returns the row index of comp_img_matrix as it is laid out by
+    save_compressed_image, or by save_packed_image if packed is True:
+    [row_offsets, checkpoints, checkpoint_cols, checkpoint_bytes, data_size],
+    where all but data_size are arrays.
+    row_offsets holds the byte offset of each row in the file, plus the file size.
+    Every step-th run of a row is a checkpoint: checkpoint_cols holds its first
+    column and checkpoint_bytes its byte offset from the start of the row.
+    Each row ends with a checkpoint for the end of the row, and
+    checkpoints holds the position of each row's first checkpoint.
+    A back-reference row has the offset and checkpoints of the row it
+    refers to.
+    
+    >>> row_offsets, checkpoints, checkpoint_cols, checkpoint_bytes, data_size = build_row_index([['0x5', '200x2'], ['111x7']], step=1)
+    >>> row_offsets.tolist(), checkpoints.tolist()
+    ([12, 22, 28], [0, 3, 5])
+    >>> checkpoint_cols.tolist(), checkpoint_bytes.tolist()
+    ([0, 5, 7, 0, 7], [0, 4, 9, 0, 5])
+    '''
+    
+    num_row = len(comp_img_matrix)
+    num_col = get_num_col_compressed_img(comp_img_matrix)
+    header = ('P5C' if packed else 'P2C') + '\n' + str(num_col) + ' ' + str(num_row) + '\n255\n'
+    row_offsets = array.array('Q')
+    checkpoints = array.array('Q')
+    checkpoint_cols = array.array('I')
+    checkpoint_bytes = array.array('I')
+    offset = len(header)
+    refs = RowReferences()
+    dedup = isinstance(comp_img_matrix, DedupMatrix)
+    
+    for r, row in enumerate(comp_img_matrix):
+        d = refs.distance(row) if dedup else 0
+        
+        if d > 0 and (num_col > 0 or not(packed)):
+            # a back-reference is read from the row it refers to
+            lo = checkpoints[r - d]
+            hi = checkpoints[r - d + 1] if d > 1 else len(checkpoint_cols)
+            row_offsets.append(row_offsets[r - d])
+            checkpoints.append(len(checkpoint_cols))
+            checkpoint_cols.extend(checkpoint_cols[lo:hi])
+            checkpoint_bytes.extend(checkpoint_bytes[lo:hi])
+            offset += 1 + varint_size(d) if packed else len(str(d)) + 2
+            continue
+        
+        row_offsets.append(offset)
+        checkpoints.append(len(checkpoint_cols))
+        col = 0
+        
+        # [pixels, bytes] of each run, or of each packed entry, since a
+        # literal span can only be read as a whole
+        if packed:
+            entries = token_entries(row)
+            num_bytes = varint_size(len(entries))
+            sizes = [[entry[1], 1 + varint_size(entry[1])] if type(entry) == list
+                     else [len(entry), 1 + varint_size(len(entry) - 1) + len(entry)] for entry in entries]
+        else:
+            num_bytes = 0
+            sizes = [[elem.count(',') + 1 if ',' in elem else int(elem.partition('x')[2]), len(elem) + 1] for elem in row]
+        
+        for k in range(len(sizes)):
+            if k % step == 0:
+                checkpoint_cols.append(col)
+                checkpoint_bytes.append(num_bytes)
+            col += sizes[k][0]
+            num_bytes += sizes[k][1]
+        
+        checkpoint_cols.append(num_col)
+        checkpoint_bytes.append(num_bytes if packed or not(row) else num_bytes - 1)
+        offset += num_bytes if packed else max(num_bytes, 1)
+    
+    row_offsets.append(offset)
+    checkpoints.append(len(checkpoint_cols))
+    
+    return [row_offsets, checkpoints, checkpoint_cols, checkpoint_bytes, offset]
+
+
+def save_row_index(comp_img_matrix, filename, packed=False, step=INDEX_RUN_STEP):
+    ''' (<list<list<str>>>, str, bool, int) -> NoneType
+    Writes the row index of comp_img_matrix, saved as filename, to the
+    sidecar file filename + '.idx' so crop_compressed_file can seek
+    straight to the rows and runs it needs. The index records the size,
+    modification time and inode of filename, so that it is only used
+    with the file it was built for.
+    '''
     
-    >>> save_regular_image([[0]*10, [255]*10, [0]*10], 'test.pgm')
-    >>> fobj = open('test.pgm', 'r')
-    >>> fobj.read()
-    'P2\\n10 3\\n255\\n0 0 0 0 0 0 0 0 0 0\\n255 255 255 255 255 255 255 255 255 255\\n0 0 0 0 0 0 0 0 0 0\\n'
-    >>> fobj.close()
-    >>> image = [[0]*10, [255]*10, [0]*10]
-    >>> image2 = load_image('test.pgm')
-    >>> image == image2
+    row_offsets, checkpoints, checkpoint_cols, checkpoint_bytes, data_size = build_row_index(comp_img_matrix, packed, step)
+    stat = os.stat(filename)
+    sizes = array.array('Q', [len(comp_img_matrix), data_size, len(checkpoint_cols), stat.st_mtime_ns, stat.st_ino])
+    
+    fobj = open(filename + '.idx', 'wb')
+    fobj.write(b'PIDX\n')
+    fobj.write(sizes.tobytes())
+    fobj.write(row_offsets.tobytes())
+    fobj.write(checkpoints.tobytes())
+    fobj.write(checkpoint_cols.tobytes())
+    fobj.write(checkpoint_bytes.tobytes())
+    fobj.close()
+
+
+def load_row_index(filename):
+    ''' (str) -> list or NoneType
+    Returns the row index saved next to filename by save_row_index, in the
+    same form as build_row_index. Returns None if there is no index, if
+    filename is not a compressed ('P2C' or 'P5C') image, or if filename
+    has been changed since the index was saved.
+    
+    >>> save_compressed_image([['0x5', '200x2'], ['111x7']], 'test.pgm.compressed', index=True)
+    >>> load_row_index('test.pgm.compressed')[0]
+    array('Q', [12, 22, 28])
+    
+    >>> os.replace('test.pgm.compressed.idx', 'test.idx')
+    >>> save_image([[1] * 10, [2] * 10], 'test.pgm.compressed', 'P5')
+    >>> os.replace('test.idx', 'test.pgm.compressed.idx')
+    >>> load_row_index('test.pgm.compressed') is None
     True
     '''
-
-    if not(is_valid_image(img_matrix)):
-        raise AssertionError('Nested list must be a matrix in PGM image format.')
     
-    num_row = len(img_matrix)
-    num_col = len(img_matrix[0])
-    img = 'P2\n' + str(num_col) + ' ' + str(num_row) + '\n255\n'
+    try:
+        fobj = open(filename + '.idx', 'rb')
+    except OSError:
+        return None
     
-    for r in range(num_row):
-        img_row = ' '
-        for c in range(num_col):
-            img_matrix[r][c] = str(img_matrix[r][c])
-        img_row = img_row.join(img_matrix[r])
-        img = img + img_row + '\n'
+    buf = fobj.read()
+    fobj.close()
     
-    fobj = open(filename, 'w')
-    fobj.write(img)
+    if buf[:5] != b'PIDX\n' or len(buf) < 45:
+        return None
+    
+    sizes = array.array('Q', buf[5:45])
+    num_row, data_size, num_checkpoints, mtime, inode = sizes
+    arrays = []
+    i = 45
+    
+    for typecode, length in [('Q', num_row + 1), ('Q', num_row + 1), ('I', num_checkpoints), ('I', num_checkpoints)]:
+        values = array.array(typecode)
+        end = i + length * values.itemsize
+        if end > len(buf):
+            return None
+        values.frombytes(buf[i:end])
+        arrays.append(values)
+        i = end
+    
+    try:
+        stat = os.stat(filename)
+        fobj = open(filename, 'rb')
+    except OSError:
+        return None
+    
+    magic = fobj.read(4)
     fobj.close()
+    
+    if [stat.st_size, stat.st_mtime_ns, stat.st_ino] != [data_size, mtime, inode]:
+        return None
+    if magic not in [b'P2C\n', b'P5C\n']:
+        return None
+    
+    return arrays + [data_size]
 
 
-def get_num_col_compressed_img(img_matrix):
-    ''' (<list<list>>) -> int
-    Returns the sum of all b values in the first row of img_matrix.
+def unpack_runs(buf):
+    ''' (bytes-like) -> list<str>
+    Returns the packed entries held in buf, one after another, as 'AxB'
+    and 'A,A,...' strings.
     
-    >>> get_num_col_compressed_img([['11x5'], ['1x1', '5x3', '7x1'], ['255x3', '0x1', '255x1']])
-    5
+    >>> unpack_runs(b'\\x00\\x05\\xc8\\x02')
+    ['0x5', '200x2']
+    '''
     
-    >>> get_num_col_compressed_img([['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x30'], ['255x29', '239x1'], ['255x27', '223x1', '95x1', '15x1'], ['255x25', '239x1', '95x1', '0x3'], ['255x24', '143x1', '15x1', '0x4'], ['255x22', '207x1', '47x1', '0x5', '14x1'], ['255x21', '159x1', '15x1', '0x4', '14x1', '95x1', '115x1']])
-    30
+    runs = []
+    i = 0
     
-    >>> get_num_col_compressed_img([['3x3', '4x3'], ['5x6']])
-    6
+    while i < len(buf):
+        b, i = unpack_entry(buf, i, runs)
+    
+    return runs
+
+
+def crop_compressed_file(filename, top_left_row, top_left_col, num_row, num_col):
+    ''' (str, int, int, int, int) -> <list<list<str>>>
+    Returns the compressed image matrix of the num_row x num_col region,
+    with its top left corner at (top_left_row, top_left_col), of the compressed
+    image saved as filename ('P2C' or 'P5C').
+    If the file has a row index, only the rows of the region are read, and
+    in each row binary search over the index picks the runs to read.
+    Without an index, the whole image is loaded and cropped.
+    
+    >>> save_compressed_image([['5x3'], ['5x1', '6x2'], ['6x2', '7x1']], 'test.pgm.compressed', index=True)
+    >>> crop_compressed_file('test.pgm.compressed', 1, 1, 2, 2)
+    [['6x2'], ['6x1', '7x1']]
+    
+    >>> save_packed_image([['5x3'], ['5x1', '6x2'], ['6x2', '7x1']], 'test.p5c', index=True)
+    >>> crop_compressed_file('test.p5c', 1, 1, 2, 2)
+    [['6x2'], ['6x1', '7x1']]
+    
+    >>> crop_compressed_file('test.p5c', 1, 1, 2, 3)
+    Traceback (most recent call last):
+    AssertionError: The dimensions given must be valid.
     '''
     
-    first_row = img_matrix[0]
-    b_list = []
+    index = load_row_index(filename)
     
-    for c in range(len(first_row)):
-        elem = first_row[c].split('x')
-        b = int(elem[1])
-        b_list.append(b)
+    if index is None:
+        return crop_compressed(load_image(filename), top_left_row, top_left_col, num_row, num_col)
+    
+    row_offsets, checkpoints, checkpoint_cols, checkpoint_bytes, data_size = index
+    fobj = open(filename, 'rb')
+    packed = fobj.read(4) == b'P5C\n'
+    
+    image_num_row = len(row_offsets) - 1
+    image_num_col = checkpoint_cols[checkpoints[1] - 1] if image_num_row else 0
+    valid_num_row = 0 < num_row and top_left_row + num_row <= image_num_row
+    valid_num_col = 0 < num_col and top_left_col + num_col <= image_num_col
+    
+    if not (valid_num_row and valid_num_col):
+        fobj.close()
+        raise AssertionError('The dimensions given must be valid.')
+    
+    end_col = top_left_col + num_col
+    new_comp_img_matrix = CompressedMatrix()
+    
+    for r in range(top_left_row, top_left_row + num_row):
+        lo = checkpoints[r]
+        hi = checkpoints[r + 1]
+        # the last checkpoint at or before the first column, and the first
+        # checkpoint at or after the end of the region
+        first = bisect.bisect_right(checkpoint_cols, top_left_col, lo, hi - 1) - 1
+        last = bisect.bisect_left(checkpoint_cols, end_col, first + 1, hi - 1)
         
-    b_sum = 0
+        fobj.seek(row_offsets[r] + checkpoint_bytes[first])
+        buf = fobj.read(checkpoint_bytes[last] - checkpoint_bytes[first])
+        
+        if packed:
+            runs = unpack_runs(buf)
+        else:
+            runs = buf.decode('ascii').split()
+        
+        start_col = checkpoint_cols[first]
+        new_comp_img_matrix.append(crop_compressed_row(runs, top_left_col - start_col, num_col))
     
-    for i in range(len(b_list)):
-        b_sum += b_list[i]
+    fobj.close()
     
-    return b_sum
+    return new_comp_img_matrix
 
 
-def save_compressed_image(img_matrix, filename):
-    ''' (<list<list>>, str) -> NoneType
-    Saves img_matrix as filename.
-    If img_matrix is not a valid compressed PGM
-    image matrix, raise an AssertionError.
+class ImageStream:
+    ''' An image that is produced one row at a time.
+    width and height describe the image, compressed is True if the rows
+    are compressed rows ('AxB' strings) and False if they are rows of
+    pixels (bytes-like), and rows is an iterator over the rows.
+    Compressed rows may also hold literal spans ('A,A,...').
+    If dedup is True, compressed rows that are the same list are saved as
+    back-references, as in a DedupMatrix.
+    Only one row needs to be held in memory at a time, and the rows can
+    only be read once.
+    
+    >>> stream = ImageStream(2, 2, False, iter([b'ab', b'cd']))
+    >>> [bytes(row) for row in stream]
+    [b'ab', b'cd']
+    >>> list(stream)
+    Traceback (most recent call last):
+    AssertionError: The rows of a stream can only be read once.
+    '''
     
-    >>> save_compressed_image([['0x5', '200x2'], ['111x7']], 'test.pgm.compressed')
-    >>> fobj = open('test.pgm.compressed', 'r')
-    >>> fobj.read()
-    'P2C\\n7 2\\n255\\n0x5 200x2\\n111x7\\n'
-    >>> fobj.close()
+    __slots__ = ('width', 'height', 'compressed', 'rows', 'dedup')
     
-    >>> save_compressed_image([['0x24'], ['0x1', '51x5', '0x1', '119x5', '0x1', '187x5', '0x1', '255x4', '0x1'], ['0x1', '51x1', '0x5', '119x1', '0x3', '119x1', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x1', '0x2', '255x1', '0x1'], ['0x1', '51x1', '0x5', '119x1', '0x3', '119x1', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x4', '0x1'], ['0x1', '51x1', '0x5', '119x1', '0x3', '119x1', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x1', '0x4'], ['0x1', '51x5', '0x1', '119x5', '0x1', '187x1', '0x1', '187x1', '0x1', '187x1', '0x1', '255x1', '0x4'], ['0x24']], 'test2.pgm.compressed')
-    >>> fobj = open('test2.pgm.compressed', 'r')
-    >>> fobj.read()
-    'P2C\\n24 7\\n255\\n0x24\\n0x1 51x5 0x1 119x5 0x1 187x5 0x1 255x4 0x1\\n0x1 51x1 0x5 119x1 0x3 119x1 0x1 187x1 0x1 187x1 0x1 187x1 0x1 255x1 0x2 255x1 0x1\\n0x1 51x1 0x5 119x1 0x3 119x1 0x1 187x1 0x1 187x1 0x1 187x1 0x1 255x4 0x1\\n0x1 51x1 0x5 119x1 0x3 119x1 0x1 187x1 0x1 187x1 0x1 187x1 0x1 255x1 0x4\\n0x1 51x5 0x1 119x5 0x1 187x1 0x1 187x1 0x1 187x1 0x1 255x1 0x4\\n0x24\\n'
-    >>> fobj.close()
+    def __init__(self, width, height, compressed, rows, dedup=False):
+        self.width = width
+        self.height = height
+        self.compressed = compressed
+        self.rows = rows
+        self.dedup = dedup
+    
+    def __iter__(self):
+        if self.rows is None:
+            raise AssertionError('The rows of a stream can only be read once.')
+        rows = self.rows
+        self.rows = None
+        return iter(rows)
+    
+    def __repr__(self):
+        return 'ImageStream(' + str(self.width) + ', ' + str(self.height) + ')'
+
+
+def read_text_rows(fobj, num_col, num_row, compressed):
+    ''' (file, int, int, bool) -> iterator
+    Yields num_row rows read from the text file fobj, one line at a time.
+    Regular rows are yielded as bytes and compressed rows as lists of 'AxB'
+    strings; a back-reference '=d' yields the same list as the row it
+    refers to. An AssertionError is raised as soon as a row is not valid.
+    The file is closed once all rows are read.
     '''
+    
+    if compressed:
+        message = 'Input must be in a valid compressed PGM image format.'
+    else:
+        message = 'Input must be in PGM image format.'
+    
+    # the rows a back-reference can refer to
+    history = collections.deque(maxlen=ROW_REF_WINDOW)
+    
+    try:
+        for r in range(num_row):
+            row = fobj.readline().split()
+            
+            d = row_reference(row) if compressed else 0
+            
+            if d > 0:
+                if d > len(history):
+                    raise image_format_error(message, r, 0)
+                row = history[-d]
+                history.append(row)
+                yield row
+            elif compressed:
+                if not(row):
+                    raise image_format_error(message, r)
+                try:
+                    check_compressed_image([row], num_col, message)
+                except AssertionError as err:
+                    if err.col is not None:
+                        raise image_format_error(message, r, err.col)
+                    raise AssertionError('The number of rows and columns of image matrix\'s contents must match the number of rows and columns specified in the second line of the file.')
+                history.append(row)
+                yield row
+            else:
+                if len(row) != num_col or not(''.join(row).isdecimal()):
+                    raise AssertionError(message)
+                try:
+                    yield bytes(map(int, row))
+                except ValueError:
+                    raise AssertionError(message)
+        
+        if fobj.readline().split():
+            raise AssertionError(message)
+    finally:
+        fobj.close()
 
-    if not(is_valid_compressed_image(img_matrix)):
-        raise AssertionError('Nested list must be a matrix in compressed PGM image format.')
+
+def read_binary_rows(fobj, num_col, num_row):
+    ''' (file, int, int) -> iterator<bytes>
+    Yields num_row rows of num_col bytes read from the binary file fobj.
+    The file is closed once all rows are read.
+    '''
     
-    num_row = len(img_matrix)
-    num_col = get_num_col_compressed_img(img_matrix)
-    img = 'P2C\n' + str(num_col) + ' ' + str(num_row) + '\n255\n'
+    try:
+        for r in range(num_row):
+            row = fobj.read(num_col)
+            if len(row) != num_col:
+                raise AssertionError('Input must be in PGM image format.')
+            yield row
+    finally:
+        fobj.close()
+
+
+def read_packed_rows(fobj, num_col, num_row, chunk_size=65536):
+    ''' (file, int, int, int) -> iterator<list<str>>
+    Yields num_row rows read from the packed compressed file fobj,
+    reading chunk_size bytes at a time. The file is closed once all rows are read.
+    '''
     
-    for r in range(num_row):
-        img_row = ' '
-        img_row = img_row.join(img_matrix[r])
-        img = img + img_row + '\n'
+    buf = b''
+    i = 0
+    at_end = False
+    # the rows a back-reference can refer to
+    history = collections.deque(maxlen=ROW_REF_WINDOW)
+    
+    try:
+        for r in range(num_row):
+            while True:
+                try:
+                    row, end = unpack_row(buf, i, num_col, history)
+                    break
+                except AssertionError:
+                    # the row may only be cut off by the end of the chunk
+                    if at_end:
+                        raise
+                    chunk = fobj.read(chunk_size)
+                    at_end = not(chunk)
+                    buf = buf[i:] + chunk
+                    i = 0
+            i = end
+            history.append(row)
+            yield row
         
-    fobj = open(filename, 'w')
-    fobj.write(img)
+        if i != len(buf) or fobj.read(1):
+            raise AssertionError('The number of rows and columns of image matrix\'s contents must match the number of rows and columns specified in the second line of the file.')
+    finally:
+        fobj.close()
+
+
+def stream_image(filename):
+    ''' (str) -> ImageStream
+    Opens filename (a 'P2', 'P2C', 'P5' or 'P5C' image) and returns an ImageStream
+    that reads the rows of the image from the file as they are needed.
+    Only the header is read before the stream is returned.
+    
+    >>> save_image([[1, 2, 3], [4, 5, 6]], 'test.pgm')
+    >>> stream = stream_image('test.pgm')
+    >>> stream.width, stream.height, stream.compressed
+    (3, 2, False)
+    >>> [list(row) for row in stream]
+    [[1, 2, 3], [4, 5, 6]]
+    
+    >>> save_image([['0x5', '200x2'], ['111x7']], 'test.pgm.compressed')
+    >>> list(stream_image('test.pgm.compressed'))
+    [['0x5', '200x2'], ['111x7']]
+    
+    >>> save_image([['0x5', '200x2'], ['111x7']], 'test.p5c', 'P5C')
+    >>> list(stream_image('test.p5c'))
+    [['0x5', '200x2'], ['111x7']]
+    '''
+    
+    fobj = open(filename, 'rb')
+    file_type = fobj.readline().split()
+    file_type = file_type[0] if file_type else b''
+    
+    if file_type in [b'P5', b'P5C']:
+        fobj.seek(0)
+        header = fobj.read(1024)
+        num_col, num_row, max_value, offset = read_binary_header(header, file_type)
+        if max_value != 255:
+            fobj.close()
+            raise AssertionError('Input must be in PGM image format.')
+        fobj.seek(offset)
+        if file_type == b'P5C':
+            return ImageStream(num_col, num_row, True, read_packed_rows(fobj, num_col, num_row), True)
+        return ImageStream(num_col, num_row, False, read_binary_rows(fobj, num_col, num_row))
+    
     fobj.close()
+    
+    if file_type == b'P2C':
+        compressed = True
+        message = 'Input must be in a valid compressed PGM image format.'
+    elif file_type == b'P2':
+        compressed = False
+        message = 'Input must be in PGM image format.'
+    else:
+        raise AssertionError('File must be a PGM image or compressed PGM image.')
+    
+    fobj = open(filename, 'r')
+    header = [fobj.readline().split() for i in range(3)]
+    
+    if not(header[2]):
+        fobj.close()
+        raise AssertionError('Input must not be empty.')
+    
+    valid_size = len(header[1]) == 2 and header[1][0].isdecimal() and header[1][1].isdecimal()
+    
+    if not(valid_size and header[2] == ['255']):
+        fobj.close()
+        raise AssertionError(message)
+    
+    num_col = int(header[1][0])
+    num_row = int(header[1][1])
+    
+    return ImageStream(num_col, num_row, compressed, read_text_rows(fobj, num_col, num_row, compressed), compressed)
 
 
-def save_image(img_matrix, filename):
-    '''(<list<list>>) -> NoneType
-    Saves img_matrix as filename.
-    If img_matrix is not a valid compressed PGM image matrix
-    or PGM image matrix, raise an AssertionError.
+def stream_invert(stream):
+    ''' (ImageStream) -> ImageStream
+    Returns a stream where each pixel of stream is subtracted from 255.
+    Compressed rows are inverted run by run.
     
-    >>> save_image([['0x5', '200x2'], ['111x7']], 'test2.pgm.compressed')
-    >>> fobj = open('test2.pgm.compressed', 'r')
-    >>> fobj.read()
-    'P2C\\n7 2\\n255\\n0x5 200x2\\n111x7\\n'
-    >>> fobj.close()
+    >>> stream = ImageStream(2, 1, False, iter([b'\\x00\\x0f']))
+    >>> [list(row) for row in stream_invert(stream)]
+    [[255, 240]]
     
-    >>> save_image([['0x5', '200x2'], ['111x7']], 'test2.txt')
-    >>> fobj = open('test2.txt', 'r')
-    >>> fobj.read()
-    'P2C\\n7 2\\n255\\n0x5 200x2\\n111x7\\n'
-    >>> fobj.close()
+    >>> list(stream_invert(ImageStream(7, 1, True, iter([['0x5', '200x2']]))))
+    [['255x5', '55x2']]
     '''
     
-    if type(img_matrix[0][0]) == int:
-        save_regular_image(img_matrix, filename)
-    elif type(img_matrix[0][0]) == str:
-        save_compressed_image(img_matrix, filename)
+    if stream.compressed:
+        rows = map_compressed_rows(lambda row: invert_compressed([row])[0], stream)
     else:
-        raise AssertionError('The elements of the image matrix must either be strings or integers.')
+        rows = (bytes(row).translate(INVERT_TABLE) for row in stream)
+    
+    return ImageStream(stream.width, stream.height, stream.compressed, rows, stream.dedup)
 
 
-def invert(img_matrix):
-    ''' (<list<list>>) -> <list<list>>
-    Returns a nested list where each element of img_matrix is subtracted from 255.
-    Raises an AssertionError if the input matrix is not a valid PGM image matrix.
+def stream_flip_horizontal(stream):
+    ''' (ImageStream) -> ImageStream
+    Returns a stream where each row of stream is reversed.
+    Compressed rows have their runs reversed.
+    
+    >>> stream = ImageStream(3, 1, False, iter([b'\\x01\\x02\\x03']))
+    >>> [list(row) for row in stream_flip_horizontal(stream)]
+    [[3, 2, 1]]
+    '''
     
-    >>> image = [[0, 100, 150], [200, 200, 200], [255, 255, 255]]
-    >>> invert(image)
-    [[255, 155, 105], [55, 55, 55], [0, 0, 0]]
-    >>> image == [[0, 100, 150], [200, 200, 200], [255, 255, 255]]
-    True
+    if stream.compressed:
+        rows = map_compressed_rows(reverse_compressed_row, stream)
+    else:
+        rows = (bytes(row)[::-1] for row in stream)
     
-    >>> img = [[3, 2, 3], [4, 5, 6], [7, 8, 9]]
-    >>> invert(img)
-    [[252, 253, 252], [251, 250, 249], [248, 247, 246]]
-    >>> img == [[3, 2, 3], [4, 5, 6], [7, 8, 9]]
-    True
+    return ImageStream(stream.width, stream.height, stream.compressed, rows, stream.dedup)
+
+
+STREAM_BUFFER_SIZE = 64 * 1024 * 1024
+
+
+def reverse_rows(rows, buffer_size):
+    ''' (iterator, int) -> iterator
+    Yields rows in reverse order. Rows are kept in memory until they take
+    up more than buffer_size bytes; after that they are spilled to a
+    temporary file which is then read back from the end.
+    '''
     
-    >>> image = [[0, 150], [200, 200, 200], [255, 255, 255]]
-    >>> invert(image)
-    Traceback (most recent call last):
-    AssertionError: Nested list must be a matrix in PGM image format.
+    buffered = []
+    num_bytes = 0
+    spill = None
+    offsets = []
+    
+    for row in rows:
+        if type(row) == list:
+            row = ' '.join(row).encode('ascii')
+            compressed = True
+        else:
+            row = bytes(row)
+            compressed = False
+        
+        if spill is None:
+            buffered.append(row)
+            num_bytes += len(row)
+            if num_bytes > buffer_size:
+                spill = tempfile.TemporaryFile()
+                for buffered_row in buffered:
+                    offsets.append(spill.tell())
+                    spill.write(buffered_row)
+                buffered = []
+        else:
+            offsets.append(spill.tell())
+            spill.write(row)
+    
+    if spill is None:
+        for r in range(len(buffered) - 1, -1, -1):
+            row = buffered.pop(r)
+            yield row.decode('ascii').split() if compressed else row
+        return
+    
+    try:
+        end = spill.tell()
+        for r in range(len(offsets) - 1, -1, -1):
+            spill.seek(offsets[r])
+            row = spill.read(end - offsets[r])
+            end = offsets[r]
+            yield row.decode('ascii').split() if compressed else row
+    finally:
+        spill.close()
+
+
+def stream_flip_vertical(stream, buffer_size=STREAM_BUFFER_SIZE):
+    ''' (ImageStream, int) -> ImageStream
+    Returns a stream with the rows of stream in reverse order.
+    Since the last row comes out first, all rows must be read before
+    the first one is produced: up to buffer_size bytes of rows are held in
+    memory and the rest are spilled to a temporary file.
+    
+    >>> stream = ImageStream(1, 3, False, iter([b'\\x01', b'\\x02', b'\\x03']))
+    >>> [list(row) for row in stream_flip_vertical(stream, buffer_size=1)]
+    [[3], [2], [1]]
+    '''
     
-    >>> image = [[0, 261, 250], [200, 200, 200], [255, 255, 255]]
-    >>> invert(image)
+    rows = reverse_rows(stream, buffer_size)
+    
+    return ImageStream(stream.width, stream.height, stream.compressed, rows, stream.dedup)
+
+
+def stream_rotate_180(stream, buffer_size=STREAM_BUFFER_SIZE):
+    ''' (ImageStream, int) -> ImageStream
+    Returns stream turned by 180 degrees: each row is reversed as it
+    arrives and the rows come out in reverse order, as in stream_flip_vertical.
+    
+    >>> stream = ImageStream(2, 2, False, iter([b'\\x01\\x02', b'\\x03\\x04']))
+    >>> [list(row) for row in stream_rotate_180(stream)]
+    [[4, 3], [2, 1]]
+    '''
+    
+    return stream_flip_vertical(stream_flip_horizontal(stream), buffer_size)
+
+
+def stream_crop(stream, top_left_row, top_left_col, num_row, num_col):
+    ''' (ImageStream, int, int, int, int) -> ImageStream
+    Returns a stream of the num_row x num_col region of stream whose
+    top left corner is at (top_left_row, top_left_col).
+    Rows above the region are skipped and rows below it are never read.
+    
+    >>> stream = ImageStream(3, 3, False, iter([b'abc', b'def', b'ghi']))
+    >>> [bytes(row) for row in stream_crop(stream, 1, 1, 2, 2)]
+    [b'ef', b'hi']
+    
+    >>> stream_crop(ImageStream(3, 3, False, iter([])), 2, 0, 2, 1)
     Traceback (most recent call last):
-    AssertionError: Nested list must be a matrix in PGM image format.
+    AssertionError: The dimensions given must be valid.
     '''
     
-    if not(is_valid_image(img_matrix)):
-        raise AssertionError('Nested list must be a matrix in PGM image format.')
+    valid_num_row = 0 < num_row and top_left_row + num_row <= stream.height
+    valid_num_col = 0 < num_col and top_left_col + num_col <= stream.width
     
-    num_row = len(img_matrix)
-    num_col = len(img_matrix[0])
-    inv_img_matrix = []
+    if not (valid_num_row and valid_num_col):
+        raise AssertionError('The dimensions given must be valid.')
     
-    for r in range(num_row):
-        sub_inv_img_matrix = []
-        for c in range(num_col):
-            num = 255 - img_matrix[r][c]
-            sub_inv_img_matrix.append(num)
-        inv_img_matrix.append(sub_inv_img_matrix)
+    def region_rows():
+        rows = iter(stream)
+        for r in range(top_left_row):
+            next(rows)
+        for r in range(num_row):
+            yield next(rows)
+    
+    if stream.compressed:
+        rows = map_compressed_rows(lambda row: crop_compressed_row(row, top_left_col, num_col), region_rows())
+    else:
+        rows = (bytes(row[top_left_col:top_left_col + num_col]) for row in region_rows())
     
-    return inv_img_matrix
+    return ImageStream(num_col, num_row, stream.compressed, rows, stream.dedup)
 
 
-def flip(img_matrix, direction):
-    ''' (<list<list>>) -> <list<list>>
-    If direction == 'h', returns  the elements of each sublist in img_matrix reversed.
-    If direction is not 'h', returns the order of sublists in img_matrix reversed.
-    Raises an AssertionError if the input matrix is not a valid PGM image matrix.
+def stream_compress(stream, mode='rle'):
+    ''' (ImageStream, str) -> ImageStream
+    Returns a stream of the rows of stream in compressed ('AxB') form.
+    mode is as for compress.
+    
+    >>> stream = ImageStream(3, 1, False, iter([b'\\x05\\x05\\x06']))
+    >>> list(stream_compress(stream))
+    [['5x2', '6x1']]
+    '''
     
-    >>> image = [[1, 2, 3, 4, 5], [0, 0, 5, 10, 10], [5, 5, 5, 5, 5]]
-    >>> flip_vertical(image)
-    [[5, 5, 5, 5, 5], [0, 0, 5, 10, 10], [1, 2, 3, 4, 5]]
+    if stream.compressed:
+        raise AssertionError('Input matrix must be in PGM image format.')
     
-    >>> image = [[1, 2, 3, 4], [0, 0, 5], [5, 5, 5, 5, 5]]
-    >>> flip_vertical(image)
-    Traceback (most recent call last):
-    AssertionError: Input matrix must be in PGM image format.
+    if mode not in ['rle', 'adaptive']:
+        raise AssertionError("Mode must be 'rle' or 'adaptive'.")
     
-    >>> image = [[1, 2, 3, 4, 5], [0, 0, 5, 10, 10], [5, 5, 5, 5, 5]]
-    >>> flip_horizontal(image)
-    [[5, 4, 3, 2, 1], [10, 10, 5, 0, 0], [5, 5, 5, 5, 5]]
+    tokens = RunTokens()
     
-    >>> image = [[1, 2, 3, 4, 'a'], [0, 0, 5, 10, 10], [5, 5, 5, 5, 5]]
-    >>> flip_horizontal(image)
-    Traceback (most recent call last):
-    AssertionError: Input matrix must be in PGM image format.
+    if mode == 'adaptive':
+        rows = (literal_spans(encode_row(row, tokens)) for row in stream)
+    else:
+        rows = (encode_row(row, tokens) for row in stream)
     
-    >>> image = [[1, 2, 3, 4], [0, 0, 5], [5, 5, 5, 5, 5]]
-    >>> flip_horizontal(image)
-    Traceback (most recent call last):
-    AssertionError: Input matrix must be in PGM image format.
+    return ImageStream(stream.width, stream.height, True, rows)
+
+
+def stream_decompress(stream):
+    ''' (ImageStream) -> ImageStream
+    Returns a stream of the rows of the compressed stream as pixels.
+    
+    >>> stream = ImageStream(3, 1, True, iter([['5x2', '6x1']]))
+    >>> [list(row) for row in stream_decompress(stream)]
+    [[5, 5, 6]]
     '''
     
-    if not(is_valid_image(img_matrix)):
-        raise AssertionError('Input matrix must be in PGM image format.')
+    if not(stream.compressed):
+        raise AssertionError('Input matrix must be in compressed PGM image format.')
     
-    num_row = len(img_matrix)
-    new_img_matrix = []
+    rows = map_compressed_rows(lambda row: decompress_row(row, stream.width), stream)
     
-    if direction == 'h':
-        for r in range(num_row):
-            sub_img_matrix = img_matrix[r][::-1]
-            new_img_matrix.append(sub_img_matrix)
+    return ImageStream(stream.width, stream.height, False, rows)
+
+
+def save_stream(stream, filename, img_format=None):
+    ''' (ImageStream, str, str) -> NoneType
+    Writes the rows of stream to filename as they are produced,
+    using write_stream.
+    Compressed streams are saved as 'P2C' images; other streams are saved as
+    'P2' images, or as binary 'P5' images if img_format is 'P5'.
+    If img_format is 'P5C', either kind of stream is saved as a packed
+    compressed image.
+    
+    >>> save_stream(ImageStream(2, 1, False, iter([b'\\x01\\x02'])), 'test.pgm')
+    >>> load_image('test.pgm')
+    [[1, 2]]
+    
+    >>> save_stream(ImageStream(2, 1, False, iter([b'\\x01\\x01'])), 'test.p5c', 'P5C')
+    >>> load_image('test.p5c')
+    [['1x2']]
+    '''
+    
+    write_file(filename, lambda fobj: write_stream(stream, fobj, img_format))
+
+
+def write_stream(stream, fobj, img_format=None):
+    ''' (ImageStream, file, str) -> NoneType
+    Writes the rows of stream to fobj as they are produced, in the format
+    save_stream(stream, filename, img_format) would save.
+    
+    >>> fobj = io.BytesIO()
+    >>> write_stream(ImageStream(2, 1, False, iter([b'\\x01\\x02'])), fobj, 'P5')
+    >>> fobj.getvalue()
+    b'P5\\n2 1\\n255\\n\\x01\\x02'
+    '''
+    
+    if img_format == 'P5C':
+        magic = 'P5C'
+    elif stream.compressed:
+        magic = 'P2C'
+    elif img_format == 'P5':
+        magic = 'P5'
     else:
-        for r in range(num_row):
-            new_img_matrix = img_matrix[::-1]
-            
-    return new_img_matrix
+        magic = 'P2'
+    
+    header = magic + '\n' + str(stream.width) + ' ' + str(stream.height) + '\n255\n'
+    fobj.write(header.encode('ascii'))
+    refs = RowReferences()
+    
+    for row in stream:
+        # shared compressed rows are written as back-references
+        d = refs.distance(row) if stream.compressed and stream.dedup else 0
+        if magic == 'P5':
+            fobj.write(row)
+        elif magic == 'P5C':
+            out = bytearray()
+            if not(stream.compressed):
+                pack_row(row_runs(row), out)
+            elif d > 0 and stream.width > 0:
+                pack_row_reference(d, out)
+            else:
+                pack_row(token_entries(row), out)
+            fobj.write(out)
+        elif magic == 'P2C' and d > 0:
+            fobj.write(('=' + str(d) + '\n').encode('ascii'))
+        elif magic == 'P2C':
+            fobj.write((' '.join(row) + '\n').encode('ascii'))
+        else:
+            fobj.write(b' '.join(map(PIXEL_TEXT.__getitem__, row)) + b'\n')
+    
+    
+def check_capital(elem):
+    ''' (str) -> bool
+    Returns True if all characters are capital letters
+    and False if otherwise.
+    
+    >>> check_capital('ABX')
+    True
+    
+    >>> check_capital('NGONRIFJDPSKC')
+    True
+    
+    >>> check_capital('ABa')
+    False
+    
+    >>> check_capital('D3')
+    False
+    
+    >>> check_capital('fffff')
+    False
+    '''
+    
+    for letter in elem:
+        if not(letter.isupper()):
+            return False
+    return True
 
 
-def flip_horizontal(img_matrix):
-    ''' (<list<list>>) -> <list<list>>
-    Returns  the elements of each sublist in img_matrix reversed.
+def parse_command(cmd):
+    ''' (str) -> list<list>
+    Returns the commands in cmd as a plan: a list of steps, where each step
+    is a list holding the command name followed by its arguments.
+    AssertionError raised if unrecognized command is given, or if the
+    first command is not LOAD.
     
-    >>> image = [[1, 2, 3, 4, 5], [0, 0, 5, 10, 10], [5, 5, 5, 5, 5]]
-    >>> flip_horizontal(image)
-    [[5, 4, 3, 2, 1], [10, 10, 5, 0, 0], [5, 5, 5, 5, 5]]
+    >>> parse_command('LOAD<comp.pgm> INV CR<3,3,4,9> SAVE<comp3.pgm,P5>')
+    [['LOAD', 'comp.pgm'], ['INV'], ['CR', 3, 3, 4, 9], ['SAVE', 'comp3.pgm', 'P5']]
     
-    >>> image = [[1, 2, 3, 4, 'a'], [0, 0, 5, 10, 10], [5, 5, 5, 5, 5]]
-    >>> flip_horizontal(image)
+    >>> parse_command('LOAD<comp.pgm> @P SAVE<comp2.pgm>')
     Traceback (most recent call last):
-    AssertionError: Input matrix must be in PGM image format.
+    AssertionError: Input proper commands: LOAD, SAVE, INV, FH, FV, ROT, CR, CP, or DC.
     
-    >>> image = [[1, 2, 3, 4], [0, 0, 5], [5, 5, 5, 5, 5]]
-    >>> flip_horizontal(image)
+    >>> parse_command('INV SAVE<comp2.pgm>')
     Traceback (most recent call last):
-    AssertionError: Input matrix must be in PGM image format.
+    AssertionError: The first command must be LOAD.
     '''
     
-    new_img_matrix = flip(img_matrix, 'h')
-    
-    return new_img_matrix
-    
-    
-def flip_vertical(img_matrix):
-    ''' (<list<list>>) -> <list<list>>
-    Returns the order of sublists in img_matrix reversed.
-    
-    >>> image = [[1, 2, 3, 4, 5], [0, 0, 5, 10, 10], [5, 5, 5, 5, 5]]
-    >>> flip_vertical(image)
-    [[5, 5, 5, 5, 5], [0, 0, 5, 10, 10], [1, 2, 3, 4, 5]]
+    cmd_list = ['LOAD', 'SAVE', 'INV', 'FH', 'FV', 'CR', 'CP', 'DC', 'ROT']
+    cmd = cmd.replace('<', ' <')
+    cmd = cmd.replace(',', ' ')
+    cmd = cmd.split()
+    plan = []
+    i = 0
     
-    >>> image = [[1, 2, 3, 4], [0, 0, 5], [5, 5, 5, 5, 5]]
-    >>> flip_vertical(image)
-    Traceback (most recent call last):
-    AssertionError: Input matrix must be in PGM image format.
-    '''
+    while i < len(cmd):
+        elem = cmd[i]
+        is_upper = check_capital(elem)
+        
+        if not(is_upper) or elem not in cmd_list:
+            raise AssertionError('Input proper commands: LOAD, SAVE, INV, FH, FV, ROT, CR, CP, or DC.')
+        
+        if elem == 'LOAD':
+            plan.append(['LOAD', cmd[i + 1][1:-1]])
+            i += 1
+        
+        elif elem == 'CR':
+            top_left_row = int((cmd[i + 1])[1:])        # gets rid of '<' and converts to int
+            top_left_col = int(cmd[i + 2])
+            num_row = int(cmd[i + 3])
+            num_col = int(cmd[i + 4][:-1])
+            plan.append(['CR', top_left_row, top_left_col, num_row, num_col])
+            i += 4
+        
+        elif elem == 'SAVE':
+            if cmd[i + 1].endswith('>'):
+                plan.append(['SAVE', cmd[i + 1][1:-1], None])
+            else:
+                plan.append(['SAVE', cmd[i + 1][1:], cmd[i + 2][:-1]])
+                i += 1
+            i += 1
+        
+        else:
+            plan.append([elem])
+        
+        i += 1
     
-    new_img_matrix = flip(img_matrix, 'v')
+    # every other step works on the image of a LOAD before it
+    if plan and plan[0][0] != 'LOAD':
+        raise AssertionError('The first command must be LOAD.')
     
-    return new_img_matrix
-
+    return plan
 
-def crop(img_matrix, top_left_row, top_left_col, num_row, num_col):
-    ''' (list<list>) -> <list<list>>
-    Returns a nested list of integers at indices top_left_row to num_row
-    and top_left_col to num_col of img_matrix.
 
-    >>> crop([[5, 5, 5], [5, 6, 6], [6, 6, 7]], 1, 1, 2, 2)
-    [[6, 6], [6, 7]]
-    
-    >>> crop([[1, 2, 3, 4], [4, 5, 6, 7], [8, 9, 10, 11]], 1, 2, 2, 1)
-    [[6], [10]]
+def format_plan(plan):
+    ''' (list<list>) -> str
+    Returns plan written as a command string.
     
-    >>> crop([[1, 2, 3, 4], [4, 5, 6, 7], [8, 9, 10, 11]], 0, 0, 3, 4)
-    [[1, 2, 3, 4], [4, 5, 6, 7], [8, 9, 10, 11]]
+    >>> format_plan([['LOAD', 'comp.pgm'], ['CR', 3, 3, 4, 9], ['ROT'], ['SAVE', 'comp3.pgm', None]])
+    'LOAD<comp.pgm> CR<3,3,4,9> ROT SAVE<comp3.pgm>'
     '''
     
-    if not(is_valid_image(img_matrix)):
-        raise AssertionError('Input matrix must be in PGM image format.')
-    
-    num_row = top_left_row + num_row
-    num_col = top_left_col + num_col
-    valid_num_row = num_row <= len(img_matrix)
-    valid_num_col = num_col <= len(img_matrix[0])
-    
-    if not (valid_num_row and valid_num_col):
-        raise AssertionError('The dimensions given must be valid.')
+    words = []
     
-    new_img_matrix = []
+    for step in plan:
+        if step[0] == 'SAVE' and step[2] is not None:
+            words.append('SAVE<' + step[1] + ',' + step[2] + '>')
+        elif len(step) > 1:
+            words.append(step[0] + '<' + ','.join(str(arg) for arg in step[1:] if arg is not None) + '>')
+        else:
+            words.append(step[0])
     
-    for r in range(top_left_row, num_row):
-        sub_new_img_matrix = []
-        for c in range(top_left_col, num_col):
-            sub_new_img_matrix.append(img_matrix[r][c])
-        new_img_matrix.append(sub_new_img_matrix)
+    return ' '.join(words)
 
-    return new_img_matrix
+
+def fuse_steps(steps, size):
+    ''' (list<list>, list<int>) -> list
+    Rewrites a sequence of INV, FH, FV, ROT and CR steps applied to an image
+    of size [num_row, num_col] (or None if the size is not known) into at
+    most one CR, one flip (FH, FV or ROT) and one INV, in that order, so the
+    crop is taken from the source before anything else touches the pixels.
+    Returns [new_steps, new_size].
+    AssertionError raised if a crop does not fit in the image.
+    
+    >>> fuse_steps([['INV'], ['FH'], ['INV'], ['FV']], [7, 24])
+    [[['ROT']], [7, 24]]
+    
+    >>> fuse_steps([['FH'], ['CR', 1, 2, 3, 4]], [7, 24])
+    [[['CR', 1, 18, 3, 4], ['FH']], [3, 4]]
+    
+    >>> fuse_steps([['CR', 1, 1, 5, 5], ['CR', 1, 1, 2, 2]], None)
+    [[['CR', 2, 2, 2, 2]], [2, 2]]
+    
+    >>> fuse_steps([['FH'], ['FH']], None)
+    [[], None]
+    '''
+    
+    new_steps = []
+    window = None           # [top, left, num_row, num_col] of the source
+    flip_h = False
+    flip_v = False
+    inverted = False
+    
+    for step in steps:
+        if step[0] == 'INV':
+            inverted = not(inverted)
+        elif step[0] == 'FH':
+            flip_h = not(flip_h)
+        elif step[0] == 'FV':
+            flip_v = not(flip_v)
+        elif step[0] == 'ROT':
+            flip_h = not(flip_h)
+            flip_v = not(flip_v)
+        else:
+            top_left_row, top_left_col, num_row, num_col = step[1:]
+            curr_size = window[2:] if window else size
+            
+            if curr_size is None:
+                # without the size, a crop cannot be moved before the flips
+                if flip_h and flip_v:
+                    new_steps.append(['ROT'])
+                elif flip_h:
+                    new_steps.append(['FH'])
+                elif flip_v:
+                    new_steps.append(['FV'])
+                flip_h = False
+                flip_v = False
+                window = [top_left_row, top_left_col, num_row, num_col]
+                continue
+            
+            valid_num_row = 0 < num_row and top_left_row + num_row <= curr_size[0]
+            valid_num_col = 0 < num_col and top_left_col + num_col <= curr_size[1]
+            
+            if not (valid_num_row and valid_num_col):
+                raise AssertionError('The dimensions given must be valid.')
+            
+            if flip_v:
+                top_left_row = curr_size[0] - top_left_row - num_row
+            if flip_h:
+                top_left_col = curr_size[1] - top_left_col - num_col
+            if window:
+                top_left_row += window[0]
+                top_left_col += window[1]
+            
+            window = [top_left_row, top_left_col, num_row, num_col]
+    
+    if window and (size is None or window != [0, 0] + size):
+        new_steps.append(['CR'] + window)
+    if flip_h and flip_v:
+        new_steps.append(['ROT'])
+    elif flip_h:
+        new_steps.append(['FH'])
+    elif flip_v:
+        new_steps.append(['FV'])
+    if inverted:
+        new_steps.append(['INV'])
+    
+    return [new_steps, window[2:] if window else size]
 
 
-def find_end_of_repetition(int_list, ind, target_num):
-    ''' (<list<int>>) -> int
-    Looks through int_list starting after ind.
-    Returns the index of the last consecutive occurrence of the target_num.
+def optimize_plan(plan):
+    ''' (list<list>) -> list<list>
+    Returns a plan that gives the same results as plan with fewer passes
+    over the pixels: INV INV, FH FH and FV FV cancel out, FH FV becomes a
+    single ROT, crops are merged and moved before flips and inversions
+    (so they are taken from the source image), and CP directly followed by
+    DC on a regular image is dropped. Image sizes are read from the headers of the loaded files.
+    
+    >>> save_image([[0] * 24] * 7, 'test.pgm')
+    >>> plan = parse_command('LOAD<test.pgm> INV FH CR<1,1,3,4> FV INV CP DC SAVE<out.pgm>')
+    >>> format_plan(optimize_plan(plan))
+    'LOAD<test.pgm> CR<1,19,3,4> ROT SAVE<out.pgm>'
+    
+    >>> save_image([['0x24']] * 7, 'test.pgm.compressed')
+    >>> format_plan(optimize_plan(parse_command('LOAD<test.pgm.compressed> CP DC SAVE<out.pgm>')))
+    'LOAD<test.pgm.compressed> CP DC SAVE<out.pgm>'
+    '''
     
-    >>> find_end_of_repetition([5, 3, 5, 5, 5, -1, 0], 2, 5)
-    4
+    new_plan = []
+    saved_sizes = {}
+    saved_compressed = {}
+    size = None
+    # whether the image is compressed, or None if that is not known, and
+    # whether the last CP was run on a regular image
+    compressed = None
+    regular_cp = False
+    steps = []
+    
+    for step in plan + [['END']]:
+        if step[0] in ['INV', 'FH', 'FV', 'ROT', 'CR']:
+            steps.append(step)
+            continue
+        
+        fused_steps, size = fuse_steps(steps, size)
+        new_plan += fused_steps
+        steps = []
+        
+        if step[0] == 'LOAD':
+            if step[1] in saved_sizes:
+                size = saved_sizes[step[1]]
+                compressed = saved_compressed[step[1]]
+            else:
+                try:
+                    header = read_image_header(step[1])
+                    size = header[1:]
+                    compressed = header[0] in ['P2C', 'P5C']
+                except (OSError, AssertionError):
+                    size = None
+                    compressed = None
+        elif step[0] == 'SAVE':
+            saved_sizes[step[1]] = size
+            saved_compressed[step[1]] = True if step[2] == 'P5C' else compressed
+        elif step[0] == 'CP':
+            regular_cp = compressed is False
+            compressed = True
+        elif step[0] == 'DC' and new_plan and new_plan[-1] == ['CP'] and regular_cp:
+            # CP DC gives back the same regular image; on a compressed
+            # image CP raises an AssertionError, so it is kept
+            new_plan.pop()
+            compressed = False
+            continue
+        elif step[0] == 'DC':
+            compressed = False
+        elif step[0] == 'END':
+            break
+        
+        new_plan.append(step)
     
-    >>> find_end_of_repetition([1, 2, 3, 4, 5, 6, 7], 6, 7)
-    6
+    return new_plan
+
+
+def file_digest(filename):
+    ''' (str) -> str
+    Returns the SHA-256 hash of the contents of filename, in hexadecimal.
     
-    >>> find_end_of_repetition([1, 1, 1, 1, 1, 1], 0, 1)
-    5
+    >>> save_image([[1, 2], [3, 4]], 'test.p5.pgm', 'P5')
+    >>> file_digest('test.p5.pgm')[:16]
+    '41ef39e057f0ecb3'
     '''
     
-    num_elem = len(int_list)
+    digest = hashlib.sha256()
+    fobj = open(filename, 'rb')
     
-    for i in range(ind, num_elem):
-        last_occur = i
-        if int_list[i] != target_num:
-            last_occur = i - 1
-            break
+    for chunk in iter(lambda: fobj.read(IO_CHUNK_SIZE), b''):
+        digest.update(chunk)
     
-    return last_occur
+    fobj.close()
+    
+    return digest.hexdigest()
 
 
-def compress(img_matrix):
-    ''' (list<list<int>>) -> <list<list<str>>>
-    Returns img_matrix with repeated integers in the form 'AxB'.
-    
-    >>> compress([[11, 11, 11, 11, 11], [1, 5, 5, 5, 7], [255, 255, 255, 0, 255]])
-    [['11x5'], ['1x1', '5x3', '7x1'], ['255x3', '0x1', '255x1']]
-    
+class ResultCache:
+    ''' An on-disk cache of the images made by process_command.
+    An image is stored under a key made from the hash of the contents of
+    the file it was loaded from and the steps run on it since, so the same
+    steps on the same pixels are found again whatever the file is called.
+    Images are stored as binary PGM ('P5') files and compressed images as
+    packed compressed PGM ('P5C') files in directory. When the files take
+    more than max_bytes, the least recently used ones are removed.
+    
+    >>> cache = ResultCache(tempfile.mkdtemp())
+    >>> key = cache.key(file_digest('comp3.pgm'), [['INV']])
+    >>> cache.get(key) is None
+    True
+    >>> cache.put(key, Image.from_matrix([[1, 2]]))
+    >>> cache.get(key).to_matrix()
+    [[1, 2]]
+    >>> cache.hits, cache.misses
+    (1, 1)
+    '''
     
-    >>> compress([[5, 5, 5], [1, 2, 3], [4, 6, 5]])
-    [['5x3'], ['1x1', '2x1', '3x1'], ['4x1', '6x1', '5x1']]
+    __slots__ = ('directory', 'max_bytes', 'hits', 'misses')
     
-    >>> compress([[5, 5, 5, 6], [4, 4, 7, 8], [2, 2, 22, 4]])
-    [['5x3', '6x1'], ['4x2', '7x1', '8x1'], ['2x2', '22x1', '4x1']]
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        ''' (ResultCache, str, int) -> NoneType
+        Creates a cache in directory, which is made if it does not exist.
+        '''
+        
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+    
+    def key(self, digest, steps):
+        ''' (ResultCache, str, list<list>) -> str
+        Returns the key of the image made by running steps on the image
+        loaded from a file whose contents hash to digest.
+        '''
+        
+        return hashlib.sha256((digest + ' ' + format_plan(steps)).encode('utf-8')).hexdigest()
     
-    >>> compress([['11x5'], ['1x1', '5x3', '7x1'], ['255x3', '0x1', '255x1']])
-    Traceback (most recent call last):
-    AssertionError: Input matrix must be in PGM image format.
+    def get(self, key):
+        ''' (ResultCache, str) -> Image or list<list<str>> or NoneType
+        Returns the image stored under key, or None if there is none.
+        '''
+        
+        for extension in ['.p5', '.p5c']:
+            path = os.path.join(self.directory, key + extension)
+            try:
+                img_matrix = load_image(path, True)
+                os.utime(path)
+            except (OSError, AssertionError):
+                continue
+            self.hits += 1
+            return img_matrix
+        
+        self.misses += 1
+        return None
+    
+    def put(self, key, img_matrix):
+        ''' (ResultCache, str, Image or list<list<str>>) -> NoneType
+        Stores img_matrix under key, then evicts images until the cache
+        fits in max_bytes. An image larger than max_bytes is not stored.
+        The file is written under a temporary name and renamed, so other
+        processes sharing the cache never see half of it.
+        '''
+        
+        compressed = not(isinstance(img_matrix, Image)) and type(img_matrix[0][0]) == str
+        extension = '.p5c' if compressed else '.p5'
+        fd, temp_name = tempfile.mkstemp('.tmp', '', self.directory)
+        os.close(fd)
+        
+        try:
+            save_image(img_matrix, temp_name, 'P5C' if compressed else 'P5')
+            if os.path.getsize(temp_name) > self.max_bytes:
+                return
+            os.replace(temp_name, os.path.join(self.directory, key + extension))
+        finally:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+        
+        self.evict()
     
-    >>> compress([[5, 5, 5, 6], [4, 4, 7, 8], [2, 2, 2222, 4]])
-    Traceback (most recent call last):
-    AssertionError: Input matrix must be in PGM image format.
+    def evict(self):
+        ''' (ResultCache) -> NoneType
+        Removes the least recently used images until the cache takes at
+        most max_bytes.
+        '''
+        
+        entries = []
+        
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(('.p5', '.p5c')):
+                stat = entry.stat()
+                entries.append([stat.st_mtime, stat.st_size, entry.path])
+        
+        total = sum(entry[1] for entry in entries)
+        
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def cached_prefix(cache, digest, done, plan, i):
+    ''' (ResultCache, str, list<list>, list<list>, int) -> list or NoneType
+    Looks for the longest run of image steps plan[i:end], stopping before
+    any LOAD or SAVE, whose result after the steps done is in cache.
+    Returns [img_matrix, end], or None if no such result is cached.
     '''
     
-    if not(is_valid_image(img_matrix)):
-        raise AssertionError('Input matrix must be in PGM image format.')
+    end = i
     
-    num_row = len(img_matrix)
-    num_col = len(img_matrix[0])
-    comp_img_matrix = []
+    while end < len(plan) and plan[end][0] not in ['LOAD', 'SAVE']:
+        end += 1
     
-    for r in range(num_row):
-        comp_row = []
-        c = 0
-        while c < num_col:
-            target_num = img_matrix[r][c]
-            last_occur = find_end_of_repetition(img_matrix[r], c, target_num)
-            num_occur = last_occur - c + 1
-            comp_row_elem = str(target_num) + 'x' + str(num_occur)
-            comp_row.append(comp_row_elem)
-            c += num_occur
-        comp_img_matrix.append(comp_row)
-            
-    return comp_img_matrix
+    for k in range(end, i, -1):
+        img_matrix = cache.get(cache.key(digest, done + plan[i:k]))
+        if img_matrix is not None:
+            return [img_matrix, k]
+    
+    return None
 
 
-def decompress(comp_img_matrix):
-    ''' (<list<list<str>>>) -> <list<list<int>>>
-    >>> decompress([['11x5'], ['1x1', '5x3', '7x1'], ['255x3', '0x1', '255x1']])
-    [[11, 11, 11, 11, 11], [1, 5, 5, 5, 7], [255, 255, 255, 0, 255]]
-    
-    >>> image = [[11, 11, 11, 11, 11], [1, 5, 5, 5, 7], [255, 255, 255, 0, 255]]
-    >>> compressed_image = compress(image)
-    >>> image2 = decompress(compressed_image)
-    >>> image == image2
-    True
+class StageProfiler:
+    ''' Collects what each stage of a plan run by process_command costs:
+    wall and CPU time, the pixels (and, for compressed images, runs) that
+    went into the stage, the size of the file loaded or saved and, if
+    trace_memory is True, the most memory allocated at once (through
+    tracemalloc, which slows everything down while it is on).
+    Each record is a dict; callback, if given, is called with each record
+    as soon as its stage ends. Consecutive steps that run as one pass
+    (see execute_plan) are one stage.
+    In streaming mode rows are only made when they are saved, so nearly
+    all of the work is recorded against SAVE.
+    
+    >>> profiler = StageProfiler()
+    >>> process_command('LOAD<comp.pgm> INV FH CP SAVE<comp8.pgm>', profiler=profiler)
+    >>> [[record['stage'], record['pixels'], record['runs']] for record in profiler.records]
+    [['LOAD<comp.pgm>', 168, None], ['FH INV', 168, None], ['CP', 168, None], ['SAVE<comp8.pgm>', 168, 71]]
     '''
     
-    if not(is_valid_compressed_image(comp_img_matrix)):
-        raise AssertionError('Input matrix must be in compressed PGM image format.')
-
-    num_row = len(comp_img_matrix)
-    img_matrix = []
+    __slots__ = ('records', 'callback', 'trace_memory')
     
-    for r in range(num_row):
-        num_col = len(comp_img_matrix[r])
-        row = []
-        for c in range(num_col):
-            elem = comp_img_matrix[r][c].split('x')
-            a = int(elem[0])
-            b = int(elem[1])
-            row_elem = [a] * b
-            row += row_elem
-        img_matrix.append(row)
+    def __init__(self, callback=None, trace_memory=False):
+        ''' (StageProfiler, function, bool) -> NoneType
+        Creates a profiler with no records.
+        '''
         
-    return img_matrix
-    
+        self.records = []
+        self.callback = callback
+        self.trace_memory = trace_memory
+    
+    def start(self, img_matrix):
+        ''' (StageProfiler, Image or list<list> or ImageStream) -> list
+        Starts timing a stage whose input is img_matrix (None for LOAD).
+        Returns what stop needs to finish the record.
+        '''
+        
+        started_tracing = False
+        
+        if self.trace_memory:
+            started_tracing = not(tracemalloc.is_tracing())
+            if started_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        
+        size = None if img_matrix is None else image_size(img_matrix)
+        
+        return [time.perf_counter(), time.process_time(), size, started_tracing]
     
-def check_capital(elem):
-    ''' (str) -> bool
-    Returns True if all characters are capital letters
-    and False if otherwise.
+    def stop(self, token, steps, img_matrix):
+        ''' (StageProfiler, list, list<list>, Image or list<list> or ImageStream) -> NoneType
+        Finishes the record of the stage started by start, which ran steps
+        and made img_matrix.
+        '''
+        
+        wall_seconds = time.perf_counter() - token[0]
+        cpu_seconds = time.process_time() - token[1]
+        peak_bytes = None
+        
+        if self.trace_memory:
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            if token[3]:
+                tracemalloc.stop()
+        
+        pixels, runs = token[2] if token[2] is not None else image_size(img_matrix)
+        num_bytes = None
+        
+        if steps[0][0] == 'LOAD':
+            num_bytes = os.path.getsize(steps[0][1])
+        elif steps[-1][0] == 'SAVE':
+            num_bytes = os.path.getsize(steps[-1][1])
+        
+        record = {'stage': format_plan(steps), 'wall_seconds': wall_seconds, 'cpu_seconds': cpu_seconds,
+                  'pixels': pixels, 'runs': runs, 'bytes': num_bytes, 'peak_bytes': peak_bytes}
+        self.records.append(record)
+        
+        if self.callback is not None:
+            self.callback(record)
     
-    >>> check_capital('ABX')
-    True
+    def json_lines(self):
+        ''' (StageProfiler) -> str
+        Returns the records as JSON, one record per line.
+        '''
+        
+        return ''.join(json.dumps(record, sort_keys=True) + '\n' for record in self.records)
     
-    >>> check_capital('NGONRIFJDPSKC')
-    True
+    def summary(self):
+        ''' (StageProfiler) -> str
+        Returns the records as a table, with the share of the total wall
+        time taken by each stage.
+        
+        >>> profiler = StageProfiler()
+        >>> profiler.records.append({'stage': 'INV', 'wall_seconds': 0.25, 'cpu_seconds': 0.25,
+        ...                          'pixels': 100, 'runs': None, 'bytes': None, 'peak_bytes': None})
+        >>> print(profiler.summary())
+        stage                      wall ms   cpu ms      %       pixels       runs        bytes   peak MB
+        INV                          250.0    250.0  100.0          100          -            -         -
+        '''
+        
+        total = sum(record['wall_seconds'] for record in self.records) or 1
+        lines = ['%-24s %9s %8s %6s %12s %10s %12s %9s' % ('stage', 'wall ms', 'cpu ms', '%', 'pixels', 'runs', 'bytes', 'peak MB')]
+        
+        for record in self.records:
+            cells = []
+            for key, width in [['pixels', 12], ['runs', 10], ['bytes', 12]]:
+                cells.append(('%' + str(width) + 's') % ('-' if record[key] is None else record[key]))
+            peak = '-' if record['peak_bytes'] is None else '%.1f' % (record['peak_bytes'] / 1024 / 1024)
+            lines.append('%-24s %9.1f %8.1f %6.1f %s %9s' % (
+                record['stage'][:24], record['wall_seconds'] * 1000, record['cpu_seconds'] * 1000,
+                100 * record['wall_seconds'] / total, ' '.join(cells), peak))
+        
+        return '\n'.join(lines)
+
+
+def image_size(img_matrix):
+    ''' (Image or list<list> or ImageStream) -> list
+    Returns [pixels, runs] of img_matrix, where runs is None unless
+    img_matrix is a compressed image matrix.
+    
+    >>> image_size([['0x5', '200x2'], ['111x7']])
+    [14, 3]
+    >>> image_size(Image(3, 2))
+    [6, None]
+    '''
     
-    >>> check_capital('ABa')
-    False
+    if isinstance(img_matrix, (Image, ImageStream)):
+        return [img_matrix.width * img_matrix.height, None]
     
-    >>> check_capital('D3')
-    False
+    if len(img_matrix) > 0 and type(img_matrix[0][0]) == str:
+        return [len(img_matrix) * get_num_col_compressed_img(img_matrix), sum(map(len, img_matrix))]
     
-    >>> check_capital('fffff')
-    False
+    return [len(img_matrix) * len(img_matrix[0]) if img_matrix else 0, None]
+
+
+def execute_plan(plan, streaming=False, cache=None, image_cache=None, profiler=None):
+    ''' (list<list>, bool, ResultCache, ImageCache, StageProfiler) -> NoneType
+    Runs each step of plan, as described in process_command.
+    Consecutive INV, FH, FV, ROT and CR steps on a regular image are run
+    together by fused_transform, in one pass over the pixels.
+    If cache is given (and streaming is False), the longest cached prefix
+    of the steps after each LOAD and SAVE is loaded instead of being run,
+    and the image made by each step is stored in cache, so steps are run
+    one at a time and a plan that shares only its first steps with an
+    earlier one, or that failed part way, still starts from cached images.
+    If image_cache is given (and streaming is False), LOAD goes through it.
+    If profiler is given, each stage is recorded in it.
     '''
     
-    for letter in elem:
-        if not(letter.isupper()):
-            return False
-    return True
+    img_matrix = None
+    # the hash of the last loaded file and the steps run on it since
+    digest = None
+    done = []
+    checked = False
+    
+    if streaming:
+        cache = None
+        load, save = stream_image, save_stream
+        operations = {'INV': stream_invert, 'FH': stream_flip_horizontal, 'FV': stream_flip_vertical,
+                      'ROT': stream_rotate_180, 'CR': stream_crop, 'CP': stream_compress, 'DC': stream_decompress}
+    else:
+        load, save = load_image, save_image
+        operations = {'INV': invert, 'FH': flip_horizontal, 'FV': flip_vertical, 'ROT': rotate_180,
+                      'CR': crop, 'CP': compress, 'DC': decompress}
+        compressed_operations = {'INV': invert_compressed, 'FH': flip_horizontal_compressed,
+                                 'FV': flip_vertical_compressed, 'ROT': rotate_180_compressed,
+                                 'CR': crop_compressed}
+    
+    i = 0
+    
+    while i < len(plan):
+        step = plan[i]
+        elem = step[0]
+        start = i
+        first = i
+        
+        if profiler is not None:
+            profile = profiler.start(None if elem == 'LOAD' else img_matrix)
+        
+        # before the first step after each LOAD or SAVE, skip as many steps
+        # as the cache has the result of
+        if cache is not None and elem != 'SAVE' and (elem == 'LOAD' or not(checked) and digest is not None):
+            if elem == 'LOAD':
+                digest = file_digest(step[1])
+                done = []
+                start = i + 1
+            checked = True
+            hit = cached_prefix(cache, digest, done, plan, start)
+            if hit is not None:
+                img_matrix, i = hit
+                done = done + plan[start:i]
+                if profiler is not None:
+                    profiler.stop(profile, plan[first:i], img_matrix)
+                continue
+            start = i
+        
+        # compressed images are transformed run by run
+        ops = operations
+        if not(streaming) and elem in compressed_operations and isinstance(img_matrix, list) and type(img_matrix[0][0]) == str:
+            ops = compressed_operations
+        
+        if elem == 'LOAD':
+            curr_file = step[1]
+            if not(streaming) and i + 1 < len(plan) and plan[i + 1][0] == 'CR' and load_row_index(curr_file) is not None:
+                # an indexed compressed file only needs the cropped rows read
+                img_matrix = crop_compressed_file(curr_file, *plan[i + 1][1:])
+                i += 1
+            elif streaming:
+                img_matrix = load(curr_file)
+            else:
+                img_matrix = load(curr_file, as_image=True, cache=image_cache)
+        
+        elif elem in ['INV', 'FH', 'FV', 'ROT', 'CR'] and isinstance(img_matrix, Image):
+            end = i + 1
+            while cache is None and end < len(plan) and plan[end][0] in ['INV', 'FH', 'FV', 'ROT', 'CR']:
+                end += 1
+            img_matrix = fused_transform(img_matrix, plan[i:end])
+            i = end - 1
+        
+        elif elem == 'DC' and not(streaming):
+            img_matrix = decompress(img_matrix, as_image=True)
+        
+        elif elem == 'CR':
+            img_matrix = ops['CR'](img_matrix, *step[1:])
+        
+        elif elem == 'SAVE':
+            save(img_matrix, step[1], step[2])
+            if streaming and i + 1 < len(plan) and plan[i + 1][0] != 'LOAD':
+                # saving used up the stream, so the next steps read the
+                # rows back from the file, in the form they had
+                compressed = img_matrix.compressed
+                img_matrix = load(step[1])
+                if img_matrix.compressed and not(compressed):
+                    img_matrix = stream_decompress(img_matrix)
+            checked = False
+        
+        else:
+            img_matrix = ops[elem](img_matrix)
+        
+        if cache is not None and elem != 'SAVE' and digest is not None:
+            done = done + [done_step for done_step in plan[start:i + 1] if done_step[0] != 'LOAD']
+            if len(done) > 0:
+                cache.put(cache.key(digest, done), img_matrix)
+        
+        if profiler is not None:
+            profiler.stop(profile, plan[first:i + 1], img_matrix)
+        
+        i += 1
 
 
-def process_command(cmd):
-    ''' (str) -> NoneType
+def process_command(cmd, streaming=False, optimize=True, explain=False, cache=None, image_cache=None, profiler=None):
+    ''' (str, bool, bool, bool, ResultCache, ImageCache, StageProfiler) -> NoneType
     Uses the corresponding commands in cmd to call functions.
     'LOAD<x.pgm>' calls load_image(x.pgm), giving img_matrix.
     'INV' calls invert(img_matrix).
     'FH' calls flip_horizontal(img_matrix).
     'FV' calls flip_vertical(img_matrix).
     'CR<>y,x,h,w> calls crop(img_matrix, top_left_row, top_left_col, num_row, num_col).
+    INV, FH, FV and CR work on compressed images without decompressing them,
+    through invert_compressed, flip_horizontal_compressed,
+    flip_vertical_compressed and crop_compressed.
+    'LOAD<x>' directly followed by 'CR<y,x,h,w>' calls crop_compressed_file
+    if x is a compressed image with a row index, reading only the cropped rows.
     'CP' calls compress(img_matrix).
     'DC' calls decompress(img_matrix.)
     'SAVE<x.pgm>' calls save_image(x.pgm).
+    'SAVE<x.pgm,P5>' calls save_image(x.pgm, 'P5').
+    If streaming is True, LOAD returns an ImageStream, each command becomes
+    a stage that processes one row at a time and SAVE writes rows as they
+    arrive, so images do not have to fit in memory. The steps after a SAVE
+    read the saved rows back from its file.
+    cmd is first parsed into a plan by parse_command. Unless optimize is False,
+    the plan is then rewritten by optimize_plan so that commands that cancel
+    out or can be combined cost as few passes over the image as possible.
+    If explain is True, or cmd starts with 'EXPLAIN', the plan that would be
+    run is printed instead of being run.
+    If cache is a ResultCache, the image made by each step is stored in it,
+    and steps whose result on the same input pixels is already in it are
+    skipped (see execute_plan). The cache is not used when streaming.
+    If image_cache is an ImageCache, LOAD takes unchanged files from it
+    instead of reading them again (see load_image).
+    If profiler is a StageProfiler, the time, size and memory of each stage
+    of the plan are recorded in it.
     AssertionError raised if unrecognized command is given
     
     >>> process_command('LOAD<comp.pgm> CP SAVE<comp.pgm.compressed>')
@@ -854,7 +4534,7 @@ def process_command(cmd):
     
     >>> process_command('LOAD<dragon.pgm> FH FV I SAVE<dragonfhfvi.pgm>')
     Traceback (most recent call last):
-    AssertionError: Input proper commands: LOAD, SAVE, INV, FH, FV, CR, CP, or DC.
+    AssertionError: Input proper commands: LOAD, SAVE, INV, FH, FV, ROT, CR, CP, or DC.
     
     >>> process_command('LOAD<dragon.pgm> FH FV INV SAVE<dragonfhfvi.pgm>')
     >>> process_command('LOAD<dragonfhfvi.pgm> FH FV INV SAVE<dragonundo1.pgm>')
@@ -869,68 +4549,77 @@ def process_command(cmd):
     
     >>> process_command('LOAD<comp.pgm> CP DC INd INV SAVE<comp2.pgm>')
     Traceback (most recent call last):
-    AssertionError: Input proper commands: LOAD, SAVE, INV, FH, FV, CR, CP, or DC.
+    AssertionError: Input proper commands: LOAD, SAVE, INV, FH, FV, ROT, CR, CP, or DC.
     
     >>> process_command('LOAD<comp.pgm> CP 1C INd INV SAVE<comp2.pgm>')
     Traceback (most recent call last):
-    AssertionError: Input proper commands: LOAD, SAVE, INV, FH, FV, CR, CP, or DC.
+    AssertionError: Input proper commands: LOAD, SAVE, INV, FH, FV, ROT, CR, CP, or DC.
     
     >>> process_command('LOAD<comp.pgm> @P 1C INd INV SAVE<comp2.pgm>')
     Traceback (most recent call last):
-    AssertionError: Input proper commands: LOAD, SAVE, INV, FH, FV, CR, CP, or DC.
+    AssertionError: Input proper commands: LOAD, SAVE, INV, FH, FV, ROT, CR, CP, or DC.
     
     >>> process_command('load<comp.pgm> cp save<comp.pgm.compressed>')
     Traceback (most recent call last):
-    AssertionError: Input proper commands: LOAD, SAVE, INV, FH, FV, CR, CP, or DC.
+    AssertionError: Input proper commands: LOAD, SAVE, INV, FH, FV, ROT, CR, CP, or DC.
+    
+    >>> cache = ResultCache(tempfile.mkdtemp())
+    >>> process_command('LOAD<comp.pgm> FH CP SAVE<comp6.pgm>', cache=cache)
+    >>> process_command('LOAD<comp.pgm> FH CP INV SAVE<comp7.pgm>', cache=cache)
+    >>> cache.hits, cache.misses
+    (1, 3)
+    >>> load_image('comp7.pgm') == invert_compressed(load_image('comp6.pgm'))
+    True
+    >>> process_command('LOAD<comp.pgm> FH INV SAVE<comp8.pgm>', cache=cache)
+    >>> cache.hits, cache.misses
+    (2, 4)
+    
+    >>> process_command('LOAD<comp3.pgm> INV SAVE<comp3inv.pgm,P5>')
+    >>> load_image('comp3inv.pgm')[0][4]
+    136
+    
+    >>> process_command('LOAD<comp.pgm> CR<1,1,3,22> FH FV INV SAVE<comp4.pgm>')
+    >>> process_command('LOAD<comp.pgm> CR<1,1,3,22> FH FV INV SAVE<comp5.pgm>', streaming=True)
+    >>> load_image('comp4.pgm') == load_image('comp5.pgm')
+    True
+    
+    >>> process_command('LOAD<comp.pgm> CR<0,0,3,0> CP SAVE<comp5.pgm>')
+    Traceback (most recent call last):
+    AssertionError: The dimensions given must be valid.
+    
+    >>> process_command('LOAD<comp.pgm> CR<1,1,3,22> SAVE<comp5.pgm,P5C> FH FV INV SAVE<comp6.pgm>', streaming=True)
+    >>> load_image('comp4.pgm') == load_image('comp6.pgm')
+    True
+    
+    >>> process_command('LOAD<comp.pgm.compressed> CR<1,1,3,22> FH FV INV DC SAVE<comp6.pgm>')
+    >>> load_image('comp4.pgm') == load_image('comp6.pgm')
+    True
+    
+    >>> save_compressed_image(load_image('comp.pgm.compressed'), 'comp7.pgm.compressed', index=True)
+    >>> process_command('LOAD<comp7.pgm.compressed> CR<1,1,3,22> FH FV INV DC SAVE<comp7.pgm>')
+    >>> load_image('comp4.pgm') == load_image('comp7.pgm')
+    True
+    
+    >>> process_command('EXPLAIN LOAD<comp.pgm> INV FH FV CR<1,1,3,22> INV CP DC SAVE<comp8.pgm>')
+    LOAD<comp.pgm> CR<3,1,3,22> ROT SAVE<comp8.pgm>
     '''
     
-    cmd_list = ['LOAD', 'SAVE', 'INV', 'FH', 'FV', 'CR', 'CP', 'DC']
-    cmd = cmd.replace('<', ' <')
-    cmd = cmd.replace(',', ' ')
-    cmd = cmd.split(' ')
-    i = 0
+    words = cmd.split()
     
-    while i < len(cmd) - 1:
-        elem = cmd[i]
-        is_upper = check_capital(elem)
-        
-        if not(is_upper) or elem not in cmd_list:
-            raise AssertionError('Input proper commands: LOAD, SAVE, INV, FH, FV, CR, CP, or DC.')
-        
-        elif elem == 'LOAD':
-            curr_file = cmd[i + 1][1:-1]
-            img_matrix = load_image(curr_file)
-            i += 1
-        
-        elif elem == 'INV':
-            img_matrix = invert(img_matrix)
-        
-        elif elem == 'FH':
-            img_matrix = flip_horizontal(img_matrix)
-        
-        elif elem == 'FV':
-            img_matrix = flip_vertical(img_matrix)
-        
-        elif elem == 'CP':
-            img_matrix = compress(img_matrix)
-        
-        elif elem == 'DC':
-            img_matrix = decompress(img_matrix)
-        
-        elif elem == 'CR':
-            top_left_row = int((cmd[i + 1])[1:])        # gets rid of '<' and converts to int
-            top_left_col = int(cmd[i + 2])
-            num_row = int(cmd[i + 3])
-            num_col = int(cmd[i + 4][:-1])
-            img_matrix = crop(img_matrix, top_left_row, top_left_col, num_row, num_col)
-            i += 4
-        
-        elif elem == 'SAVE':
-            curr_file = cmd[i + 1][1:-1]
-            save_image(img_matrix, curr_file)
-            
-        i += 1
-            
+    if words[:1] == ['EXPLAIN']:
+        explain = True
+        cmd = ' '.join(words[1:])
+    
+    plan = parse_command(cmd)
+    
+    if optimize:
+        plan = optimize_plan(plan)
+    
+    if explain:
+        print(format_plan(plan))
+    else:
+        execute_plan(plan, streaming, cache, image_cache, profiler)
+
 
 if __name__ == '__main__':
-    doctest.testmod()
\ No newline at end of file
+    doctest.testmod()
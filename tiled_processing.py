@@ -0,0 +1,192 @@
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import image_processing
+from image_processing import Image, CompressedMatrix
+
+
+# Shared memory blocks a worker process has attached to, by name, so that each
+# block is only attached once per worker however many bands it processes.
+ATTACHED_BLOCKS = {}
+
+# Steps that can be run band by band between an optional DC and CP.
+TILED_STEPS = ['INV', 'FH', 'FV', 'ROT', 'CR']
+
+
+def attach_block(name):
+    ''' (str) -> SharedMemory
+    Returns the shared memory block called name, attaching to it if this
+    process has not done so yet.
+    '''
+    
+    if name not in ATTACHED_BLOCKS:
+        ATTACHED_BLOCKS[name] = shared_memory.SharedMemory(name)
+    
+    return ATTACHED_BLOCKS[name]
+
+
+def transform_band(task):
+    ''' (list) -> list<list<str>> or NoneType
+    Worker for run_tiled. task is [src_name, src_width, src_row, out_name,
+    out_offset, band_steps, num_row, compress]: the num_row rows of the source
+    image starting at src_row are run through band_steps by fused_transform.
+    If compress is True the compressed rows are returned, otherwise they are
+    written to the output block at out_offset.
+    '''
+    
+    src_name, src_width, src_row, out_name, out_offset, band_steps, num_row, compress = task
+    src = attach_block(src_name)
+    
+    band = Image(src_width, num_row, src.buf[src_row * src_width:(src_row + num_row) * src_width])
+    band = image_processing.fused_transform(band, band_steps)
+    
+    if compress:
+        return image_processing.compress(band)
+    
+    out = attach_block(out_name)
+    out.buf[out_offset:out_offset + len(band.data)] = band.data
+
+
+def decompress_band(task):
+    ''' (list) -> NoneType
+    Worker for run_tiled. task is [comp_rows, num_col, out_name, out_offset]:
+    the compressed rows comp_rows are decompressed into the output block at
+    out_offset.
+    '''
+    
+    comp_rows, num_col, out_name, out_offset = task
+    out = attach_block(out_name)
+    
+    for comp_row in comp_rows:
+        out.buf[out_offset:out_offset + num_col] = image_processing.decompress_row(comp_row, num_col)
+        out_offset += num_col
+
+
+def split_bands(num_row, band_rows):
+    ''' (int, int) -> list<list<int>>
+    Returns [first_row, num_row] of each band of at most band_rows rows.
+    
+    >>> split_bands(10, 4)
+    [[0, 4], [4, 4], [8, 2]]
+    '''
+    
+    return [[r, min(band_rows, num_row - r)] for r in range(0, num_row, band_rows)]
+
+
+def band_steps_for(top_left_col, num_col, flip_h, flip_v, table, num_row):
+    ''' (int, int, bool, bool, bytes, int) -> list<list>
+    Returns the steps that turn a band of num_row source rows into the
+    matching band of output rows, for the compiled steps of compile_steps.
+    
+    >>> band_steps_for(2, 3, True, False, image_processing.INVERT_TABLE, 5)
+    [['CR', 0, 2, 5, 3], ['FH'], ['INV']]
+    '''
+    
+    band_steps = [['CR', 0, top_left_col, num_row, num_col]]
+    
+    if flip_h:
+        band_steps.append(['FH'])
+    
+    if flip_v:
+        band_steps.append(['FV'])
+    
+    if table != image_processing.IDENTITY_TABLE:
+        band_steps.append(['INV'])
+    
+    return band_steps
+
+
+def run_tiled(img_matrix, steps, processes=None, band_rows=None):
+    ''' (Image or <list<list>>, list<list>, int, int) -> Image or CompressedMatrix
+    Runs steps (as in a plan from parse_command) on img_matrix across a pool of
+    processes worker processes (default: one per CPU), band_rows rows at a
+    time. Pixels are passed to the workers through shared memory, not pickled.
+    steps is an optional DC, then any INV, FH, FV, ROT and CR steps, then an
+    optional CP. Compressed rows from CP are put back together in order.
+    Gives exactly the same result as running the steps one after the other.
+    Raises an AssertionError if the steps cannot be run this way.
+    
+    >>> image = Image.from_matrix([[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+    >>> run_tiled(image, [['INV'], ['FV'], ['CR', 0, 1, 2, 2]], processes=2, band_rows=1).to_matrix()
+    [[247, 246], [250, 249]]
+    
+    >>> run_tiled(image, [['FH'], ['CP']], processes=2, band_rows=2)
+    [['3x1', '2x1', '1x1'], ['6x1', '5x1', '4x1'], ['9x1', '8x1', '7x1']]
+    
+    >>> run_tiled([['5x2'], ['6x1', '7x1']], [['DC'], ['ROT']], processes=2).to_matrix()
+    [[7, 6], [5, 5]]
+    
+    >>> run_tiled(image, [['SAVE', 'x.pgm', None]])
+    Traceback (most recent call last):
+    AssertionError: Only DC, INV, FH, FV, ROT, CR and CP can be run in tiles.
+    '''
+    
+    steps = list(steps)
+    decompress = len(steps) > 0 and steps[0][0] == 'DC'
+    compress = len(steps) > 0 and steps[-1][0] == 'CP'
+    pixel_steps = steps[int(decompress):len(steps) - int(compress)]
+    
+    if not(all(step[0] in TILED_STEPS for step in pixel_steps)):
+        raise AssertionError('Only DC, INV, FH, FV, ROT, CR and CP can be run in tiles.')
+    
+    if processes is None:
+        processes = os.cpu_count() or 1
+    
+    if decompress:
+        num_col = image_processing.check_compressed_image(img_matrix)
+        num_row = len(img_matrix)
+    else:
+        if not(image_processing.is_valid_image(img_matrix)):
+            raise AssertionError('Input matrix must be in PGM image format.')
+        img_matrix = Image.from_matrix(img_matrix)
+        num_row = img_matrix.height
+        num_col = img_matrix.width
+    
+    if band_rows is None:
+        band_rows = max(1, -(-num_row // (processes * 4)))
+    
+    src = shared_memory.SharedMemory(create=True, size=max(1, num_row * num_col))
+    out = None
+    pool = multiprocessing.Pool(processes)
+    
+    try:
+        if decompress:
+            tasks = [[img_matrix[r:r + n], num_col, src.name, r * num_col] for r, n in split_bands(num_row, band_rows)]
+            for result in pool.imap_unordered(decompress_band, tasks):
+                pass
+        else:
+            for r in range(num_row):
+                src.buf[r * num_col:(r + 1) * num_col] = img_matrix.row(r)
+    
+        top_left_row, top_left_col, out_num_row, out_num_col, flip_h, flip_v, table = image_processing.compile_steps(pixel_steps, num_row, num_col)
+        tasks = []
+    
+        for r, n in split_bands(out_num_row, band_rows):
+            if flip_v:
+                src_row = top_left_row + out_num_row - r - n
+            else:
+                src_row = top_left_row + r
+            band_steps = band_steps_for(top_left_col, out_num_col, flip_h, flip_v, table, n)
+            tasks.append([src.name, num_col, src_row, None, r * out_num_col, band_steps, n, compress])
+    
+        if compress:
+            comp_img_matrix = CompressedMatrix()
+            for comp_rows in pool.imap(transform_band, tasks):
+                comp_img_matrix.extend(comp_rows)
+            return comp_img_matrix
+    
+        out = shared_memory.SharedMemory(create=True, size=max(1, out_num_row * out_num_col))
+        for task in tasks:
+            task[3] = out.name
+        for result in pool.imap_unordered(transform_band, tasks):
+            pass
+    
+        return Image(out_num_col, out_num_row, bytearray(out.buf[:out_num_row * out_num_col]))
+    finally:
+        pool.close()
+        pool.join()
+        for block in [src, out]:
+            if block is not None:
+                block.close()
+                block.unlink()